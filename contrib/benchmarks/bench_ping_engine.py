@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+contrib/benchmarks/bench_ping_engine.py
+
+Throughput benchmark for the ping engine against a local fake HTTP server.
+
+Spins up a threaded HTTP server on localhost that answers every request after
+a configurable delay, then pings a set of fake services spread across a number
+of fake hosts, first one at a time (as the old one-job-per-service pings did)
+and then with the ping engine. Nothing is written to the database.
+
+    python contrib/benchmarks/bench_ping_engine.py --services 500 --hosts 20 --latency 0.05
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from argparse import ArgumentParser
+from bson import ObjectId
+import time
+
+from ioos_catalog.models.service import Service
+from ioos_catalog.tasks.ping_engine import PingEngine
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.
+    body = 'Attributes {\n}\n'
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class BenchService(dict):
+    '''
+    Stand-in for a Service document that uses the real Service.ping
+    '''
+    get_ping_url = Service.__dict__['get_ping_url']
+    get_ping_byte_cap = Service.__dict__['get_ping_byte_cap']
+    timed_ping = Service.__dict__['timed_ping']
+    ping = Service.__dict__['ping']
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+class NullSinkEngine(PingEngine):
+    def flush(self, results):
+        pass
+
+
+def make_services(base_url, count, hosts):
+    return [BenchService(_id=ObjectId(),
+                         url=u'%s/svc%d' % (base_url, i),
+                         tld=u'host%d' % (i % hosts),
+                         service_type=u'DAP')
+            for i in xrange(count)]
+
+
+def bench_sequential(services, timeout):
+    start = time.time()
+    for s in services:
+        s.ping(timeout=timeout)
+    return time.time() - start
+
+
+def bench_engine(services, workers, per_host, timeout):
+    engine = NullSinkEngine(workers=workers, per_host=per_host, timeout=timeout)
+    stats = engine.run(services)
+    return stats['elapsed']
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--services', type=int, default=500)
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the fake server waits before answering')
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--per-host', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=15)
+    parser.add_argument('--skip-sequential', action='store_true')
+    args = parser.parse_args()
+
+    FakeHandler.latency = args.latency
+    server = FakeServer(('127.0.0.1', 0), FakeHandler)
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    services = make_services(base_url, args.services, args.hosts)
+
+    if not args.skip_sequential:
+        elapsed = bench_sequential(services, args.timeout)
+        print 'sequential: %d pings in %.2fs (%.1f pings/s)' % (len(services), elapsed, len(services) / elapsed)
+
+    elapsed = bench_engine(services, args.workers, args.per_host, args.timeout)
+    print 'engine:     %d pings in %.2fs (%.1f pings/s, %d workers, %d per host)' % (
+        len(services), elapsed, len(services) / elapsed, args.workers, args.per_host)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
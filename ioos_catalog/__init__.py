@@ -45,8 +45,13 @@ redis_pool = redis.ConnectionPool(host=app.config.get('REDIS_HOST'),
 redis_connection = redis.Redis(connection_pool=redis_pool)
 
 # rq
+# One queue per workload, highest priority first. A worker listening to
+# several queues always takes the next job from the first one that has any,
+# so pings and emails don't wait behind a backlog of harvests.
 from rq import Queue
-queue = Queue('default', connection=redis_connection)
+QUEUE_NAMES = ['pings', 'email', 'default', 'reindex', 'harvests']
+queues = {name: Queue(name, connection=redis_connection) for name in QUEUE_NAMES}
+queue = queues['default']
 
 # Create the database connection
 from flask.ext.mongokit import MongoKit
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/harvesters/dap_cache.py
+
+An on-disk cache of the DAS and DDS of OPeNDAP datasets, keyed by URL. Most
+datasets don't change between nightly harvests, so the documents are kept
+with their ETag and Last-Modified and revalidated with a conditional GET,
+which a server that supports it answers with a bodyless 304. An entry
+validated less than max_age seconds ago is used without asking at all.
+
+The cache is bounded to max_bytes, evicting the least recently used entries
+first. Entries are written to temporary files and renamed into place, so the
+worker processes can share one directory.
+
+The netCDF C library fetches the documents itself, so harvesters open
+datasets through a DapCacheProxy, a local HTTP server that answers the DAS
+and DDS requests from the cache and passes the data requests through.
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Array, Process
+from SocketServer import ThreadingMixIn
+from ioos_catalog import app, http_client
+from ioos_catalog.timeout import TimeoutError
+import base64
+import hashlib
+import json
+import os
+import requests
+import socket
+import struct
+import tempfile
+import time
+import urlparse
+
+# how fetch found an entry
+HIT = 'hit'
+REVALIDATED = 'revalidated'
+MISS = 'miss'
+
+# the documents the cache keeps, the rest of a dataset is always fetched
+CACHED_SUFFIXES = ('.das', '.dds')
+
+# DAP response headers kept with an entry and sent back with it
+KEPT_HEADERS = ('Content-Type', 'Content-Description', 'XDODS-Server', 'XOPeNDAP-Server')
+
+# hop-by-hop headers of a passed through response, which don't apply to the
+# one the proxy sends
+SKIPPED_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                   'te', 'trailers', 'transfer-encoding', 'upgrade')
+
+
+def get_dap_cache():
+    '''
+    Returns the DapCache configured by DAP_CACHE_DIR, or None if there is
+    none or it can't be used
+    '''
+    path = app.config.get('DAP_CACHE_DIR')
+    if not path:
+        return None
+    try:
+        return DapCache(path,
+                        max_bytes=app.config.get('DAP_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+                        max_age=app.config.get('DAP_CACHE_MAX_AGE', 0))
+    except OSError:
+        app.logger.warning("Can't use the DAP cache in %s", path, exc_info=True)
+        return None
+
+
+class DapCache(object):
+    '''
+    DAS and DDS documents on disk. An entry is a dict of
+
+        url, etag, last_modified, headers, sha1, size, fetched, validated
+
+    and its body, stored side by side as <sha1 of url>.json and .body. The
+    modification time of the body records its last use.
+    '''
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_age=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another worker made it first
+                if not os.path.isdir(path):
+                    raise
+
+    def _paths(self, url):
+        base = os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        return base + '.json', base + '.body'
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def get(self, url):
+        '''
+        Returns the entry for url with its 'body', or None
+        '''
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'rb') as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+            os.utime(body_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        # a body and metadata written by different workers at once
+        if entry.get('url') != url or hashlib.sha1(body).hexdigest() != entry.get('sha1'):
+            return None
+        entry['body'] = body
+        return entry
+
+    def put(self, url, body, etag=None, last_modified=None, headers=None):
+        '''
+        Stores body for url and returns its entry
+        '''
+        now = time.time()
+        entry = {'url': url,
+                 'etag': etag or None,
+                 'last_modified': last_modified or None,
+                 'headers': headers or {},
+                 'sha1': hashlib.sha1(body).hexdigest(),
+                 'size': len(body),
+                 'fetched': now,
+                 'validated': now}
+        meta_path, body_path = self._paths(url)
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(entry))
+        self.evict()
+        entry['body'] = body
+        return entry
+
+    def validated(self, url, entry):
+        '''
+        Records that entry was found unchanged on the server
+        '''
+        entry['validated'] = time.time()
+        meta = {k: v for k, v in entry.iteritems() if k != 'body'}
+        self._write(self._paths(url)[0], json.dumps(meta))
+
+    def fetch(self, url, timeout=None, deadline=None):
+        '''
+        Returns (entry, how) for url, how being HIT if the entry was fresh
+        enough to use as is, REVALIDATED if the server said it hadn't changed
+        and MISS if it was downloaded.
+
+        Raises requests.RequestException if it can't be fetched.
+        '''
+        entry = self.get(url)
+        if entry is not None and self.max_age and time.time() - entry['validated'] < self.max_age:
+            return entry, HIT
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = http_client.get(url, timeout=timeout, deadline=deadline, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            self.validated(url, entry)
+            return entry, REVALIDATED
+        response.raise_for_status()
+        # a connection closed early isn't an error to requests, and a partial
+        # document must not be cached
+        length = response.headers.get('Content-Length')
+        if (length and length.isdigit() and not response.headers.get('Content-Encoding') and
+                int(length) != len(response.content)):
+            raise requests.ConnectionError("Got %d of the %s bytes of %s" % (len(response.content),
+                                                                           length, url))
+        kept = {k: response.headers[k] for k in KEPT_HEADERS if k in response.headers}
+        entry = self.put(url, response.content, response.headers.get('ETag'),
+                         response.headers.get('Last-Modified'), kept)
+        return entry, MISS
+
+    def entries(self):
+        '''
+        Returns a list of (last used, size, body path) of the bodies on disk
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.body'):
+                continue
+            body_path = os.path.join(self.path, name)
+            try:
+                st = os.stat(body_path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, body_path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in
+        max_bytes. Returns the number removed.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, body_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (body_path[:-len('.body')] + '.json', body_path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def encode_url(url):
+    return base64.urlsafe_b64encode(url.encode('utf-8')).rstrip('=')
+
+
+class _ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    '''
+    Serves /dap/<encoded dataset url><suffix>?<query> for the datasets the
+    proxy was made for, the DAS and DDS from the cache and everything else
+    from the dataset's server
+    '''
+
+    def do_GET(self):
+        server = self.server
+        path, _, query = self.path.partition('?')
+        if not path.startswith('/dap/'):
+            self.send_error(404)
+            return
+        token, dot, suffix = path[len('/dap/'):].partition('.')
+        if token not in server.datasets:
+            # only the harvester's datasets, it's no open proxy
+            self.send_error(404)
+            return
+        url = server.datasets[token] + dot + suffix
+
+        sent = False
+        try:
+            entry = None
+            if dot + suffix in CACHED_SUFFIXES and not query:
+                try:
+                    entry, how = server.cache.fetch(url, deadline=server.deadline)
+                    server.count(how)
+                except requests.RequestException:
+                    # an IOError too, but from the server
+                    raise
+                except (IOError, OSError) as e:
+                    # a full disk or unwritable cache, the server still has
+                    # the document
+                    app.logger.warning("DAP cache failed for %s, passing it through: %s", url, e)
+            if entry is not None:
+                self.send_response(200)
+                for k, v in entry['headers'].iteritems():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(entry['size']))
+                self.end_headers()
+                sent = True
+                self.wfile.write(entry['body'])
+                return
+
+            if query:
+                url += '?' + query
+            # the body is passed on as it comes, with its own length and
+            # encoding, so a client can tell if it is cut short
+            headers = {'Accept-Encoding': self.headers.get('Accept-Encoding') or 'identity'}
+            response = http_client.get(url, deadline=server.deadline, stream=True, headers=headers)
+            self.send_response(response.status_code)
+            for k, v in response.headers.iteritems():
+                if k.lower() not in SKIPPED_HEADERS:
+                    self.send_header(k, v)
+            self.end_headers()
+            sent = True
+            size = 0
+            for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                self.wfile.write(chunk)
+                size += len(chunk)
+            # the server closing the connection early doesn't always raise
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and size != int(length):
+                raise requests.ConnectionError("Got %d of the %s bytes of %s" % (size, length, url))
+        except Exception as e:
+            if sent:
+                # too late for an error response, it would land in the middle
+                # of the body, so the connection is reset instead
+                app.logger.warning("DAP proxy failed while sending %s", url, exc_info=True)
+                self.abort()
+            elif isinstance(e, requests.HTTPError):
+                self.send_error(e.response.status_code)
+            elif isinstance(e, requests.Timeout):
+                self.send_error(504)
+            elif isinstance(e, (requests.RequestException, TimeoutError)):
+                app.logger.warning("DAP proxy could not get %s", url, exc_info=True)
+                self.send_error(502)
+            else:
+                raise
+
+    def abort(self):
+        '''
+        Resets the connection, so the client sees the response fail rather
+        than end
+        '''
+        self.close_connection = 1
+        try:
+            self.wfile.flush()
+        except socket.error:
+            pass
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def log_message(self, format, *args):
+        app.logger.debug("DAP proxy: " + format, *args)
+
+
+class DapCacheProxy(object):
+    '''
+    A local HTTP server in its own process that datasets are opened through,
+    so their DAS and DDS come from the cache:
+
+        with DapCacheProxy(cache, [url], deadline) as proxy:
+            nc = Dataset(proxy.url(url))
+
+    It only forwards requests for the datasets it was made for.
+
+    The server has its own process because the netCDF library may hold the
+    GIL while it waits for the answer.
+    '''
+
+    def __init__(self, cache, datasets, deadline=None):
+        self.cache = cache
+        self.datasets = {encode_url(url): url for url in datasets}
+        self.deadline = deadline
+        self.port = None
+        self.process = None
+        # hits, revalidations and misses, shared with the server process
+        self._stats = Array('i', 3)
+
+    @staticmethod
+    def can_proxy(url):
+        '''
+        Returns True for the dataset URLs the proxy can forward, plain http
+        or https ones
+        '''
+        parts = urlparse.urlsplit(url)
+        return parts.scheme in ('http', 'https') and not parts.query and not parts.fragment
+
+    def url(self, url):
+        '''
+        Returns the URL dataset url is opened at through the proxy. Raises
+        KeyError if the proxy wasn't made for it.
+        '''
+        token = encode_url(url)
+        if token not in self.datasets:
+            raise KeyError(url)
+        return 'http://127.0.0.1:%d/dap/%s' % (self.port, token)
+
+    @property
+    def stats(self):
+        return dict(zip((HIT, REVALIDATED, MISS), self._stats[:]))
+
+    def start(self):
+        server = _ProxyServer(('127.0.0.1', 0), _ProxyHandler)
+        server.cache = self.cache
+        server.datasets = self.datasets
+        server.deadline = self.deadline
+        stats = self._stats
+
+        def count(how):
+            with stats.get_lock():
+                stats[(HIT, REVALIDATED, MISS).index(how)] += 1
+        server.count = count
+
+        self.port = server.server_address[1]
+        self.process = Process(target=server.serve_forever, name='dap-proxy-%d' % self.port)
+        self.process.daemon = True
+        self.process.start()
+        # the server process has its own copy of the socket
+        server.server_close()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -6,6 +6,8 @@ ioos_catalog/harvesters/dap_harvester.py
 Harvester for OPeNDAP
 '''
 from ioos_catalog.harvesters.harvester import Harvester
+from ioos_catalog.harvesters.dap_cache import DapCacheProxy, get_dap_cache
+from ioos_catalog.harvesters.geometry import curvilinear_polygon, read_chunks, simplify_trajectory
 from ioos_catalog.harvesters import get_common_name, unicode_or_none
 from ioos_catalog.util import getsize
 from bson import ObjectId
@@ -22,22 +24,91 @@ from wicken.netcdf_dogma import NetCDFDogma
 
 from shapely.geometry import mapping, box, Point, asLineString
 
-from ioos_catalog import app, db
+from ioos_catalog import app, db, http_client
+from ioos_catalog.timeout import DeadlineExceeded
 from dateutil.parser import parse
 from netCDF4 import num2date
 
 # py2/3 compat
 from six.moves.urllib.request import urlopen
 
-import requests
 import itertools
-import re
 import math
+import netCDF4
+import os
+import re
+import tempfile
 import numpy as np
 
 import json
 
 
+class SharedDataset(Dataset):
+    '''
+    A remote dataset shared by every stage of a harvest. paegan closes the
+    handle it is given once it has sniffed the grid type, so close does
+    nothing here and the harvester calls release when it is done.
+    '''
+
+    def close(self):
+        pass
+
+    def release(self):
+        Dataset.close(self)
+
+
+# rc files the netCDF C library reads its DAP client settings from, in the
+# order it looks for them when DAPRCFILE isn't set
+RC_FILES = ('.daprc', '.dodsrc')
+
+# the rc file of this process, with the timeouts of the last set_dap_timeouts
+_rc_path = None
+
+
+def read_rc_lines():
+    '''
+    Returns the lines of the rc file the netCDF library would read, so its
+    other settings are kept
+    '''
+    paths = [os.environ.get('DAPRCFILE')] if os.environ.get('DAPRCFILE') else []
+    for directory in (os.getcwd(), os.path.expanduser('~')):
+        paths.extend(os.path.join(directory, name) for name in RC_FILES)
+    for path in paths:
+        if path != _rc_path and os.path.isfile(path):
+            with open(path) as f:
+                return f.read().splitlines()
+    return []
+
+
+def set_dap_timeouts(timeout, connect_timeout):
+    '''
+    Sets the HTTP.TIMEOUT and HTTP.CONNECTTIMEOUT of the netCDF C library's
+    DAP client, in seconds, None for no timeout. They bound every request it
+    makes, so a hung server fails the open or read instead of blocking it.
+
+    netCDF4 with rc_set (netCDF 4.9) takes them directly. Older versions
+    read them from the rc file named by DAPRCFILE when they first open a
+    DAP URL, once per RQ work horse.
+    '''
+    settings = [('HTTP.TIMEOUT', timeout), ('HTTP.CONNECTTIMEOUT', connect_timeout)]
+    settings = [(k, str(int(math.ceil(v))) if v else '0') for k, v in settings]
+    rc_set = getattr(netCDF4, 'rc_set', None)
+    if rc_set is not None:
+        for k, v in settings:
+            rc_set(k, v)
+        return
+
+    global _rc_path
+    lines = [l for l in read_rc_lines() if l.split('=')[0].strip() not in dict(settings)]
+    lines.extend('%s=%s' % kv for kv in settings)
+    if _rc_path is None:
+        fd, _rc_path = tempfile.mkstemp(prefix='daprc-')
+        os.close(fd)
+    with open(_rc_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.environ['DAPRCFILE'] = _rc_path
+
+
 class DapHarvestError(Exception):
     def __init__(self, message):
         self.message = message
@@ -98,10 +169,16 @@ class DapHarvester(Harvester):
                          u'lon_rho',
                          u'lat_psi']
 
-    def __init__(self, service):
-        Harvester.__init__(self, service)
+    # longest a single request of the netCDF library may take, the deadline
+    # permitting
+    OPEN_TIMEOUT = 600
+
+    def __init__(self, service, deadline=None):
+        Harvester.__init__(self, service, deadline)
         self.std_variables = None
         self.non_std_variables = None
+        self.nc = None
+        self.proxy = None
         self.cd = None
         self.axis_names = None
         self.messages = []
@@ -157,7 +234,7 @@ class DapHarvester(Harvester):
         y_name_trunc = coord_names['yname'][2:]
         gj_url = (self.service.get('url') + '.geoJson?' +
                   x_name_trunc + ',' + y_name_trunc)
-        response = requests.get(gj_url)
+        response = http_client.get(gj_url, deadline=self.deadline)
         if response.status_code != 200:
             raise DapGeometryError('Failed to get Geometry from ERDDAP {}'
                                    ''.format(response.url))
@@ -214,8 +291,44 @@ class DapHarvester(Harvester):
                         return None, None
         return None, None
 
+    def open_dataset(self):
+        """
+        Returns the remote dataset, opening it the first time. Every stage of
+        the harvest shares this one handle, so the DAS and DDS are fetched
+        once per harvest (see counters['remote_opens']).
+        """
+        if self.nc is None:
+            url = self.service.get('url')
+            # through the DAP cache, when there is one, so an unchanged DAS
+            # and DDS aren't downloaded again
+            cache = get_dap_cache()
+            if cache is not None and DapCacheProxy.can_proxy(url):
+                self.proxy = DapCacheProxy(cache, [url], self.deadline).start()
+                url = self.proxy.url(url)
+            set_dap_timeouts(self.deadline.timeout(self.OPEN_TIMEOUT),
+                             self.deadline.timeout(app.config.get('HTTP_CONNECT_TIMEOUT', 10)))
+            self.nc = SharedDataset(url)
+            self.count('remote_opens')
+        return self.nc
+
+    def close_dataset(self):
+        if self.nc is not None:
+            try:
+                self.nc.release()
+            except RuntimeError:
+                pass
+        if self.proxy is not None:
+            self.proxy.stop()
+            for how, n in self.proxy.stats.iteritems():
+                self.count('dap_cache_%s' % how, n)
+        self.nc = None
+        self.proxy = None
+        self.cd = None
+
     def load_dataset(self):
-        self.cd = CommonDataset.open(self.service.get('url'))
+        self.cd = CommonDataset.open(self.open_dataset())
+        # paegan keeps what it was opened from for its repr
+        self.cd._filepath = self.service.get('url')
         self.std_variables = None
         self.non_std_variables = None
         self.get_standards(self.cd)
@@ -231,10 +344,20 @@ class DapHarvester(Harvester):
           * RGRID
           * DSG
         """
+        try:
+            return self._harvest()
+        finally:
+            self.close_dataset()
 
+    def _harvest(self):
         try:
-            cd = self.load_dataset()
+            with self.phase('open'):
+                cd = self.load_dataset()
+        except DeadlineExceeded:
+            raise
         except Exception as e:
+            # an open that failed once the deadline passed timed out
+            self.deadline.check('Opening the dataset')
             app.logger.error("Could not open DAP dataset from '%s'\n"
                              "Exception %s: %s" % (self.service.get('url'),
                                                    type(e).__name__, e))
@@ -328,13 +451,14 @@ class DapHarvester(Harvester):
 
         gj = None
 
-        if is_ugrid:
-            self.messages.append(
-                u"The underlying 'Paegan' data access library does not support UGRID and cannot parse geometry.")
-        elif is_trajectory:
-            gj = self.parse_trajectory()
-        else:
-            gj = self.parse_geometry()
+        with self.phase('geometry'):
+            if is_ugrid:
+                self.messages.append(
+                    u"The underlying 'Paegan' data access library does not support UGRID and cannot parse geometry.")
+            elif is_trajectory:
+                gj = self.parse_trajectory()
+            else:
+                gj = self.parse_geometry()
 
         # TODO: compute bounding box using global attributes
 
@@ -377,48 +501,94 @@ class DapHarvester(Harvester):
             'geojson': gj,
             'updated': datetime.utcnow()
         }
-        with app.app_context():
+        with self.phase('save'), app.app_context():
             dataset.services.append(service)
             dataset.updated = datetime.utcnow()
             dataset.save()
 
-        ncdataset = Dataset(self.service.get('url'))
-        scores = self.ccheck_dataset(ncdataset)
-        metamap = self.metamap_dataset(ncdataset)
+        with self.phase('ccheck'):
+            ncdataset = self.open_dataset()
+            scores = self.ccheck_dataset(ncdataset)
+            metamap = self.metamap_dataset(ncdataset)
 
-        try:
-            self.save_ccheck_dataset('ioos', dataset._id, scores, metamap)
-        except Exception as e:
-            app.logger.error(
-                "could not save compliancecheck/metamap information", exc_info=True)
+            try:
+                self.save_ccheck_dataset('ioos', dataset._id, scores, metamap)
+            except Exception as e:
+                app.logger.error(
+                    "could not save compliancecheck/metamap information", exc_info=True)
 
         if deferred_exception is not None:
             raise deferred_exception
         return "Harvested"
 
+    def grid_key(self, variable):
+        """
+        Returns the (x, y) coordinate variable names paegan computes the
+        geometry of variable from, or None if it can't tell
+        """
+        try:
+            # paegan's grid objects ignore the axis names, so neither does this
+            names = self.cd.get_coord_names(variable)
+        except (AttributeError, AssertionError, ValueError, KeyError, IndexError):
+            return None
+        if names['xname'] is None or names['yname'] is None:
+            return None
+        return names['xname'], names['yname']
+
+    def variable_geometry(self, variable, key=None):
+        """
+        Returns the bounding polygon, box or point of variable as GeoJSON, or
+        None if paegan can't calculate either. key is the variable's
+        grid_key.
+        """
+        if key is not None:
+            xvar = self.cd.nc.variables[key[0]]
+            yvar = self.cd.nc.variables[key[1]]
+            if xvar.ndim == 2 and yvar.ndim == 2:
+                # paegan would read the whole curvilinear grid, only its
+                # edges are needed
+                try:
+                    self.count('geometry_edge_reads')
+                    return mapping(curvilinear_polygon(xvar, yvar).simplify(0.5))
+                except (ValueError, IndexError):
+                    app.logger.warning("Could not calculate the polygon of %s from the edges of %s",
+                                       variable, key, exc_info=True)
+        try:
+            return mapping(self.cd.getboundingpolygon(var=variable, **self.axis_names).simplify(0.5))
+        except (AttributeError, AssertionError, ValueError,
+                KeyError, IndexError):
+            try:
+                # Returns a tuple of four coordinates, but box takes in four seperate positional argouments
+                # Asterik magic to expland the tuple into positional
+                # arguments
+                app.logger.exception("Error calculating bounding box")
+
+                # handles "points" aka single position NCELLs
+                bbox = self.cd.getbbox(var=variable, **self.axis_names)
+                return self.get_bbox_or_point(bbox)
+
+            except (AttributeError, AssertionError, ValueError,
+                    KeyError, IndexError):
+                return None
+
     def parse_geometry(self):
         # badams: Start with gj object set to None so we don't get
         #         uncaught UnboundLocalError exceptions when we try to run
         #         conditionals on gj
         gj = None
+        # geometry by (x, y) coordinate variables, model output has dozens of
+        # variables on one grid and each calculation reads the coordinates
+        grids = {}
         for v in itertools.chain(self.std_variables, self.non_std_variables):
-            try:
-                gj = mapping(self.cd.getboundingpolygon(var=v, **self.axis_names).simplify(0.5))
-            except (AttributeError, AssertionError, ValueError,
-                    KeyError, IndexError):
-                try:
-                    # Returns a tuple of four coordinates, but box takes in four seperate positional argouments
-                    # Asterik magic to expland the tuple into positional
-                    # arguments
-                    app.logger.exception("Error calculating bounding box")
-
-                    # handles "points" aka single position NCELLs
-                    bbox = self.cd.getbbox(var=v, **self.axis_names)
-                    gj = self.get_bbox_or_point(bbox)
-
-                except (AttributeError, AssertionError, ValueError,
-                        KeyError, IndexError):
-                    pass
+            key = self.grid_key(v)
+            if key is not None and key in grids:
+                self.count('geometry_reads_avoided')
+                gj = grids[key]
+            else:
+                self.count('geometry_reads')
+                gj = self.variable_geometry(v, key)
+                if key is not None:
+                    grids[key] = gj
 
             if gj is not None:
                 # We computed something, break out of loop.
@@ -469,14 +639,8 @@ class DapHarvester(Harvester):
     def parse_trajectory_geometry(self, variable, coord_names):
         xvar = self.cd.nc.variables[coord_names['xname']]
         yvar = self.cd.nc.variables[coord_names['yname']]
-
-        # one less order of magnitude eg 390000 -> 10000
-        slice_factor = 10 ** (int(math.log10(xvar.size)) - 1)
-        if slice_factor < 1:
-            slice_factor = 1
-
-        # TODO: don't split x/y as separate arrays.  Refactor to
-        # use single numpy array instead with both lon/lat
+        max_vertices = app.config.get('TRAJECTORY_MAX_VERTICES', 1000)
+        chunk_size = app.config.get('TRAJECTORY_CHUNK_SIZE', 100000)
 
         # tabledap datasets must be treated differently than
         # standard DAP endpoints.  Retrieve geojson instead of
@@ -485,20 +649,20 @@ class DapHarvester(Harvester):
             # take off 's.' from erddap
             gj = self.erddap_geojson_url(coord_names)
             # type defaults to MultiPoint, change to LineString
-            coords = np.array(gj['coordinates'][::slice_factor] +
-                              gj['coordinates'][-1:])
-            xs = coords[:, 0]
-            ys = coords[:, 1]
+            coords = np.array(gj['coordinates'], dtype='float64').reshape(-1, 2)
+            chunks = ((coords[i:i + chunk_size, 0], coords[i:i + chunk_size, 1])
+                      for i in xrange(0, len(coords), chunk_size))
         else:
-            xs = np.concatenate((xvar[::slice_factor], xvar[-1:]))
-            ys = np.concatenate((yvar[::slice_factor], yvar[-1:]))
-        # both coords must be valid to have a valid vertex
-        # get rid of any nans and unreasonable lon/lats
-        valid_idx = ((~np.isnan(xs)) & (np.absolute(xs) <= 180) &
-                     (~np.isnan(ys)) & (np.absolute(ys) <= 90))
-
-        xs = xs[valid_idx]
-        ys = ys[valid_idx]
+            # read in chunks and simplified as it goes, so memory doesn't
+            # grow with the length of the track
+            chunks = read_chunks(xvar, yvar, chunk_size)
+
+        simplifier = simplify_trajectory(chunks, max_vertices)
+        xs, ys = simplifier.result()
+        self.count('trajectory_points', simplifier.points)
+        if len(xs) < 2:
+            raise DapGeometryError("Trajectory has %d valid points of %d" % (len(xs), simplifier.points))
+
         # Shapely seems to require float64 values or incorrect
         # values will propagate for the generated lineString
         # if the array is not numpy's float64 dtype
@@ -507,8 +671,9 @@ class DapHarvester(Harvester):
         gj = mapping(asLineString(lineCoords))
 
         self.messages.append(u"Variable %s was used to calculate "
-                             u"trajectory geometry, and is a "
-                             u"naive sampling." % variable)
+                             u"trajectory geometry, simplified to %d of "
+                             u"%d points (%d invalid)." % (variable, len(xs), simplifier.points,
+                                                          simplifier.invalid))
         return gj
 
     def get_standards(self, cd):
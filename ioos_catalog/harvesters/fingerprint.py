@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/harvesters/fingerprint.py
+
+Fingerprints of the documents a harvest is built from, the capabilities
+document of an OGC service or the DAS and DDS of an OPeNDAP dataset. A
+service whose fingerprint hasn't changed since its last successful harvest
+doesn't need to be harvested again.
+
+Each document is fetched with the ETag and Last-Modified of the last
+fingerprint, so a server that supports conditional requests answers 304
+without sending it again. Otherwise the SHA-1 of the body is compared.
+
+The DAS and DDS go through the DAP cache when there is one, which leaves
+them fresh in it for the harvest that may follow.
+'''
+from ioos_catalog import http_client
+from ioos_catalog.harvesters.dap_cache import get_dap_cache
+import hashlib
+import urllib
+import urlparse
+
+
+def get_fingerprint_urls(service):
+    '''
+    Returns the URLs of the documents that describe a service
+    '''
+    url = service.url
+    if service.service_type == 'DAP':
+        return [url + '.das', url + '.dds']
+
+    # the whole capabilities document, whatever sections the URL asks for
+    p = list(urlparse.urlparse(url))
+    qdict = {k: v for k, v in urlparse.parse_qsl(p[4])
+             if k.lower() not in ('service', 'request', 'sections')}
+    qdict['service'] = service.service_type
+    qdict['request'] = 'GetCapabilities'
+    p[4] = urllib.urlencode(qdict)
+    return [urlparse.urlunparse(p)]
+
+
+def fetch_fingerprint(service, previous=None, timeout=None):
+    '''
+    Returns the fingerprint of a service, a list of {'url', 'etag',
+    'last_modified', 'sha1'} dicts, one per document. previous is the last
+    fingerprint, its validators make the requests conditional.
+
+    Raises requests.RequestException if a document can't be fetched.
+    '''
+    previous = {f['url']: f for f in previous or []}
+    cache = get_dap_cache() if service.service_type == 'DAP' else None
+    fingerprint = []
+    for url in get_fingerprint_urls(service):
+        if cache is not None:
+            entry, _ = cache.fetch(url, timeout=timeout)
+            fingerprint.append({'url': unicode(url),
+                                'etag': unicode(entry['etag'] or ''),
+                                'last_modified': unicode(entry['last_modified'] or ''),
+                                'sha1': unicode(entry['sha1'])})
+            continue
+
+        last = previous.get(url)
+        headers = {}
+        if last is not None:
+            if last.get('etag'):
+                headers['If-None-Match'] = last['etag']
+            if last.get('last_modified'):
+                headers['If-Modified-Since'] = last['last_modified']
+
+        response = http_client.get(url, timeout=timeout, headers=headers)
+        if response.status_code == 304 and last is not None:
+            fingerprint.append(last)
+            continue
+        response.raise_for_status()
+        fingerprint.append({'url': unicode(url),
+                            'etag': unicode(response.headers.get('ETag') or ''),
+                            'last_modified': unicode(response.headers.get('Last-Modified') or ''),
+                            'sha1': unicode(hashlib.sha1(response.content).hexdigest())})
+    return fingerprint
+
+
+def same_fingerprint(a, b):
+    '''
+    Returns True if two fingerprints describe the same documents
+    '''
+    if not a or not b:
+        return False
+    return sorted((f['url'], f['sha1']) for f in a) == sorted((f['url'], f['sha1']) for f in b)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/harvesters/geometry.py
+
+Geometry of remote datasets computed from as little of them as possible.
+
+paegan builds the bounding polygon of a curvilinear grid (ROMS, HF Radar)
+from the whole 2-D longitude and latitude arrays, hundreds of MB for a large
+model over DAP. The polygon only depends on the grid's perimeter, so here it
+is built from strided reads of the four edge rows and columns, and what is
+read grows with the perimeter rather than the area.
+
+Trajectories of gliders and drifters can have millions of points, so they
+are read in chunks and simplified as they stream in, keeping a bounded
+number of vertices (see TrajectorySimplifier).
+'''
+from shapely.geometry import LineString, MultiPoint
+from shapely.ops import polygonize, unary_union
+import numpy as np
+
+# most points read along one edge of a grid, longer edges are strided
+EDGE_POINTS = 2000
+
+# rings of a grid read inward looking for valid coordinates, when its edges
+# are masked or NaN
+MAX_RINGS = 3
+
+
+def edge_stride(n, max_points=EDGE_POINTS):
+    '''
+    Returns the stride that reads at most max_points of an edge of n points,
+    not counting its last point, which is always read
+    '''
+    return max(int(np.ceil(float(n) / max(max_points, 1))), 1)
+
+
+def read_line(var, axis, fixed, stride=1, start=0, stop=None):
+    '''
+    Returns the values of 2-D var along axis, at index fixed of the other
+    axis, from start to stop (inclusive) every stride, as floats with masked
+    values as NaN. The last point is read even if the stride skips it.
+    '''
+    if stop is None:
+        stop = var.shape[axis] - 1
+    index = [fixed, fixed]
+    index[axis] = slice(start, stop + 1, stride)
+    values = np.ma.filled(np.ma.asarray(var[tuple(index)], dtype=float), np.nan).ravel()
+    if (stop - start) % stride:
+        index[axis] = stop
+        last = np.ma.filled(np.ma.asarray(var[tuple(index)], dtype=float), np.nan).ravel()
+        values = np.concatenate((values, last))
+    return values
+
+
+def read_ring(xvar, yvar, ring=0, max_points=EDGE_POINTS):
+    '''
+    Returns the x and y arrays of the points around 2-D coordinate variables
+    ring rows and columns in from their edges, in the order paegan walks the
+    perimeter: down the first column, along the last row, up the last column
+    and back along the first row. Each edge ends where the next one starts,
+    and the last where the first started.
+    '''
+    n0, n1 = xvar.shape
+    first0, last0 = ring, n0 - 1 - ring
+    first1, last1 = ring, n1 - 1 - ring
+    if first0 > last0 or first1 > last1:
+        raise ValueError("Grid of %dx%d has no ring %d" % (n0, n1, ring))
+    s0 = edge_stride(last0 - first0 + 1, max_points)
+    s1 = edge_stride(last1 - first1 + 1, max_points)
+
+    xs, ys = [], []
+    for axis, fixed, stride, start, stop, reverse in ((0, first1, s0, first0, last0, False),
+                                                      (1, last0, s1, first1, last1, False),
+                                                      (0, last1, s0, first0, last0, True),
+                                                      (1, first0, s1, first1, last1, True)):
+        x = read_line(xvar, axis, fixed, stride, start, stop)
+        y = read_line(yvar, axis, fixed, stride, start, stop)
+        if reverse:
+            x, y = x[::-1], y[::-1]
+        # the first point of an edge is the last of the one before
+        xs.append(x[1:] if xs else x)
+        ys.append(y[1:] if ys else y)
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+def wrap_longitudes(xs):
+    '''
+    Moves longitudes given in 0 to 360 into -180 to 180, like paegan does
+    when all of a grid's longitudes are in 0 to 360
+    '''
+    valid = xs[np.isfinite(xs)]
+    if len(valid) and valid.min() >= 0 and valid.max() <= 360:
+        xs = xs.copy()
+        xs[xs > 180] -= 360
+    return xs
+
+
+def ring_polygon(xs, ys):
+    '''
+    Returns the polygon a closed ring of points bounds. A ring that crosses
+    itself is split where it does and the largest part is taken, like
+    paegan.
+    '''
+    ring = LineString(zip(xs, ys))
+    if not ring.is_closed:
+        ring = LineString(list(ring.coords) + [ring.coords[0]])
+    polygons = list(polygonize(unary_union(ring)))
+    if not polygons:
+        raise ValueError("Could not determine a polygon")
+    return max(polygons, key=lambda p: p.area)
+
+
+def curvilinear_polygon(xvar, yvar, max_points=EDGE_POINTS, max_rings=MAX_RINGS):
+    '''
+    Returns the bounding polygon of a grid with 2-D coordinate variables
+    xvar and yvar (netCDF4 variables or arrays) from reads of its edges.
+
+    If any edge coordinate is masked or NaN the perimeter has gaps, so the
+    rings further in are read, up to max_rings of them, and the convex hull
+    of all the valid points read is returned instead.
+
+    Raises ValueError if the variables aren't 2-D or no valid coordinates
+    are found.
+    '''
+    if len(xvar.shape) != 2 or xvar.shape != yvar.shape:
+        raise ValueError("Coordinates of shape %s and %s are not a curvilinear grid" %
+                         (xvar.shape, yvar.shape))
+
+    xs, ys = read_ring(xvar, yvar, 0, max_points)
+    xs = wrap_longitudes(xs)
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    if valid.all():
+        return ring_polygon(xs, ys)
+
+    points = [(xs[valid], ys[valid])]
+    for ring in xrange(1, max_rings):
+        try:
+            xs, ys = read_ring(xvar, yvar, ring, max_points)
+        except ValueError:
+            break
+        xs = wrap_longitudes(xs)
+        valid = np.isfinite(xs) & np.isfinite(ys)
+        points.append((xs[valid], ys[valid]))
+        if valid.all():
+            break
+
+    xs = np.concatenate([x for x, _ in points])
+    ys = np.concatenate([y for _, y in points])
+    if not len(xs):
+        raise ValueError("No valid coordinates on the %d outer rings of the grid" % max_rings)
+    hull = MultiPoint(zip(xs, ys)).convex_hull
+    if hull.geom_type != 'Polygon':
+        raise ValueError("Valid coordinates of the grid don't bound an area")
+    return hull
+
+
+def triangle_areas(xs, ys):
+    '''
+    Returns the areas of the triangles each interior point of a line makes
+    with its neighbours, the effective areas of Visvalingam's algorithm
+    '''
+    return 0.5 * np.abs((xs[:-2] - xs[2:]) * (ys[1:-1] - ys[:-2]) -
+                        (xs[:-2] - xs[1:-1]) * (ys[2:] - ys[:-2]))
+
+
+def visvalingam(xs, ys, max_vertices):
+    '''
+    Returns xs and ys reduced to at most max_vertices points by dropping the
+    points of smallest effective area, keeping the end points.
+
+    Points are dropped in rounds rather than one by one: each round takes the
+    points among the smallest areas that are too many and drops every other
+    one of each run of neighbours, so no point is dropped together with one
+    its area depends on.
+    '''
+    max_vertices = max(max_vertices, 2)
+    while len(xs) > max_vertices:
+        excess = len(xs) - max_vertices
+        areas = triangle_areas(xs, ys)
+        candidates = np.zeros(len(areas), dtype=bool)
+        candidates[np.argsort(areas, kind='mergesort')[:excess]] = True
+
+        # position of each candidate in its run of neighbouring candidates
+        index = np.arange(len(areas))
+        starts = candidates & ~np.concatenate(([False], candidates[:-1]))
+        run_start = np.maximum.accumulate(np.where(starts, index, 0))
+        drop = candidates & ((index - run_start) % 2 == 0)
+
+        keep = np.ones(len(xs), dtype=bool)
+        keep[1:-1] = ~drop
+        xs, ys = xs[keep], ys[keep]
+    return xs, ys
+
+
+def valid_lonlat(xs, ys):
+    '''
+    Returns a mask of the points with finite, reasonable longitudes and
+    latitudes
+    '''
+    with np.errstate(invalid='ignore'):
+        return (np.isfinite(xs) & (np.absolute(xs) <= 180) &
+                np.isfinite(ys) & (np.absolute(ys) <= 90))
+
+
+class TrajectorySimplifier(object):
+    '''
+    Simplifies a line given in chunks to at most max_vertices, dropping
+    invalid points as they come:
+
+        simplifier = TrajectorySimplifier(1000)
+        for xs, ys in chunks:
+            simplifier.add(xs, ys)
+        xs, ys = simplifier.result()
+
+    The kept vertices are simplified again whenever they reach twice
+    max_vertices, so memory holds at most that plus one chunk, however long
+    the line.
+    '''
+
+    def __init__(self, max_vertices=1000):
+        self.max_vertices = max(max_vertices, 2)
+        self.xs = np.empty(0)
+        self.ys = np.empty(0)
+        self.points = 0
+        self.invalid = 0
+
+    def add(self, xs, ys):
+        xs = np.ma.filled(np.ma.asarray(xs, dtype='float64'), np.nan).ravel()
+        ys = np.ma.filled(np.ma.asarray(ys, dtype='float64'), np.nan).ravel()
+        valid = valid_lonlat(xs, ys)
+        self.points += len(xs)
+        self.invalid += len(xs) - np.count_nonzero(valid)
+        self.xs = np.concatenate((self.xs, xs[valid]))
+        self.ys = np.concatenate((self.ys, ys[valid]))
+        if len(self.xs) >= 2 * self.max_vertices:
+            self.xs, self.ys = visvalingam(self.xs, self.ys, self.max_vertices)
+
+    def result(self):
+        '''
+        Returns the xs and ys of the simplified line
+        '''
+        return visvalingam(self.xs, self.ys, self.max_vertices)
+
+
+def read_chunks(xvar, yvar, chunk_size=100000):
+    '''
+    Yields (xs, ys) of coordinate variables chunk_size points along their
+    first dimension at a time
+    '''
+    n = xvar.shape[0]
+    for start in xrange(0, n, chunk_size):
+        yield xvar[start:start + chunk_size], yvar[start:start + chunk_size]
+
+
+def simplify_trajectory(chunks, max_vertices=1000):
+    '''
+    Returns a TrajectorySimplifier fed with every (xs, ys) of chunks
+    '''
+    simplifier = TrajectorySimplifier(max_vertices)
+    for xs, ys in chunks:
+        simplifier.add(xs, ys)
+    return simplifier
@@ -3,15 +3,41 @@
 '''
 ioos_catalog/harvesters/harvester.py
 '''
+from contextlib import contextmanager
 from datetime import datetime
 from ioos_catalog.harvesters import context_decorator
 from ioos_catalog import db
+from ioos_catalog.timeout import Deadline
+import time
 
 
 class Harvester(object):
 
-    def __init__(self, service):
+    def __init__(self, service, deadline=None):
         self.service = service
+        self.timings = {}
+        self.counters = {}
+        # every remote call caps its timeout by the time left
+        self.deadline = deadline or Deadline()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the wall time of the block to the named phase in self.timings
+        (seconds), which the Harvest records for scheduling.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.) + time.time() - start
+
+    def count(self, name, n=1):
+        """
+        Adds n to the named counter in self.counters, which the Harvest
+        records with the timings
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
 
     @context_decorator
     def save_ccheck_and_metadata(self, service_id, checker_name, ref_id, ref_type, scores, metamap):
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/harvesters/pipeline.py
+
+A staged pipeline for harvests that make many remote requests, like the
+stations of an SOS:
+
+    fetch    - a pool of threads making the remote requests
+    analyze  - a pool of processes doing the CPU bound parsing, so the GIL
+               doesn't serialize it with the fetches
+    persist  - the calling thread, writing the results in batches
+
+The stages are joined by bounded queues, so a slow stage holds back the ones
+before it instead of piling up results in memory.
+
+analyze runs in other processes, so it has to be a module level function
+taking and returning picklable values, and must not use the database.
+'''
+from collections import deque
+from multiprocessing import Pool, TimeoutError
+from Queue import Queue, Empty, Full
+from ioos_catalog import app
+from ioos_catalog.timeout import Deadline
+import threading
+import time
+
+# marks the end of a stage's output
+_DONE = object()
+
+
+def _call(func, value):
+    '''
+    Runs func(value) in a pool process. Exceptions don't always pickle, so
+    they come back as messages.
+    '''
+    try:
+        return True, func(value)
+    except Exception as e:
+        return False, '%s: %s' % (type(e).__name__, e)
+
+
+class Pipeline(object):
+    '''
+    Runs items through fetch(item) on fetch_threads threads, analyze(fetched)
+    on processes processes (in the fetch threads if processes is 0) and
+    persist(batch) on the calling thread, with batch a list of (item,
+    fetched, analyzed) of up to batch_size.
+
+    persist returns a list of (item, error message) for the items it could
+    not save, or None.
+    '''
+
+    def __init__(self, fetch, analyze, persist, fetch_threads=4, processes=2,
+                 batch_size=20, queue_size=16, deadline=None):
+        self.fetch = fetch
+        self.analyze = analyze
+        self.persist = persist
+        self.fetch_threads = max(fetch_threads, 1)
+        self.processes = processes
+        self.batch_size = max(batch_size, 1)
+        self.queue_size = max(queue_size, 1)
+        self.deadline = deadline or Deadline()
+        # seconds spent in each stage, summed over its threads or processes
+        self.timings = {'fetch': 0., 'analyze': 0., 'persist': 0.}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _add_time(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] += seconds
+
+    def _put(self, q, value):
+        # gives up once the pipeline is stopped, so no thread is left blocked
+        # on a queue nobody reads
+        while not self._stop.is_set():
+            try:
+                q.put(value, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except Empty:
+                pass
+        return _DONE
+
+    def _feed(self, items, todo):
+        for item in items:
+            if not self._put(todo, item):
+                return
+        for _ in xrange(self.fetch_threads):
+            self._put(todo, _DONE)
+
+    def _fetch_worker(self, todo, fetched):
+        inline = not self.processes
+        while True:
+            item = self._get(todo)
+            if item is _DONE:
+                self._put(fetched, _DONE)
+                return
+            start = time.time()
+            try:
+                value = self.fetch(item)
+                error = None
+            except Exception as e:
+                app.logger.warning("Fetch failed for %s", item, exc_info=True)
+                value, error = None, '%s: %s' % (type(e).__name__, e)
+            self._add_time('fetch', time.time() - start)
+
+            if inline and error is None:
+                start = time.time()
+                ok, result = _call(self.analyze, value)
+                self._add_time('analyze', time.time() - start)
+                value = (value, result) if ok else None
+                error = None if ok else result
+            if not self._put(fetched, (item, value, error)):
+                return
+
+    def _analyze_dispatcher(self, fetched, analyzed, pool):
+        '''
+        Hands fetched values to the process pool in order, with at most
+        queue_size in flight
+        '''
+        done = 0
+        in_flight = deque()
+
+        def collect():
+            item, value, pending, submitted = in_flight.popleft()
+            try:
+                # polled, so a lost task can't block the pipeline past its
+                # deadline or its stop
+                while True:
+                    if self._stop.is_set():
+                        return False
+                    self.deadline.check('Analyze')
+                    try:
+                        ok, result = pending.get(timeout=0.5)
+                        break
+                    except TimeoutError:
+                        pass
+            except Exception as e:
+                # like a result that can't be pickled back
+                app.logger.warning("Analyze failed for %s", item, exc_info=True)
+                ok, result = False, '%s: %s' % (type(e).__name__, e)
+            self._add_time('analyze', time.time() - submitted)
+            if ok:
+                return self._put(analyzed, (item, (value, result), None))
+            return self._put(analyzed, (item, None, result))
+
+        while done < self.fetch_threads:
+            entry = self._get(fetched)
+            if entry is _DONE:
+                if self._stop.is_set():
+                    return
+                done += 1
+                continue
+            item, value, error = entry
+            if pool is None or error is not None:
+                if not self._put(analyzed, entry):
+                    return
+                continue
+            in_flight.append((item, value, pool.apply_async(_call, (self.analyze, value)), time.time()))
+            if len(in_flight) >= self.queue_size and not collect():
+                return
+
+        while in_flight:
+            if not collect():
+                return
+        self._put(analyzed, _DONE)
+
+    def _flush(self, batch, errors):
+        if not batch:
+            return
+        start = time.time()
+        try:
+            failed = self.persist(list(batch)) or []
+        except Exception as e:
+            app.logger.exception("Persisting a batch of %d failed", len(batch))
+            failed = [(item, '%s: %s' % (type(e).__name__, e)) for item, _, _ in batch]
+        self._add_time('persist', time.time() - start)
+        errors.extend(failed)
+        del batch[:]
+
+    def run(self, items):
+        '''
+        Runs items through the pipeline. Returns a list of (item, error
+        message) for every item that failed in any stage.
+
+        Raises DeadlineExceeded, after stopping the stages, if the deadline
+        passes first.
+        '''
+        todo = Queue(self.queue_size)
+        fetched = Queue(self.queue_size)
+        analyzed = Queue(self.queue_size)
+        pool = Pool(self.processes) if self.processes else None
+
+        threads = [threading.Thread(target=self._feed, args=(items, todo))]
+        threads += [threading.Thread(target=self._fetch_worker, args=(todo, fetched))
+                    for _ in xrange(self.fetch_threads)]
+        threads.append(threading.Thread(target=self._analyze_dispatcher, args=(fetched, analyzed, pool)))
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        errors = []
+        batch = []
+        try:
+            while True:
+                self.deadline.check()
+                try:
+                    entry = analyzed.get(timeout=1)
+                except Empty:
+                    continue
+                if entry is _DONE:
+                    break
+                item, value, error = entry
+                if error is not None:
+                    errors.append((item, error))
+                    continue
+                fetched_value, result = value
+                batch.append((item, fetched_value, result))
+                if len(batch) >= self.batch_size:
+                    self._flush(batch, errors)
+            self._flush(batch, errors)
+        finally:
+            self._stop.set()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return errors
@@ -7,7 +7,9 @@ Harvester for SOS
 '''
 from ioos_catalog.harvesters.harvester import Harvester
 from ioos_catalog.harvesters import unicode_or_none, get_common_name
-from ioos_catalog import app, db
+from ioos_catalog import app, db, http_client
+from ioos_catalog.harvesters.pipeline import Pipeline
+from ioos_catalog.timeout import DeadlineExceeded
 
 from compliance_checker.runner import ComplianceCheckerCheckSuite
 from compliance_checker.ioos import IOOSSOSGCCheck, IOOSSOSDSCheck
@@ -29,6 +31,8 @@ from petulantbear import netcdf2ncml
 from urllib import urlencode
 import geojson
 import json
+import threading
+import urlparse
 
 
 IOOS_SENSORML = 'text/xml;subtype="sensorML/1.0.1/profiles/ioos_sos/1.0"'
@@ -56,28 +60,193 @@ class SosFormatError(SosHarvestError):
     pass
 
 
+GML_NS = "http://www.opengis.net/gml"
+
+
+def metamap_sensor_ml(root):
+    """
+    Returns the metamap of a station's SensorML document
+    """
+    # gets a metamap document of this service using wicken
+    beliefs = IOOSSOSDSCheck.beliefs()
+    doc = MultipleXmlDogma(
+        'sos-ds', beliefs, root, namespaces=get_namespaces())
+
+    # now make a map out of this
+    # @TODO wicken should make this easier
+    metamap = {}
+    for k in beliefs:
+        try:
+            metamap[k] = plain_value(getattr(doc, doc._fixup_belief(k)[0]))
+        except:
+            pass
+
+    return metamap
+
+
+def plain_value(value):
+    """
+    Returns a metamap value as unicode, or a list of them. wicken can return
+    lxml smart strings, which keep a reference to their element and can't
+    be pickled back from the analyze processes.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [plain_value(v) for v in value]
+    return unicode_or_none(value)
+
+
+def analyze_station(desc_sens):
+    """
+    Parses a station's DescribeSensor response into a dict of the fields
+    its dataset is built from, plus its metamap. Returns None if there is no
+    response.
+
+    This is the CPU bound stage of the station pipeline and runs in a pool
+    process, so it only takes and returns plain values.
+    """
+    if desc_sens is None:
+        return None
+    metadata_value = etree.fromstring(desc_sens)
+    sensor_ml = SensorML(metadata_value)
+    try:
+        station_ds = IoosDescribeSensor(metadata_value)
+    # if this doesn't conform to IOOS SensorML sub, fall back to
+    # manually picking apart the SensorML
+    except ows.ExceptionReport:
+        station_ds = netcdf2ncml.process_sensorml(sensor_ml.members[0])
+
+    result = {'id': unicode_or_none(station_ds.id)}
+    if result['id'] is None:
+        return result
+
+    # Parsing messages
+    messages = []
+
+    # NAME
+    name = unicode_or_none(station_ds.shortName)
+    if name is None:
+        messages.append(
+            u"Could not get a 'shortName' from the SensorML "
+            u"identifiers.  Looking for a definition of "
+            u"'http://mmisw.org/ont/ioos/definition/shortName'")
+
+    # DESCRIPTION
+    description = unicode_or_none(station_ds.longName)
+    if description is None:
+        messages.append(
+            u"Could not get a 'longName' from the SensorML "
+            u"identifiers.  Looking for a definition of "
+            u"'http://mmisw.org/ont/ioos/definition/longName'")
+
+    # PLATFORM TYPE
+    asset_type = unicode_or_none(getattr(station_ds,
+                                         'platformType', None))
+    if asset_type is None:
+        messages.append(
+            u"Could not get a 'platformType' from the SensorML "
+            u"identifiers.  Looking for a definition of "
+            u"'http://mmisw.org/ont/ioos/definition/platformType'")
+
+    # LOCATION is in GML
+    gj = None
+    loc = station_ds.location
+    if loc is not None and loc.tag == "{%s}Point" % GML_NS:
+        pos_element = loc.find("{%s}pos" % GML_NS)
+        # some older responses may uses the deprecated coordinates
+        # element
+        if pos_element is None:
+            # if pos not found use deprecated coordinates element
+            pos_element = loc.find("{%s}coordinates" % GML_NS)
+        # strip out points
+        positions = map(float, pos_element.text.split(" "))
+
+        for el in [pos_element, loc]:
+            srs_name = testXMLAttribute(el, "srsName")
+            if srs_name:
+                crs = Crs(srs_name)
+                if crs.axisorder == "yx":
+                    gj = json.loads(geojson.dumps(
+                        geojson.Point([positions[1], positions[0]])))
+                else:
+                    gj = json.loads(geojson.dumps(
+                        geojson.Point([positions[0], positions[1]])))
+                break
+        else:
+            if positions:
+                messages.append(
+                    u"Position(s) found but could not parse SRS: %s, %s" % (positions, srs_name))
+
+    else:
+        messages.append(
+            u"Found an unrecognized child of the sml:location element and did not attempt to process it: %s" % loc)
+
+    meta_str = unicode(etree.tostring(metadata_value)).strip()
+    if len(meta_str) > 4000000:
+        messages.append(
+            u'Metadata document was too large to store (len: %s)' % len(meta_str))
+
+    result.update({'name': name,
+                   'description': description,
+                   'asset_type': asset_type,
+                   'geojson': gj,
+                   'messages': messages,
+                   'keywords': list(station_ds.keywords),
+                   'variables': list(station_ds.variables),
+                   'metamap': metamap_sensor_ml(sensor_ml._root)})
+    return result
+
+
 class SosHarvester(Harvester):
 
-    def __init__(self, service):
-        Harvester.__init__(self, service)
+    # longest the GetCapabilities request may take, the deadline permitting
+    CAPABILITIES_TIMEOUT = 300
+
+    def __init__(self, service, deadline=None):
+        Harvester.__init__(self, service, deadline)
         self.output_format = IOOS_SENSORML
+        self.output_format_lock = threading.Lock()
+
+    def get_capabilities(self):
+        '''
+        Returns the owslib SensorObservationService of the service, from a
+        GetCapabilities request made with a timeout, which owslib doesn't
+        take. The request is the one owslib would make.
+        '''
+        url = self.service.get('url')
+        base, _, query = url.partition('?')
+        qs = urlparse.parse_qsl(query)
+        params = [k for k, _ in qs]
+        for k, v in (('service', 'SOS'), ('request', 'GetCapabilities'), ('acceptVersions', '1.0.0')):
+            if k not in params:
+                qs.append((k, v))
+        timeout = (http_client.default_timeout()[0], self.CAPABILITIES_TIMEOUT)
+        response = http_client.get(base + '?' + urlencode(qs), timeout=timeout, deadline=self.deadline)
+        response.raise_for_status()
+        return SensorObservationService(url, xml=response.content)
 
     def _handle_ows_exception(self, **kwargs):
-        # Put the current output format first, this will prevent us from trying
-        # subsequent calls with different formats.
+        # Put the last format that worked first, this will prevent us from trying
+        # subsequent calls with different formats. The stations are described
+        # on several threads, so the one being tried is kept local and the
+        # format is only recorded once the server accepts it.
+        current = self.output_format
         formats = [IOOS_SENSORML, IOOS_SWE, SENSORML]
-        formats.pop(formats.index(self.output_format))
-        formats.insert(0, self.output_format)
+        formats.pop(formats.index(current))
+        formats.insert(0, current)
         for output_format in formats:
             try:
-                self.output_format = output_format
                 kwargs['outputFormat'] = output_format
-                return self.sos.describe_sensor(**kwargs)
+                response = self.sos.describe_sensor(**kwargs)
             except ows.ExceptionReport as e:
                 if e.code == 'InvalidParameterValue':
                     continue
-                e.msg = e.msg + '\n' + self.format_url(kwargs['procedure'])
+                e.msg = e.msg + '\n' + self.format_url(kwargs['procedure'], output_format)
                 raise e
+            with self.output_format_lock:
+                self.output_format = output_format
+            return response
         else:
 
             raise SosFormatError('No valid outputFormat found for DescribeSensor\n' +
@@ -89,7 +258,7 @@ class SosHarvester(Harvester):
         """
         kwargs = {
             'procedure': uid,
-            'timeout': timeout
+            'timeout': self.deadline.timeout(timeout)
         }
 
         return self._handle_ows_exception(**kwargs)
@@ -150,8 +319,9 @@ class SosHarvester(Harvester):
         metadata.save()
         return metadata
 
-    def update_dataset_metadata(self, dataset_id, sensor_ml, describe_sensor_url=None):
-        metamap = self.metamap_station(sensor_ml)
+    def update_dataset_metadata(self, dataset_id, sensor_ml, describe_sensor_url=None, metamap=None):
+        if metamap is None:
+            metamap = self.metamap_station(sensor_ml)
         if describe_sensor_url:
             metamap['Describe Sensor URL'] = describe_sensor_url
         metadata = db.Metadata.find_one({"ref_id": dataset_id})
@@ -185,15 +355,25 @@ class SosHarvester(Harvester):
         metadata.save()
         return metadata
 
-    def harvest(self):
-        self.sos = SensorObservationService(self.service.get('url'))
+    def harvest(self, start=0, stop=None):
+        """
+        Harvests the stations of the offerings[start:stop], so a large SOS
+        can be harvested in batches. The service metadata is updated with
+        the first batch. self.offering_count is set to the total number of
+        offerings.
+        """
+        with self.phase('capabilities'):
+            self.sos = self.get_capabilities()
+            self.offering_count = len(self.sos.offerings)
 
-        self.update_service_metadata()
+            if start == 0:
+                self.update_service_metadata()
 
         # List storing the stations that have already been processed in this SOS server.
         # This is kept and checked later to avoid servers that have the same
         # stations in many offerings.
         processed = []
+        stations = []
 
         exception = None
 
@@ -203,7 +383,8 @@ class SosHarvester(Harvester):
 
         # allow searching child offerings for by name for network offerings
         name_lookup = {o.name: o for o in self.sos.offerings}
-        for offering in self.sos.offerings:
+        for offering in self.sos.offerings[start:stop]:
+            self.deadline.check()
             # TODO: We assume an offering should only have one procedure here
             # which will be the case in sos 2.0, but may not be the case right now
             # on some non IOOS supported servers.
@@ -216,16 +397,20 @@ class SosHarvester(Harvester):
                 if uid[-3:].lower() == 'all':
                     continue  # Skip the all
                 try:
-                    net = self._describe_sensor(uid, timeout=net_timeout)
+                    with self.phase('networks'):
+                        net = self._describe_sensor(uid, timeout=net_timeout)
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
                     message = '\n'.join(['DescribeSensor failed for {}'.format(uid), e.message])
                     if exception is None:
                         exception = DescribeSensorError(message)
                     else:
                         exception.append(message)
+                    continue
 
                 network_ds = IoosDescribeSensor(net)
-                # Iterate over stations in the network and process them
+                # Collect the stations in the network to process them
                 # individually
 
                 for proc in network_ds.procedures:
@@ -233,179 +418,155 @@ class SosHarvester(Harvester):
                     if proc is not None and proc.split(":")[2] == "station":
                         if proc not in processed:
                             # offering associated with this procedure
-                            proc_off = name_lookup.get(proc)
-                            self.process_station(proc, proc_off)
+                            stations.append((proc, name_lookup.get(proc)))
                         processed.append(proc)
             else:
                 # Station Offering, or malformed urn - try it anyway as if it
                 # is a station
                 if uid not in processed:
-                    try:
-                        self.process_station(uid, offering)
-                    except SosHarvestError as e:
-                        message = '\n'.join(['DescribeSensor failed for {}'.format(uid), e.message])
-                        if exception is None:
-                            exception = e
-                        exception.append(message)
-                    except Exception as e:
-                        message = '\n'.join(['DescribeSensor failed for {}'.format(uid), e.message])
-                        if exception is None:
-                            exception = DescribeSensorError(message)
-                        else:
-                            exception.append(message)
-
+                    stations.append((uid, offering))
                 processed.append(uid)
 
-            if exception is not None:
-                raise exception
-
-    def process_station(self, uid, offering):
-        """ Makes a DescribeSensor request based on a 'uid' parameter being a
-            station procedure.  Also pass along an offering with
-            getCapabilities information for items such as temporal extent"""
-
-        GML_NS = "http://www.opengis.net/gml"
+        with self.phase('stations'):
+            errors = self.harvest_stations(stations)
+        for (uid, offering), error in errors:
+            message = '\n'.join(['DescribeSensor failed for {}'.format(uid), error])
+            if exception is None:
+                exception = DescribeSensorError(message)
+            else:
+                exception.append(message)
 
-        with app.app_context():
+        if exception is not None:
+            raise exception
 
-            desc_sens = self._describe_sensor(uid, timeout=1200)
-            # FIXME: add some kind of notice saying the station failed
-            if desc_sens is None:
-                app.logger.warn(
-                    "Could not get a valid describeSensor response")
-                return
-            metadata_value = etree.fromstring(desc_sens)
-            sensor_ml = SensorML(metadata_value)
-            try:
-                station_ds = IoosDescribeSensor(metadata_value)
-            # if this doesn't conform to IOOS SensorML sub, fall back to
-            # manually picking apart the SensorML
-            except ows.ExceptionReport:
-                station_ds = netcdf2ncml.process_sensorml(sensor_ml.members[0])
-
-            unique_id = station_ds.id
-            if unique_id is None:
-                app.logger.warn(
-                    "Could not get a 'stationID' from the SensorML "
-                    "identifiers.  Looking for a definition of "
-                    "'http://mmisw.org/ont/ioos/definition/stationID'")
-                return
-
-            dataset = db.Dataset.find_one({'uid': unicode(unique_id)})
-            if dataset is None:
-                dataset = db.Dataset()
-                dataset.uid = unicode(unique_id)
-                dataset['active'] = True
-
-            # Find service reference in Dataset.services and remove (to replace
-            # it)
-            dataset_services = dataset.services[:]
-            for service in dataset_services:
-                if service['url'] == self.service.get('url'):
-                    dataset.services.remove(service)
-
-            # Parsing messages
-            messages = []
-
-            # NAME
-            name = unicode_or_none(station_ds.shortName)
-            if name is None:
-                messages.append(
-                    u"Could not get a 'shortName' from the SensorML "
-                    u"identifiers.  Looking for a definition of "
-                    u"'http://mmisw.org/ont/ioos/definition/shortName'")
+    def harvest_stations(self, stations):
+        """
+        Harvests stations, a list of (uid, offering), through a pipeline (see
+        pipeline.py): the DescribeSensor requests are made on
+        HARVEST_FETCH_THREADS threads, the SensorML is parsed and metamapped
+        on HARVEST_ANALYZE_PROCESSES processes and the datasets are saved in
+        batches of HARVEST_PERSIST_BATCH.
+
+        Returns a list of ((uid, offering), error message) for the stations
+        that failed.
+        """
+        if not stations:
+            return []
+        pipeline = Pipeline(self.fetch_station, analyze_station, self.persist_stations,
+                            fetch_threads=app.config.get('HARVEST_FETCH_THREADS', 4),
+                            processes=app.config.get('HARVEST_ANALYZE_PROCESSES', 2),
+                            batch_size=app.config.get('HARVEST_PERSIST_BATCH', 20),
+                            queue_size=app.config.get('HARVEST_PIPELINE_QUEUE', 16),
+                            deadline=self.deadline)
+        try:
+            return pipeline.run(stations)
+        finally:
+            for stage, seconds in pipeline.timings.iteritems():
+                self.timings['station_' + stage] = self.timings.get('station_' + stage, 0.) + seconds
 
-            # DESCRIPTION
-            description = unicode_or_none(station_ds.longName)
-            if description is None:
-                messages.append(
-                    u"Could not get a 'longName' from the SensorML "
-                    u"identifiers.  Looking for a definition of "
-                    u"'http://mmisw.org/ont/ioos/definition/longName'")
-
-            # PLATFORM TYPE
-            asset_type = unicode_or_none(getattr(station_ds,
-                                                 'platformType', None))
-            if asset_type is None:
-                messages.append(
-                    u"Could not get a 'platformType' from the SensorML "
-                    u"identifiers.  Looking for a definition of "
-                    u"'http://mmisw.org/ont/ioos/definition/platformType'")
-
-            # LOCATION is in GML
-            gj = None
-            loc = station_ds.location
-            if loc is not None and loc.tag == "{%s}Point" % GML_NS:
-                pos_element = loc.find("{%s}pos" % GML_NS)
-                # some older responses may uses the deprecated coordinates
-                # element
-                if pos_element is None:
-                    # if pos not found use deprecated coordinates element
-                    pos_element = loc.find("{%s}coordinates" % GML_NS)
-                # strip out points
-                positions = map(float, pos_element.text.split(" "))
-
-                for el in [pos_element, loc]:
-                    srs_name = testXMLAttribute(el, "srsName")
-                    if srs_name:
-                        crs = Crs(srs_name)
-                        if crs.axisorder == "yx":
-                            gj = json.loads(geojson.dumps(
-                                geojson.Point([positions[1], positions[0]])))
-                        else:
-                            gj = json.loads(geojson.dumps(
-                                geojson.Point([positions[0], positions[1]])))
-                        break
-                else:
-                    if positions:
-                        messages.append(
-                            u"Position(s) found but could not parse SRS: %s, %s" % (positions, srs_name))
+    def fetch_station(self, station):
+        """
+        Returns the DescribeSensor response of a station, a (uid, offering)
+        """
+        uid, offering = station
+        return self._describe_sensor(uid, timeout=1200)
 
-            else:
-                messages.append(
-                    u"Found an unrecognized child of the sml:location element and did not attempt to process it: %s" % loc)
+    def persist_stations(self, batch):
+        """
+        Saves a batch of analyzed stations, a list of ((uid, offering),
+        DescribeSensor response, analyze_station result), reading their
+        datasets with one query. Returns a list of ((uid, offering), error
+        message) for the stations that could not be saved.
+        """
+        failed = []
+        with app.app_context():
+            station_ids = [unicode(result['id']) for _, _, result in batch if result and result['id']]
+            datasets = {d.uid: d for d in db.Dataset.find({'uid': {'$in': station_ids}})}
+
+            for station, desc_sens, result in batch:
+                uid, offering = station
+                # FIXME: add some kind of notice saying the station failed
+                if result is None:
+                    app.logger.warn(
+                        "Could not get a valid describeSensor response")
+                    continue
+                if result['id'] is None:
+                    app.logger.warn(
+                        "Could not get a 'stationID' from the SensorML "
+                        "identifiers.  Looking for a definition of "
+                        "'http://mmisw.org/ont/ioos/definition/stationID'")
+                    continue
+                try:
+                    dataset = self.save_station(datasets.get(unicode(result['id'])), offering, result)
+                except Exception as e:
+                    app.logger.exception("Could not save station %s", uid)
+                    failed.append((station, '%s: %s' % (type(e).__name__, e)))
+                    continue
 
-            meta_str = unicode(etree.tostring(metadata_value)).strip()
-            if len(meta_str) > 4000000:
-                messages.append(
-                    u'Metadata document was too large to store (len: %s)' % len(meta_str))
-                meta_str = u''
-
-            service = {
-                # Reset service
-                'name': name,
-                'description': description,
-                'service_type': self.service.get('service_type'),
-                'service_id': ObjectId(self.service.get('_id')),
-                'data_provider': self.service.get('data_provider'),
-                'url': self.service.url,
-                'metadata_type': u'sensorml',
-                'metadata_value': u'',
-                'time_min': getattr(offering, 'begin_position', None),
-                'time_max': getattr(offering, 'end_position', None),
-                'messages': map(unicode, messages),
-                'keywords': map(unicode, sorted(station_ds.keywords)),
-                'variables': map(unicode, sorted(station_ds.variables)),
-                'asset_type': get_common_name(asset_type),
-                'geojson': gj,
-                'updated': datetime.utcnow()
-            }
-            dataset.service_url = self.service.url
+                # do compliance checker / metadata now
 
-            dataset.services.append(service)
-            dataset.updated = datetime.utcnow()
-            dataset.save()
+                try:
+                    describe_sensor_url = self.format_url(uid)
+                    self.update_dataset_metadata(dataset._id, None, describe_sensor_url,
+                                                 metamap=result['metamap'])
+                except Exception as e:
+                    app.logger.warn(
+                        "could not save compliancecheck/metamap information: %s", e)
+        return failed
 
-            # do compliance checker / metadata now
+    def save_station(self, dataset, offering, result):
+        """
+        Replaces this service's entry in a station's dataset with the
+        analyzed station, creating the dataset if it is None
+        """
+        if dataset is None:
+            dataset = db.Dataset()
+            dataset.uid = unicode(result['id'])
+            dataset['active'] = True
+
+        # Find service reference in Dataset.services and remove (to replace
+        # it)
+        dataset_services = dataset.services[:]
+        for service in dataset_services:
+            if service['url'] == self.service.get('url'):
+                dataset.services.remove(service)
+
+        service = {
+            # Reset service
+            'name': result['name'],
+            'description': result['description'],
+            'service_type': self.service.get('service_type'),
+            'service_id': ObjectId(self.service.get('_id')),
+            'data_provider': self.service.get('data_provider'),
+            'url': self.service.url,
+            'metadata_type': u'sensorml',
+            'metadata_value': u'',
+            'time_min': getattr(offering, 'begin_position', None),
+            'time_max': getattr(offering, 'end_position', None),
+            'messages': map(unicode, result['messages']),
+            'keywords': map(unicode, sorted(result['keywords'])),
+            'variables': map(unicode, sorted(result['variables'])),
+            'asset_type': get_common_name(result['asset_type']),
+            'geojson': result['geojson'],
+            'updated': datetime.utcnow()
+        }
+        dataset.service_url = self.service.url
 
-            try:
-                describe_sensor_url = self.format_url(uid)
-                self.update_dataset_metadata(dataset._id, sensor_ml, describe_sensor_url)
-            except Exception as e:
-                app.logger.warn(
-                    "could not save compliancecheck/metamap information: %s", e)
+        dataset.services.append(service)
+        dataset.updated = datetime.utcnow()
+        dataset.save()
+        return dataset
 
-            return "Harvest Successful"
+    def process_station(self, uid, offering):
+        """ Makes a DescribeSensor request based on a 'uid' parameter being a
+            station procedure.  Also pass along an offering with
+            getCapabilities information for items such as temporal extent"""
+        station = (uid, offering)
+        desc_sens = self.fetch_station(station)
+        failed = self.persist_stations([(station, desc_sens, analyze_station(desc_sens))])
+        if failed:
+            raise SosHarvestError(failed[0][1])
+        return "Harvest Successful"
 
     def ccheck_service(self):
         assert self.sos
@@ -470,21 +631,7 @@ class SosHarvester(Harvester):
 
     def metamap_station(self, sensor_ml):
         with app.app_context():
-            # gets a metamap document of this service using wicken
-            beliefs = IOOSSOSDSCheck.beliefs()
-            doc = MultipleXmlDogma(
-                'sos-ds', beliefs, sensor_ml._root, namespaces=get_namespaces())
-
-            # now make a map out of this
-            # @TODO wicken should make this easier
-            metamap = {}
-            for k in beliefs:
-                try:
-                    metamap[k] = getattr(doc, doc._fixup_belief(k)[0])
-                except:
-                    pass
-
-            return metamap
+            return metamap_sensor_ml(sensor_ml._root)
 
     def save_ccheck_station(self, checker_name, dataset_id, scores, metamap):
         """
@@ -10,8 +10,8 @@ from ioos_catalog.harvesters.harvester import Harvester
 
 class WcsHarvester(Harvester):
 
-    def __init__(self, service):
-        Harvester.__init__(self, service)
+    def __init__(self, service, deadline=None):
+        Harvester.__init__(self, service, deadline)
 
     def harvest(self):
         pass
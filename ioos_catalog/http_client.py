@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/http_client.py
+
+Process-wide HTTP client. Every outbound request made by the pings, the
+harvesters and the reindexer goes through one requests Session so that
+connections to the same host are kept alive and reused.
+
+The connections record how long DNS resolution, the TCP connect and the TLS
+handshake took, which timed_get reports along with time to first byte and
+total transfer time.
+'''
+from ioos_catalog import app, __version__
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import requests
+import socket
+import threading
+import time
+import os
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+# Phase timings of the request in progress on this thread, if it is timed
+_local = threading.local()
+
+
+def _current_timings():
+    return getattr(_local, 'timings', None)
+
+
+class TimedConnectionMixin(object):
+    '''
+    Records DNS, connect and TLS times of new connections into the timings of
+    the request in progress on this thread. Reused keep-alive connections
+    don't connect, so their phases stay at zero.
+    '''
+
+    def _new_conn(self):
+        timings = _current_timings()
+        if timings is None:
+            return super(TimedConnectionMixin, self)._new_conn()
+
+        # Resolve the host ourselves so resolution and connect can be timed
+        # separately, then connect to each address in turn like
+        # socket.create_connection does.
+        host_attr = '_dns_host' if hasattr(self, '_dns_host') else 'host'
+        host = getattr(self, host_attr)
+        start = time.time()
+        addresses = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        timings['dns'] = (resolved - start) * 1000.
+
+        try:
+            error = None
+            for address in addresses:
+                setattr(self, host_attr, address[4][0])
+                try:
+                    conn = super(TimedConnectionMixin, self)._new_conn()
+                    break
+                except socket.error as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            setattr(self, host_attr, host)
+
+        timings['connect'] = (time.time() - resolved) * 1000.
+        return conn
+
+    def connect(self):
+        timings = _current_timings()
+        start = time.time()
+        super(TimedConnectionMixin, self).connect()
+        if timings is not None and isinstance(self, HTTPSConnection):
+            elapsed = (time.time() - start) * 1000.
+            timings['tls'] = max(elapsed - timings['dns'] - timings['connect'], 0.)
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter whose per-host pools hand out timed connections
+    '''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+def new_session():
+    '''
+    Returns a new requests Session with per-host connection pools sized from
+    the app config
+    '''
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=app.config.get('HTTP_POOL_CONNECTIONS', 100),
+                               pool_maxsize=app.config.get('HTTP_POOL_MAXSIZE', 10),
+                               max_retries=app.config.get('HTTP_MAX_RETRIES', 0))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'ioos-service-monitor/%s' % __version__
+    return session
+
+
+def get_session():
+    '''
+    Returns the session for this process, creating it if necessary.
+
+    RQ forks a work horse for every job, and sockets must never be shared
+    across a fork, so a new session is made whenever the pid changes.
+    '''
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = new_session()
+                _session_pid = pid
+    return _session
+
+
+def default_timeout():
+    '''
+    Returns the default (connect, read) timeout tuple
+    '''
+    return (app.config.get('HTTP_CONNECT_TIMEOUT', 10),
+            app.config.get('HTTP_READ_TIMEOUT', 60))
+
+
+def deadline_timeout(deadline, timeout=None):
+    '''
+    Returns the (connect, read) timeout tuple capped by the time left before
+    deadline (see timeout.Deadline), raising DeadlineExceeded if none is left
+    '''
+    if timeout is None:
+        timeout = default_timeout()
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    return tuple(deadline.timeout(t) for t in timeout)
+
+
+def get(url, timeout=None, deadline=None, **kwargs):
+    '''
+    Issues a GET through the shared session. Takes the same keyword arguments
+    as requests.get, and a deadline that caps the timeout.
+    '''
+    if deadline is not None:
+        timeout = deadline_timeout(deadline, timeout)
+    elif timeout is None:
+        timeout = default_timeout()
+    return get_session().get(url, timeout=timeout, **kwargs)
+
+
+def timed_get(url, timeout=None, max_bytes=None, deadline=None, **kwargs):
+    '''
+    Issues a GET through the shared session, reads the body and returns a
+    (response, timings) tuple.
+
+    If max_bytes is set, at most that many bytes of the body are read before
+    the connection is closed, and the response content is not available.
+
+    timings is a dict of
+
+        dns      - DNS resolution (ms)
+        connect  - TCP connect (ms)
+        tls      - TLS handshake (ms)
+        ttfb     - time until the response headers arrived (ms)
+        total    - time until the body was fully received (ms)
+        bytes    - bytes of body received
+
+    dns, connect and tls are 0 when a keep-alive connection was reused.
+    '''
+    timings = {'dns': 0., 'connect': 0., 'tls': 0., 'ttfb': 0., 'total': 0., 'bytes': 0}
+    _local.timings = timings
+    start = time.time()
+    try:
+        response = get(url, timeout=timeout, deadline=deadline, stream=True, **kwargs)
+        timings['ttfb'] = (time.time() - start) * 1000.
+        if max_bytes is None:
+            body = response.content
+            timings['total'] = (time.time() - start) * 1000.
+            try:
+                timings['bytes'] = response.raw.tell()
+            except AttributeError:
+                timings['bytes'] = len(body)
+        else:
+            received = 0
+            for chunk in response.iter_content(chunk_size=min(max_bytes, 8192)):
+                received += len(chunk)
+                if received >= max_bytes:
+                    break
+            timings['total'] = (time.time() - start) * 1000.
+            timings['bytes'] = received
+            # Hang up rather than drain the rest of the body. A body that fit
+            # under the cap was read to the end, so its connection goes back
+            # to the pool.
+            response.close()
+    finally:
+        _local.timings = None
+    return response, timings
+
+
+def pool_stats():
+    '''
+    Returns connection reuse counters for the live per-host pools of this
+    process, as a dict of
+
+        {'scheme://host:port': {'connections': x, 'requests': y, 'reused': y - x}}
+
+    plus a '_total' entry summing all hosts.
+    '''
+    stats = {}
+    total = {'connections': 0, 'requests': 0, 'reused': 0}
+    session = get_session()
+    seen = set()
+    for adapter in session.adapters.itervalues():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            name = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+            counters = {'connections': pool.num_connections,
+                        'requests': pool.num_requests,
+                        'reused': max(pool.num_requests - pool.num_connections, 0)}
+            stats[name] = counters
+            for k, v in counters.iteritems():
+                total[k] += v
+    stats['_total'] = total
+    return stats
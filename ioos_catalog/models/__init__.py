@@ -1,3 +1,3 @@
 from ioos_catalog.models import (service, stat, dataset, metric_counts,
-                                 ping_latest, ping_archive, metadata,
+                                 ping_latest, ping_archive, ping_rollup, metadata,
                                  migrations, harvests)
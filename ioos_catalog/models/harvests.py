@@ -6,20 +6,24 @@ ioos_catalog/models/harvests.py
 Mongo definition for Harvest
 '''
 from bson import ObjectId
-from ioos_catalog import app, db
+from ioos_catalog import app, db, http_client
 from ioos_catalog.models.base_document import BaseDocument
 from ioos_catalog.harvesters.dap_harvester import DapHarvester, DapUnicodeError
 from ioos_catalog.harvesters.sos_harvester import SosHarvester, DescribeSensorError, SosFormatError
 from ioos_catalog.harvesters.wms_harvester import WmsHarvester
 from ioos_catalog.harvesters.wcs_harvester import WcsHarvester
-from ioos_catalog.timeout import Timeout, TimeoutError
+from ioos_catalog.harvesters.fingerprint import fetch_fingerprint, same_fingerprint
+from ioos_catalog.timeout import Deadline, TimeoutError
 from lxml.etree import XMLSyntaxError
-from datetime import datetime
+from datetime import datetime, timedelta
 from traceback import format_exc
 from owslib import ows
+from rq.timeouts import JobTimeoutException
 
+import numpy as np
 import requests
 import socket
+import time
 
 
 class HarvestStatus(object):
@@ -28,6 +32,8 @@ class HarvestStatus(object):
     PARTIAL_SUCCESS = 2
     SERVICE_UNAVAILABLE = 3
     TIMEOUT = 4
+    IN_PROGRESS = 5
+    NOT_MODIFIED = 6
 
 
 @db.register
@@ -36,6 +42,7 @@ class Harvest(BaseDocument):
     Model for a harvest and the reporting of a harvest's status
     '''
     MAX_MESSAGES = 20
+    MAX_TIMINGS = 30
 
     __collection__ = 'harvests'
     use_dot_notation = True
@@ -50,11 +57,211 @@ class Harvest(BaseDocument):
             'date': datetime,
             'successful': bool,
             'message': unicode
-        }]
+        }],
+        # wall times of the harvests that got past the ping, newest first
+        'harvest_timings': [{
+            'date': datetime,
+            'total': float,       # seconds
+            'phases': dict,       # phase name -> seconds
+            'counters': dict,     # counter name -> count, like remote_opens
+            'completed': bool     # False if the harvest was killed or raised
+        }],
+        # progress of a harvest done in batches, None when there is none in
+        # progress (see harvest_batch)
+        'checkpoint': {
+            'next_offering': int,     # first offering of the next batch
+            'total': int,             # number of offerings in the service
+            'batch_size': int,
+            'errors': [unicode],      # failures of the completed batches
+            'started': datetime,
+            'updated': datetime
+        },
+        # the documents the last successful harvest was built from (see
+        # harvesters/fingerprint.py)
+        'fingerprint': [{
+            'url': unicode,
+            'etag': unicode,
+            'last_modified': unicode,
+            'sha1': unicode
+        }],
+        'not_modified_count': int,    # harvests skipped because nothing changed
+        'skipped_seconds': float      # harvest time those skips saved, estimated
 
     }
 
-    def harvest(self, ignore_active=False):
+    def copy_to(self, service_ids):
+        """
+        Copies the outcome of this harvest onto the harvests of other
+        services, creating them as needed, with one bulk of upserts
+        """
+        service_ids = [sid for sid in service_ids if sid != self.service_id]
+        if not service_ids:
+            return
+        outcome = {'harvest_date': self.harvest_date,
+                   'harvest_status': self.harvest_status,
+                   'harvest_successful': self.harvest_successful,
+                   'harvest_messages': self.harvest_messages}
+        bulk = db[self.__collection__].initialize_unordered_bulk_op()
+        for sid in service_ids:
+            bulk.find({'service_id': sid}).upsert().update_one({'$set': outcome})
+        bulk.execute()
+
+    def harvest(self, ignore_active=False, batch_size=None, force=False, deadline=None):
+        """
+        Harvests the service and records how long each phase took.
+
+        If batch_size is set, an SOS is harvested batch_size offerings at a
+        time, resuming from the checkpoint of the previous batch (see
+        harvest_batch).
+
+        The harvest is skipped if the service's fingerprint is the same as at
+        the last successful harvest, unless force is set.
+
+        Every remote call the harvest makes is bounded by deadline (see
+        timeout.Deadline).
+        """
+        phases = {}
+        counters = {}
+        start = time.time()
+        completed = False
+        try:
+            self._harvest(ignore_active, phases, batch_size, force, deadline or Deadline(), counters)
+            completed = True
+        except JobTimeoutException:
+            self.new_message("Harvest killed after %ds by the job timeout" % (time.time() - start), False)
+            self.set_status("Timed Out")
+            self.harvest_successful = HarvestStatus.TIMEOUT
+            raise
+        finally:
+            if 'harvest' in phases:
+                self.record_timing(time.time() - start, phases, completed, counters)
+
+    def record_timing(self, total, phases, completed=True, counters=None):
+        if self.get('harvest_timings') is None:
+            self.harvest_timings = []
+
+        while len(self.harvest_timings) > (self.MAX_TIMINGS - 1):
+            self.harvest_timings.pop()
+
+        self.harvest_timings.insert(0, {'date': datetime.utcnow(),
+                                        'total': float(total),
+                                        'phases': {unicode(k): float(v) for k, v in phases.iteritems()},
+                                        'counters': {unicode(k): int(v) for k, v in (counters or {}).iteritems()},
+                                        'completed': completed})
+
+    @classmethod
+    def get_timing_history(cls, service_ids=None):
+        """
+        Returns a dict of service_id -> list of harvest timings, newest first
+        """
+        query = {'harvest_timings.0': {'$exists': True}}
+        if service_ids is not None:
+            query['service_id'] = {'$in': list(service_ids)}
+        return {h['service_id']: h['harvest_timings']
+                for h in db[cls.__collection__].find(query, {'service_id': 1,
+                                                             'harvest_timings': 1})}
+
+    def record_skip(self):
+        """
+        Counts a harvest skipped as not modified, and the time it saved,
+        estimated as the median of the completed harvests
+        """
+        totals = [t['total'] for t in self.get('harvest_timings') or [] if t.get('completed', True)]
+        self.not_modified_count = (self.get('not_modified_count') or 0) + 1
+        self.skipped_seconds = (self.get('skipped_seconds') or 0.) + (float(np.median(totals)) if totals else 0.)
+
+    @classmethod
+    def get_skip_stats(cls):
+        """
+        Returns a dict of service type -> {'skipped', 'skipped_seconds',
+        'not_modified'}, the harvests skipped so far, the time they saved and
+        the services whose last harvest was skipped
+        """
+        harvests = list(db[cls.__collection__].find({'not_modified_count': {'$gt': 0}},
+                                                     {'service_id': 1,
+                                                      'harvest_successful': 1,
+                                                      'not_modified_count': 1,
+                                                      'skipped_seconds': 1}))
+        types = {s['_id']: s['service_type']
+                 for s in db.services.find({'_id': {'$in': [h['service_id'] for h in harvests]}},
+                                           {'service_type': 1})}
+
+        stats = {}
+        for h in harvests:
+            row = stats.setdefault(types.get(h['service_id']), {'skipped': 0,
+                                                                'skipped_seconds': 0.,
+                                                                'not_modified': 0})
+            row['skipped'] += h['not_modified_count']
+            row['skipped_seconds'] += h.get('skipped_seconds') or 0.
+            if h.get('harvest_successful') == HarvestStatus.NOT_MODIFIED:
+                row['not_modified'] += 1
+        return stats
+
+    @classmethod
+    def clear_fingerprints(cls, service_ids=None):
+        """
+        Forgets the fingerprints of services so their next harvest is a full
+        one
+        """
+        query = {'fingerprint': {'$exists': True}}
+        if service_ids is not None:
+            query['service_id'] = {'$in': list(service_ids)}
+        db[cls.__collection__].update(query, {'$unset': {'fingerprint': ''}}, multi=True)
+
+    @classmethod
+    def get_checkpoints(cls, service_ids=None):
+        """
+        Returns a dict of service_id -> checkpoint of the batched harvests in
+        progress
+        """
+        query = {'checkpoint.next_offering': {'$exists': True}}
+        if service_ids is not None:
+            query['service_id'] = {'$in': list(service_ids)}
+        return {h['service_id']: h['checkpoint']
+                for h in db[cls.__collection__].find(query, {'service_id': 1,
+                                                             'checkpoint': 1})}
+
+    def harvest_batch(self, harvester, batch_size):
+        """
+        Harvests the next batch of offerings of an SOS and moves the
+        checkpoint past it. A batch whose stations partly failed still
+        counts as done, its failures are kept and raised with the last
+        batch. A batch that is killed leaves the checkpoint where it was, so
+        the next run starts that batch over.
+
+        A checkpoint older than HARVEST_CHECKPOINT_TTL seconds is dropped
+        and the harvest starts from the first offering.
+        """
+        checkpoint = self.get('checkpoint') or {}
+        ttl = timedelta(seconds=app.config.get('HARVEST_CHECKPOINT_TTL', 2 * 86400))
+        if checkpoint and checkpoint['updated'] < datetime.utcnow() - ttl:
+            checkpoint = {}
+
+        start = checkpoint.get('next_offering', 0)
+        stop = start + batch_size
+        errors = list(checkpoint.get('errors') or [])
+        try:
+            harvester.harvest(start=start, stop=stop)
+        except (DescribeSensorError, SosFormatError) as e:
+            errors.append(unicode(repr(e)))
+
+        total = harvester.offering_count
+        if stop < total:
+            self.checkpoint = {'next_offering': stop,
+                               'total': total,
+                               'batch_size': batch_size,
+                               'errors': errors[-self.MAX_MESSAGES:],
+                               'started': checkpoint.get('started') or datetime.utcnow(),
+                               'updated': datetime.utcnow()}
+            return None
+
+        self.checkpoint = None
+        batches = (total + batch_size - 1) // batch_size
+        if errors:
+            raise DescribeSensorError(u'\n'.join(errors))
+        return 'Harvested %d offerings in %d batches' % (total, batches)
+
+    def _harvest(self, ignore_active, phases, batch_size, force, deadline, counters):
 
         service_id = self.service_id
 
@@ -81,24 +288,30 @@ class Harvest(BaseDocument):
             self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
             return
 
+        # trust the ping sweep's status if it is recent enough, otherwise
         # ping it first to see if alive
-        try:
-            with Timeout(seconds=120):
-                _, response_code = service.ping(timeout=60)
-            operational_status = True if response_code in [200, 400] else False
-        except (requests.ConnectionError, requests.HTTPError):
-            operational_status = False
-            response_code = 0
-        except requests.Timeout as e:
-            self.new_message("Service Ping Timeout: %s" % e.message, False)
-            self.set_status("Timed Out")
-            self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
-            return
-        except TimeoutError:
-            self.new_message("Service Ping Timeout: 120s", False)
-            self.set_status("Timed Out")
-            self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
-            return
+        recent = db.PingLatest.get_recent_status(service._id, app.config.get('HARVEST_PING_TTL', 3600))
+        if recent is not None:
+            response_code, operational_status = recent
+        else:
+            try:
+                ping_start = time.time()
+                _, response_code = service.ping(timeout=60, deadline=deadline)
+                phases['ping'] = time.time() - ping_start
+                operational_status = True if response_code in [200, 400] else False
+            except (requests.ConnectionError, requests.HTTPError):
+                operational_status = False
+                response_code = 0
+            except requests.Timeout as e:
+                self.new_message("Service Ping Timeout: %s" % e.message, False)
+                self.set_status("Timed Out")
+                self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
+                return
+            except TimeoutError as e:
+                self.new_message("Service Ping Timeout: %s" % e, False)
+                self.set_status("Timed Out")
+                self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
+                return
 
         if not operational_status:
             # not a failure
@@ -116,19 +329,59 @@ class Harvest(BaseDocument):
             self.harvest_successful = HarvestStatus.SERVICE_UNAVAILABLE
             return
 
+        # skip the harvest if nothing changed since the last successful one,
+        # the rest of a batched harvest always runs
+        fingerprint = None
+        try:
+            fingerprint_start = time.time()
+            fingerprint = fetch_fingerprint(service, self.get('fingerprint'),
+                                            timeout=http_client.deadline_timeout(deadline))
+            phases['fingerprint'] = time.time() - fingerprint_start
+        except (requests.RequestException, TimeoutError):
+            app.logger.warning("Could not fingerprint service %s", service_id, exc_info=True)
+
+        if (not force and not self.get('checkpoint') and
+                self.harvest_successful in (HarvestStatus.SUCCESS, HarvestStatus.NOT_MODIFIED) and
+                same_fingerprint(fingerprint, self.get('fingerprint'))):
+            self.record_skip()
+            self.set_status("Not Modified")
+            self.harvest_successful = HarvestStatus.NOT_MODIFIED
+            return
+
+        harvest_start = time.time()
+        harvester = None
         try:
             message = ''
             if service.service_type == "DAP":
-                message = DapHarvester(service).harvest()
+                harvester = DapHarvester(service, deadline)
             elif service.service_type == "SOS":
-                message = SosHarvester(service).harvest()
+                harvester = SosHarvester(service, deadline)
             elif service.service_type == "WMS":
-                message = WmsHarvester(service).harvest()
+                harvester = WmsHarvester(service, deadline)
             elif service.service_type == "WCS":
-                message = WcsHarvester(service).harvest()
+                harvester = WcsHarvester(service, deadline)
+            if batch_size and service.service_type == "SOS":
+                message = self.harvest_batch(harvester, batch_size)
+                if self.get('checkpoint'):
+                    checkpoint = self.checkpoint
+                    self.set_status("Harvest In Progress (%d/%d offerings)" % (checkpoint['next_offering'],
+                                                                               checkpoint['total']))
+                    self.harvest_successful = HarvestStatus.IN_PROGRESS
+                    return
+            elif harvester is not None:
+                message = harvester.harvest()
             self.new_message(message or 'Harvest Successful', True)
             self.set_status("Harvest Successful")
             self.harvest_successful = HarvestStatus.SUCCESS
+            if fingerprint is not None:
+                self.fingerprint = fingerprint
+            return
+
+        except TimeoutError as e:
+            app.logger.exception("Harvest of service %s ran out of time", service_id)
+            self.new_message("Harvest Timeout: %s" % e, False)
+            self.set_status("Timed Out")
+            self.harvest_successful = HarvestStatus.TIMEOUT
             return
 
         except socket.timeout as e:
@@ -206,6 +459,12 @@ class Harvest(BaseDocument):
             self.harvest_successful = HarvestStatus.TIMEOUT
             return
 
+        finally:
+            phases['harvest'] = time.time() - harvest_start
+            if harvester is not None:
+                phases.update(harvester.timings)
+                counters.update(harvester.counters)
+
     def new_message(self, message, successful):
         if not isinstance(message, unicode):
             message = unicode(message)
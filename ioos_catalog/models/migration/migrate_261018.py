@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Migrates:
+    - PingLatest rolling windows from hourly lists to packed ring buffers at
+      PING_SLOT_SECONDS resolution
+    - Services get a canonical_url
+'''
+
+from ioos_catalog import db, app
+from ioos_catalog.models.ping_latest import (WINDOW_FIELDS, decode_window, empty_window,
+                                             encode_window, get_slot_seconds)
+from ioos_catalog.util import canonical_url
+
+
+def convert_window(field, value, stored, slot_seconds):
+    '''
+    Returns the window stored at the stored resolution as a window at
+    slot_seconds. Going finer, every old slot fills the new slots it covers
+    with its value. Going coarser, each new slot keeps the last ping of the
+    old slots it covers.
+    '''
+    old = decode_window(field, value)
+    if stored == slot_seconds:
+        return old
+    new = empty_window(field, slot_seconds)
+    sentinel = WINDOW_FIELDS[field][1]
+    for i, v in enumerate(old):
+        if v == sentinel:
+            continue
+        start = i * stored // slot_seconds
+        end = max((i + 1) * stored // slot_seconds, start + 1)
+        new[start:end] = v
+    return new
+
+
+def migrate_ping_latest():
+    slot_seconds = get_slot_seconds()
+    collection = db['ping_latest']
+    docs = collection.find({'$or': [{'slot_seconds': {'$exists': False}},
+                                    {'slot_seconds': {'$ne': slot_seconds}}]})
+    bulk = collection.initialize_unordered_bulk_op()
+    count = 0
+    for doc in docs:
+        stored = doc.get('slot_seconds') or 3600
+        update = {'slot_seconds': slot_seconds}
+        for field in WINDOW_FIELDS:
+            if doc.get(field) is None:
+                window = empty_window(field, slot_seconds)
+            else:
+                window = convert_window(field, doc[field], stored, slot_seconds)
+            update[field] = encode_window(window)
+        bulk.find({'_id': doc['_id']}).update_one({'$set': update})
+        count += 1
+
+    if count:
+        bulk.execute()
+    app.logger.info("Converted %s PingLatest windows to %ss slots", count, slot_seconds)
+
+
+def backfill_canonical_urls():
+    collection = db['services']
+    bulk = collection.initialize_unordered_bulk_op()
+    count = 0
+    for doc in collection.find({}, {'url': 1, 'canonical_url': 1}):
+        url = canonical_url(doc.get('url'))
+        if url == doc.get('canonical_url'):
+            continue
+        bulk.find({'_id': doc['_id']}).update_one({'$set': {'canonical_url': url}})
+        count += 1
+
+    if count:
+        bulk.execute()
+    collection.ensure_index('canonical_url')
+    app.logger.info("Set the canonical URL of %s services", count)
+
+
+def migrate():
+    with app.app_context():
+        migrate_ping_latest()
+        backfill_canonical_urls()
+        app.logger.info("Migration 2026-10-18 complete")
@@ -26,6 +26,15 @@ class PingArchive(BaseDocument):
         'response_time_sum'       : int,      # sum of all response_times this week
         'operational_status_sum'  : int,      # sum of all operational statuses (1s and 0s)
 
+        # phase timing sums, over the entries that have timings (failed pings don't)
+        'timed_entries'           : int,      # number of entries with timings
+        'dns_time_sum'            : float,    # sum of DNS resolution times (ms)
+        'connect_time_sum'        : float,    # sum of TCP connect times (ms)
+        'tls_time_sum'            : float,    # sum of TLS handshake times (ms)
+        'ttfb_sum'                : float,    # sum of times to first byte (ms)
+        'total_time_sum'          : float,    # sum of total transfer times (ms)
+        'bytes_sum'               : int,      # sum of bytes received
+
         'created'                 : datetime,
         'updated'                 : datetime,
     }
@@ -35,8 +44,23 @@ class PingArchive(BaseDocument):
         'num_entries'             : 0,
         'response_time_sum'       : 0,
         'operational_status_sum'  : 0,
+        'timed_entries'           : 0,
+        'dns_time_sum'            : 0.,
+        'connect_time_sum'        : 0.,
+        'tls_time_sum'            : 0.,
+        'ttfb_sum'                : 0.,
+        'total_time_sum'          : 0.,
+        'bytes_sum'               : 0,
     }
 
+    # PingResult timings key -> archive sum field
+    TIMING_FIELDS = [('dns',     'dns_time_sum'),
+                     ('connect', 'connect_time_sum'),
+                     ('tls',     'tls_time_sum'),
+                     ('ttfb',    'ttfb_sum'),
+                     ('total',   'total_time_sum'),
+                     ('bytes',   'bytes_sum')]
+
     indexes = [
         {
             'fields': ['service_id']
@@ -50,7 +74,7 @@ class PingArchive(BaseDocument):
 
         A new one will not be saved automatically.
         """
-        start_time = datetime.combine((dt - timedelta(days=dt.weekday())).date(), time())
+        start_time = cls.get_start_time(dt)
         pa = db.PingArchive.find_one({'service_id':service_id,
                                       'start_time':start_time})
         if not pa:
@@ -60,6 +84,44 @@ class PingArchive(BaseDocument):
 
         return pa
 
+    @classmethod
+    def get_start_time(cls, dt):
+        """
+        Returns midnight on the monday of the week containing dt.
+        """
+        return datetime.combine((dt - timedelta(days=dt.weekday())).date(), time())
+
+    @classmethod
+    def ingest(cls, results):
+        """
+        Adds a batch of ping results to their weekly archives with unordered
+        bulk $inc upserts, one per result.
+
+        results is an iterable of objects with service_id, dt, response_time,
+        operational_status and timings attributes (see PingResult).
+        """
+        results = list(results)
+        if not results:
+            return
+
+        utcnow = datetime.utcnow()
+        bulk = db[cls.__collection__].initialize_unordered_bulk_op()
+        for r in results:
+            inc = {'num_entries': 1,
+                   'response_time_sum': r.response_time or 0,
+                   'operational_status_sum': 1 if r.operational_status else 0}
+            timings = getattr(r, 'timings', None)
+            if timings:
+                inc['timed_entries'] = 1
+                for key, field in cls.TIMING_FIELDS:
+                    inc[field] = timings.get(key) or 0
+            bulk.find({'service_id': r.service_id,
+                       'start_time': cls.get_start_time(r.dt)}).upsert().update_one({
+                '$inc': inc,
+                '$set': {'updated': utcnow},
+                '$setOnInsert': {'created': utcnow}})
+        bulk.execute()
+
     def add_ping_data(self, response_time, operational_status):
         self.num_entries += 1
         self.response_time_sum += response_time or 0
@@ -72,6 +134,18 @@ class PingArchive(BaseDocument):
 
         return self.response_time_sum / float(self.num_entries)
 
+    @property
+    def timings(self):
+        """
+        Average phase timings for the week, as a dict keyed like the ping
+        timings (dns, connect, tls, ttfb, total, bytes).
+        """
+        timed = self.get('timed_entries') or 0
+        if timed == 0:
+            return {key: None for key, _ in self.TIMING_FIELDS}
+
+        return {key: (self.get(field) or 0) / float(timed) for key, field in self.TIMING_FIELDS}
+
     @property
     def operational_status(self):
         """
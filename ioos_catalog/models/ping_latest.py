@@ -1,4 +1,5 @@
 from bson import ObjectId
+from bson.binary import Binary
 from collections import defaultdict
 from datetime import datetime, timedelta
 import pytz
@@ -6,8 +7,55 @@ from ioos_catalog import app, db
 from ioos_catalog.models.base_document import BaseDocument
 from ioos_catalog.tasks.stat import ping_service_task
 from ioos_catalog.tasks.harvest import harvest
+import numpy as np
 import requests
 
+WEEK_SECONDS = 7 * 24 * 3600
+
+# The rolling window is stored as packed ring buffers with one slot per
+# slot_seconds since midnight monday.
+# field -> (dtype, sentinel of a slot without a ping)
+WINDOW_FIELDS = {
+    'response_times'       : ('<i4', np.iinfo(np.int32).min),
+    'response_codes'       : ('<i2', np.iinfo(np.int16).min),
+    'operational_statuses' : ('i1', -1),
+}
+
+
+def get_slot_seconds():
+    """
+    Returns the configured resolution of the rolling window in seconds. It
+    must divide a week evenly, ie 300 for 5 minute slots.
+    """
+    return app.config.get('PING_SLOT_SECONDS', 3600)
+
+
+def empty_window(field, slot_seconds=None):
+    """
+    Returns a writable window for field with every slot empty
+    """
+    dtype, sentinel = WINDOW_FIELDS[field]
+    size = WEEK_SECONDS // (slot_seconds or get_slot_seconds())
+    return np.full(size, sentinel, dtype=dtype)
+
+
+def encode_window(window):
+    return Binary(window.tostring())
+
+
+def decode_window(field, value):
+    """
+    Returns a read-only numpy view of a stored window.
+
+    Windows stored before they were packed are lists with None for a missing
+    ping, those are converted.
+    """
+    dtype, sentinel = WINDOW_FIELDS[field]
+    if isinstance(value, list):
+        return np.array([sentinel if v is None else v for v in value], dtype=dtype)
+    return np.frombuffer(value, dtype=dtype)
+
+
 @db.register
 class PingLatest(BaseDocument):
     """
@@ -25,11 +73,14 @@ class PingLatest(BaseDocument):
         'last_response_code'      : int,      # last response code
         'last_operational_status' : bool,   # last operational status
         'last_good_time'          : datetime, # last timestamp that the service was alive (possibly null)
+        'last_timings'            : dict,     # phase timings of the last ping (dns, connect, tls, ttfb, total in ms, bytes)
 
-        # rolling weekly data
-        'response_times'          : [int],    # list of pings, indexed by day of week * 24 + hour
-        'response_codes'          : [int],    # list of response codes, indexed by day of week * 24 + hour
-        'operational_statuses'    : [bool],   # list of op status, indexed by day of week * 24 + hour
+        # rolling weekly data, packed ring buffers (see WINDOW_FIELDS) indexed
+        # by seconds since midnight monday // slot_seconds
+        'slot_seconds'            : int,      # resolution of the rolling window
+        'response_times'          : Binary,   # int32 response times (ms)
+        'response_codes'          : Binary,   # int16 response codes
+        'operational_statuses'    : Binary,   # int8 op status (1 up, 0 down)
 
         'created'                 : datetime,
         'updated'                 : datetime,
@@ -37,9 +88,10 @@ class PingLatest(BaseDocument):
 
     default_values = {
         'created'              : datetime.utcnow,
-        'response_times'       : [None] * (24*7),
-        'response_codes'       : [None] * (24*7),
-        'operational_statuses' : [None] * (24*7),
+        'slot_seconds'         : get_slot_seconds,
+        'response_times'       : lambda: encode_window(empty_window('response_times')),
+        'response_codes'       : lambda: encode_window(empty_window('response_codes')),
+        'operational_statuses' : lambda: encode_window(empty_window('operational_statuses')),
     }
 
     indexes = [
@@ -62,6 +114,22 @@ class PingLatest(BaseDocument):
 
         return pl
 
+    @classmethod
+    def get_recent_status(cls, service_id, ttl):
+        """
+        Returns the (response code, operational status) of the last ping of a
+        service if it is less than ttl seconds old, else None
+        """
+        if not ttl:
+            return None
+        doc = db[cls.__collection__].find_one({'service_id': service_id,
+                                               'updated': {'$gte': datetime.utcnow() - timedelta(seconds=ttl)}},
+                                              {'last_response_code': 1,
+                                               'last_operational_status': 1})
+        if doc is None or doc.get('last_operational_status') is None:
+            return None
+        return doc.get('last_response_code'), bool(doc['last_operational_status'])
+
     def ping_service(self):
         """
         Ping the service, record its entry in the correct index.
@@ -73,8 +141,6 @@ class PingLatest(BaseDocument):
         s = db.Service.find_one({'_id':self.service_id})
         assert s is not None
 
-        last     = self.last_operational_status
-        last_idx = self.get_index(self.updated)
         dt       = datetime.utcnow()
 
         try:
@@ -85,35 +151,268 @@ class PingLatest(BaseDocument):
             response_code = -1
             operational_status = False
 
+        return self.record_ping(dt, response_time, response_code, operational_status)
+
+    def record_ping(self, dt, response_time, response_code, operational_status):
+        """
+        Records the result of a ping that was performed elsewhere (ie the ping
+        engine).
+
+        You are responsible for saving.
+
+        Returns the same 2-tuple as ping_service.
+        """
+        last     = self.last_operational_status
+        last_idx = self.get_index(self.updated, self.get_slot_seconds())
+
         idx = self.set_ping_data(dt, response_time, response_code, operational_status)
 
         return last_idx != idx, last and (last != operational_status)
 
-    def get_index(self, dt):
+    @classmethod
+    def get_index(cls, dt, slot_seconds=None):
         if dt is None:
             return None
-        weekday = dt.weekday()
-        return weekday * 24 + dt.hour
+        seconds = dt.weekday() * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+        return seconds // (slot_seconds or get_slot_seconds())
+
+    @classmethod
+    def get_skipped_indexes(cls, start_dt, dt, slot_seconds=None):
+        """
+        Returns the indexes of the slots strictly between start_dt and dt,
+        which received no ping and need to be blanked.
+        """
+        if start_dt is None:
+            return []
+        slot_seconds = slot_seconds or get_slot_seconds()
+        ends = (cls.get_index(start_dt, slot_seconds), cls.get_index(dt, slot_seconds))
+        if dt - start_dt >= timedelta(days=7):
+            # the whole window is stale
+            return [i for i in xrange(WEEK_SECONDS // slot_seconds) if i != ends[1]]
+
+        indexes = []
+        step = timedelta(seconds=slot_seconds)
+        start_dt += step
+        while start_dt < dt:
+            idx = cls.get_index(start_dt, slot_seconds)
+            if idx not in ends:
+                indexes.append(idx)
+            start_dt += step
+        return indexes
+
+    @classmethod
+    def load_windows(cls, doc, slot_seconds):
+        """
+        Returns a dict of writable copies of the windows of a stored document.
+        Windows that are missing or were stored at another resolution start
+        out empty.
+        """
+        stored = doc.get('slot_seconds') or 3600
+        windows = {}
+        for field in WINDOW_FIELDS:
+            value = doc.get(field)
+            if value is None or stored != slot_seconds:
+                windows[field] = empty_window(field, slot_seconds)
+            else:
+                windows[field] = decode_window(field, value).copy()
+        return windows
+
+    @classmethod
+    def apply_ping(cls, windows, slot_seconds, start_dt, dt, response_time,
+                   response_code, operational_status):
+        """
+        Writes a ping into the windows and blanks the slots skipped since
+        start_dt. Returns the index written.
+        """
+        skipped = cls.get_skipped_indexes(start_dt, dt, slot_seconds)
+        idx = cls.get_index(dt, slot_seconds)
+        values = {'response_times'       : response_time,
+                  'response_codes'       : response_code,
+                  'operational_statuses' : int(bool(operational_status))}
+
+        for field, (dtype, sentinel) in WINDOW_FIELDS.iteritems():
+            window = windows[field]
+            if skipped:
+                window[skipped] = sentinel
+            window[idx] = sentinel if values[field] is None else values[field]
+
+        return idx
+
+    @classmethod
+    def ingest(cls, results):
+        """
+        Records a batch of ping results with one read and one unordered bulk
+        upsert.
+
+        A packed window is a few KB at most (672 bytes per field at hourly
+        resolution), so each affected document gets its windows rewritten and
+        its latest values $set in a single update.
+
+        results is an iterable of objects with service_id, dt, response_time,
+        response_code, operational_status and timings attributes (see
+        PingResult).
+
+        Returns a list of (result, wasnew, last_status) tuples, where wasnew
+        is in the same sense as ping_service and last_status is the service's
+        operational status before this result (None if it was never pinged).
+        """
+        results = sorted(results, key=lambda r: r.dt)
+        if not results:
+            return []
+
+        slot_seconds = get_slot_seconds()
+        collection = db[cls.__collection__]
+        sids = list(set(r.service_id for r in results))
+        fields = ['service_id', 'updated', 'last_operational_status', 'slot_seconds'] + WINDOW_FIELDS.keys()
+        state = {d['service_id']: d for d in collection.find({'service_id': {'$in': sids}},
+                                                               {f: 1 for f in fields})}
+
+        recorded = []
+        windows = {}
+        updates = defaultdict(dict)
+        for r in results:
+            doc = state.setdefault(r.service_id, {'service_id': r.service_id})
+            start_dt = doc.get('updated')
+            if start_dt is not None and start_dt > r.dt:
+                app.logger.warning("Discarding out of order ping for %s", r.service_id)
+                continue
+
+            if r.service_id not in windows:
+                windows[r.service_id] = cls.load_windows(doc, slot_seconds)
+            if (doc.get('slot_seconds') or 3600) != slot_seconds:
+                # the resolution changed, the old window was dropped
+                start_dt = None
+
+            last = doc.get('last_operational_status')
+            last_idx = cls.get_index(start_dt, slot_seconds)
+            idx = cls.apply_ping(windows[r.service_id], slot_seconds, start_dt, r.dt,
+                                 r.response_time, r.response_code, r.operational_status)
+
+            update = updates[r.service_id]
+            update['updated'] = r.dt
+            update['last_response_time'] = r.response_time
+            update['last_response_code'] = r.response_code
+            update['last_operational_status'] = r.operational_status
+            update['last_timings'] = getattr(r, 'timings', None)
+            if r.operational_status:
+                update['last_good_time'] = r.dt
+
+            doc['updated'] = r.dt
+            doc['slot_seconds'] = slot_seconds
+            doc['last_operational_status'] = r.operational_status
+
+            recorded.append((r, last_idx != idx, last))
+
+        if updates:
+            utcnow = datetime.utcnow()
+            bulk = collection.initialize_unordered_bulk_op()
+            for sid, update in updates.iteritems():
+                update['slot_seconds'] = slot_seconds
+                for field, window in windows[sid].iteritems():
+                    update[field] = encode_window(window)
+                bulk.find({'service_id': sid}).upsert().update_one({
+                    '$set': update,
+                    '$setOnInsert': {'created': utcnow}})
+            bulk.execute()
+
+        return recorded
+
+    @classmethod
+    def get_slot_mask(cls, start_time, end_time, slot_seconds):
+        """
+        Returns a boolean array over the slots of a window, True for the slots
+        between start_time and end_time (wrapping around the week).
+        """
+        mask = np.zeros(WEEK_SECONDS // slot_seconds, dtype=bool)
+        sidx = cls.get_index(start_time, slot_seconds)
+        eidx = cls.get_index(end_time, slot_seconds)
+        if sidx == eidx:
+            # a range within one slot, unless it spans the whole week
+            if (end_time - start_time).total_seconds() >= WEEK_SECONDS:
+                mask[:] = True
+            else:
+                mask[sidx] = True
+        elif sidx < eidx:
+            mask[sidx:eidx] = True
+        else:
+            mask[sidx:] = True
+            mask[:eidx] = True
+        return mask
+
+    @classmethod
+    def get_counts_in_range(cls, start_time, end_time):
+        """
+        Counts the pings of every service between start_time and end_time,
+        which must be within the past week.
+
+        The operational status windows of all services sharing a resolution
+        are stacked into one services x slots matrix and counted in a single
+        numpy pass, so the cost doesn't depend on per-service Python loops.
+
+        Returns a dict of service_id -> (good, total, last_operational_status,
+        uptime percent or None if there were no pings).
+        """
+        dtype, sentinel = WINDOW_FIELDS['operational_statuses']
+        groups = defaultdict(list)
+        for doc in db[cls.__collection__].find({}, {'service_id': 1,
+                                                    'last_operational_status': 1,
+                                                    'operational_statuses': 1,
+                                                    'slot_seconds': 1}):
+            if doc.get('operational_statuses') is None:
+                continue
+            groups[doc.get('slot_seconds') or 3600].append(doc)
+
+        counts = {}
+        for slot_seconds, docs in groups.iteritems():
+            slots = WEEK_SECONDS // slot_seconds
+            packed = [d['operational_statuses'] for d in docs]
+            if all(isinstance(w, bytes) for w in packed):
+                matrix = np.frombuffer(b''.join(packed), dtype=dtype).reshape(len(docs), slots)
+            else:
+                # windows that predate packing
+                matrix = np.vstack([decode_window('operational_statuses', w) for w in packed])
+
+            window = matrix[:, cls.get_slot_mask(start_time, end_time, slot_seconds)]
+            total = (window != sentinel).sum(axis=1)
+            good = (window > 0).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                uptime = np.where(total > 0, 100. * good / total, np.nan)
+
+            for doc, g, t, u in zip(docs, good.tolist(), total.tolist(), uptime.tolist()):
+                counts[doc['service_id']] = (g, t, doc.get('last_operational_status'),
+                                             None if t == 0 else u)
+
+        return counts
+
+    def get_slot_seconds(self):
+        return self.get('slot_seconds') or 3600
+
+    def get_window(self, field):
+        """
+        Returns a read-only numpy view of one of the rolling windows
+        (response_times, response_codes or operational_statuses). Slots
+        without a ping hold the sentinel from WINDOW_FIELDS.
+        """
+        value = self.get(field)
+        if value is None:
+            return empty_window(field, self.get_slot_seconds())
+        return decode_window(field, value)
 
     def set_ping_data(self, dt, response_time, response_code, operational_status):
-        # figure number of nulls to set
-        # starting with last known update time, go forward an hour until we reach current dt
+        # blank every slot skipped since the last known update time, then
+        # write this ping into its slot
         start_dt = self.updated
         if start_dt is not None and start_dt > dt:
             # uh wat
             print "badness"
             return
 
-        if start_dt is not None:
-            start_dt += timedelta(hours=1)
-            while start_dt < dt:
-                idx = self.get_index(start_dt)
-
-                self.response_times[idx]       = None
-                self.response_codes[idx]       = None
-                self.operational_statuses[idx] = None
-
-                start_dt += timedelta(hours=1)
+        slot_seconds = get_slot_seconds()
+        if self.get_slot_seconds() != slot_seconds:
+            start_dt = None
+        windows = self.load_windows(self, slot_seconds)
+        idx = self.apply_ping(windows, slot_seconds, start_dt, dt, response_time,
+                              response_code, operational_status)
 
         # set latest
         self.updated = dt
@@ -124,27 +423,24 @@ class PingLatest(BaseDocument):
             self.last_good_time = dt
 
         # set rolling window
-        idx                            = self.get_index(dt)
-        self.response_times[idx]       = response_time
-        self.response_codes[idx]       = response_code
-        self.operational_statuses[idx] = operational_status
+        self.slot_seconds = slot_seconds
+        for field, window in windows.iteritems():
+            self[field] = encode_window(window)
 
         return idx
 
     def get_current_data(self):
-        start_dt = datetime.utcnow()
-        idx = self.get_index(start_dt)
-
-        # literally the last entry!
-        if idx == 167:
-            ret = (self.response_times, self.operational_statuses)
-        else:
-            start_idx = idx + 1
-
-            ret = (self.response_times[start_idx:168] + self.response_times[0:start_idx],
-                   self.operational_statuses[start_idx:168] + self.operational_statuses[0:start_idx])
-
-        return ret
-
+        """
+        Returns the response times and operational statuses of the past week,
+        oldest first, as masked arrays with the slots without a ping masked.
+        """
+        slot_seconds = self.get_slot_seconds()
+        start_idx = self.get_index(datetime.utcnow(), slot_seconds) + 1
 
+        ret = []
+        for field in ('response_times', 'operational_statuses'):
+            window = self.get_window(field)
+            ret.append(np.ma.masked_equal(np.roll(window, -start_idx),
+                                          WINDOW_FIELDS[field][1]))
 
+        return tuple(ret)
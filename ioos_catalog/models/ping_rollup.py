@@ -0,0 +1,227 @@
+from bson import ObjectId
+from collections import defaultdict
+from datetime import datetime, timedelta, time
+import pytz
+from ioos_catalog import app, db
+from ioos_catalog.models.base_document import BaseDocument
+
+# rollup tiers, coarsest first: tier name -> bucket length
+TIERS = [('week', timedelta(days=7)),
+         ('day',  timedelta(days=1)),
+         ('hour', timedelta(hours=1))]
+
+TIER_LENGTHS = dict(TIERS)
+
+# default days each tier is kept for, None keeps it forever
+DEFAULT_RETENTION = {'hour': 14, 'day': 400, 'week': None}
+
+
+def naive_utc(dt):
+    """
+    Returns dt as a naive UTC datetime, the way Mongo stores it
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return dt
+
+
+@db.register
+class PingRollup(BaseDocument):
+    """
+    Ping history rolled up into hourly, daily and weekly buckets by service id.
+
+    Every recorded ping is added to the bucket of each tier that contains it,
+    so a range query reads a handful of coarse buckets instead of every ping.
+    Each tier is pruned after its own retention (PING_ROLLUP_RETENTION).
+    """
+    __collection__   = 'ping_rollups'
+    use_dot_notation = True
+    use_schemaless   = True
+
+    structure = {
+        'service_id'              : ObjectId, # id of the service
+        'tier'                    : unicode,  # hour, day or week
+        'start_time'              : datetime, # start of the bucket (weeks start midnight monday)
+
+        'num_entries'             : int,      # number of pings
+        'operational_status_sum'  : int,      # number of pings that found the service up
+        'response_time_entries'   : int,      # number of pings with a response time
+        'response_time_sum'       : int,      # sum of response times (ms)
+        'response_time_min'       : int,      # fastest response time (ms)
+        'response_time_max'       : int,      # slowest response time (ms)
+
+        'created'                 : datetime,
+        'updated'                 : datetime,
+    }
+
+    default_values = {
+        'created'                 : datetime.utcnow,
+        'num_entries'             : 0,
+        'operational_status_sum'  : 0,
+        'response_time_entries'   : 0,
+        'response_time_sum'       : 0,
+    }
+
+    indexes = [
+        {
+            'fields': ['service_id', 'tier', 'start_time'],
+            'unique': True,
+        },
+        {
+            'fields': ['tier', 'start_time']
+        },
+    ]
+
+    @classmethod
+    def get_start_time(cls, tier, dt):
+        """
+        Returns the start of the bucket of tier containing dt
+        """
+        dt = naive_utc(dt)
+        if tier == 'hour':
+            return dt.replace(minute=0, second=0, microsecond=0)
+        if tier == 'day':
+            return datetime.combine(dt.date(), time())
+        if tier == 'week':
+            return datetime.combine((dt - timedelta(days=dt.weekday())).date(), time())
+        raise ValueError("Unknown rollup tier %s" % tier)
+
+    @classmethod
+    def get_retention(cls, tier):
+        """
+        Returns the oldest start time kept for tier, or None if it is kept
+        forever
+        """
+        days = app.config.get('PING_ROLLUP_RETENTION', {}).get(tier, DEFAULT_RETENTION[tier])
+        if days is None:
+            return None
+        return cls.get_start_time(tier, datetime.utcnow() - timedelta(days=days))
+
+    @classmethod
+    def ingest(cls, results):
+        """
+        Adds a batch of ping results to every rollup tier with one unordered
+        bulk of $inc/$min/$max upserts, one per bucket touched.
+
+        results is an iterable of objects with service_id, dt, response_time
+        and operational_status attributes (see PingResult).
+        """
+        buckets = defaultdict(lambda: {'inc': defaultdict(int), 'min': None, 'max': None})
+        for r in results:
+            for tier, _ in TIERS:
+                b = buckets[(r.service_id, tier, cls.get_start_time(tier, r.dt))]
+                b['inc']['num_entries'] += 1
+                b['inc']['operational_status_sum'] += 1 if r.operational_status else 0
+                if r.response_time is not None:
+                    b['inc']['response_time_entries'] += 1
+                    b['inc']['response_time_sum'] += r.response_time
+                    b['min'] = r.response_time if b['min'] is None else min(b['min'], r.response_time)
+                    b['max'] = r.response_time if b['max'] is None else max(b['max'], r.response_time)
+
+        if not buckets:
+            return
+
+        utcnow = datetime.utcnow()
+        bulk = db[cls.__collection__].initialize_unordered_bulk_op()
+        for (service_id, tier, start_time), b in buckets.iteritems():
+            update = {'$inc': dict(b['inc']),
+                      '$set': {'updated': utcnow},
+                      '$setOnInsert': {'created': utcnow}}
+            if b['min'] is not None:
+                update['$min'] = {'response_time_min': b['min']}
+                update['$max'] = {'response_time_max': b['max']}
+            bulk.find({'service_id': service_id,
+                       'tier': tier,
+                       'start_time': start_time}).upsert().update_one(update)
+        bulk.execute()
+
+    @classmethod
+    def prune(cls):
+        """
+        Removes the buckets of every tier that are older than its retention.
+        Returns a dict of tier -> number of buckets removed.
+        """
+        removed = {}
+        for tier, _ in TIERS:
+            cutoff = cls.get_retention(tier)
+            if cutoff is None:
+                continue
+            result = db[cls.__collection__].remove({'tier': tier, 'start_time': {'$lt': cutoff}})
+            removed[tier] = result.get('n', 0) if result else 0
+        return removed
+
+    @classmethod
+    def get_buckets(cls, start_time, end_time):
+        """
+        Decomposes [start_time, end_time) into the fewest aligned buckets,
+        using the coarsest tier that fits at each step. The ends are widened
+        to whole hours.
+
+        Buckets of a tier that has already been pruned are replaced by the
+        enclosing bucket of the next coarser tier, so old ranges are answered
+        at a coarser resolution instead of coming up short.
+
+        Returns a dict of tier -> sorted list of bucket start times.
+        """
+        start = cls.get_start_time('hour', start_time)
+        end = naive_utc(end_time)
+        cutoffs = {tier: cls.get_retention(tier) for tier, _ in TIERS}
+
+        buckets = defaultdict(set)
+        t = start
+        while t < end:
+            for i, (tier, length) in enumerate(TIERS):
+                if tier != 'hour' and (cls.get_start_time(tier, t) != t or t + length > end):
+                    continue
+                # fall back to coarser tiers while this one is pruned
+                while cutoffs[tier] is not None and t < cutoffs[tier] and i > 0:
+                    i -= 1
+                    tier, length = TIERS[i]
+                bucket = cls.get_start_time(tier, t)
+                buckets[tier].add(bucket)
+                t = bucket + length
+                break
+
+        return {tier: sorted(starts) for tier, starts in buckets.iteritems()}
+
+    @classmethod
+    def get_stats_in_range(cls, start_time, end_time, service_ids=None):
+        """
+        Returns the uptime and latency of every service between start_time
+        and end_time with a single aggregation over the buckets from
+        get_buckets.
+
+        Returns a dict of service_id -> {'num_entries', 'good', 'uptime',
+        'response_time', 'response_time_min', 'response_time_max'}, with
+        uptime as a percent and response times in ms.
+        """
+        buckets = cls.get_buckets(start_time, end_time)
+        if not buckets:
+            return {}
+
+        match = {'$or': [{'tier': tier, 'start_time': {'$in': starts}}
+                         for tier, starts in buckets.iteritems()]}
+        if service_ids is not None:
+            match['service_id'] = {'$in': list(service_ids)}
+
+        rows = cls.aggregate([{'$match': match},
+                              {'$group': {'_id': '$service_id',
+                                          'num_entries': {'$sum': '$num_entries'},
+                                          'good': {'$sum': '$operational_status_sum'},
+                                          'rt_entries': {'$sum': '$response_time_entries'},
+                                          'rt_sum': {'$sum': '$response_time_sum'},
+                                          'rt_min': {'$min': '$response_time_min'},
+                                          'rt_max': {'$max': '$response_time_max'}}}])
+
+        stats = {}
+        for row in rows:
+            total = row['num_entries']
+            stats[row['_id']] = {
+                'num_entries'       : total,
+                'good'              : row['good'],
+                'uptime'            : 100. * row['good'] / total if total else None,
+                'response_time'     : float(row['rt_sum']) / row['rt_entries'] if row['rt_entries'] else None,
+                'response_time_min' : row['rt_min'],
+                'response_time_max' : row['rt_max'],
+            }
+        return stats
@@ -1,11 +1,10 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
 import pytz
-import requests
 import urllib
 import urlparse
 
-from ioos_catalog import db
+from ioos_catalog import app, db, http_client
 from ioos_catalog.models.base_document import BaseDocument
 
 
@@ -18,6 +17,7 @@ class Service(BaseDocument):
     structure = {
         'name': unicode,  # friendly name of the service
         'url': unicode,  # url where the service resides
+        'canonical_url': unicode,  # url in canonical form, services sharing it are harvested once
         'tld': unicode,  # top level domain/ip address for grouping purposes
         'service_id': unicode,  # id of the service
         'service_type': unicode,  # service type
@@ -39,6 +39,12 @@ class Service(BaseDocument):
         'created': datetime.utcnow
     }
 
+    indexes = [
+        {
+            'fields': ['canonical_url'],
+        },
+    ]
+
     @classmethod
     def group_by_tld(cls, filter_ids=None):
         query = [{'$group': {'_id': '$tld', 'ids': {'$addToSet': '$_id'}}}]
@@ -48,11 +54,9 @@ class Service(BaseDocument):
         by_tld = cls.aggregate(query)
         return {a['_id']: a['ids'] for a in by_tld}
 
-    def ping(self, timeout=None):
+    def get_ping_url(self):
         """
-        Performs a service ping.
-
-        Returns a 2-tuple of response time in ms, response code.
+        Returns the URL to request when pinging this service.
         """
         url = self.url
         if self.service_type == 'DAP':
@@ -70,10 +74,40 @@ class Service(BaseDocument):
 
             url = urlparse.urlunparse(p)
 
-        r = requests.get(url, timeout=timeout)
+        return url
+
+    def get_ping_byte_cap(self):
+        """
+        Returns the number of bytes a ping reads before hanging up, or None to
+        read the whole response when streaming pings are disabled.
+        """
+        if not app.config.get('PING_STREAMING', True):
+            return None
+        caps = app.config.get('PING_BYTE_CAPS') or {}
+        return caps.get(self.service_type, 8192)
+
+    def timed_ping(self, timeout=None, deadline=None):
+        """
+        Performs a service ping.
+
+        The service is up or down by its status code alone, so only the first
+        few KB of the response are read (see get_ping_byte_cap).
+
+        Returns a 2-tuple of response code, dict of phase timings (see
+        http_client.timed_get).
+        """
+        r, timings = http_client.timed_get(self.get_ping_url(), timeout=timeout, deadline=deadline,
+                                           max_bytes=self.get_ping_byte_cap())
+        return r.status_code, timings
+
+    def ping(self, timeout=None, deadline=None):
+        """
+        Performs a service ping.
 
-        response_time = r.elapsed.microseconds / 1000
-        response_code = r.status_code
+        Returns a 2-tuple of response time in ms, response code.
+        """
+        response_code, timings = self.timed_ping(timeout=timeout, deadline=deadline)
+        response_time = int(round(timings['total']))
 
         return response_time, response_code
 
@@ -143,46 +177,26 @@ class Service(BaseDocument):
             start_time = start_time.replace(tzinfo=pytz.utc)
         start_time = start_time.astimezone(pytz.utc)
 
-        # can only support last 7 days with rolling window
+        # the rolling window covers the last 7 days, older ranges are read
+        # from the rollups
         aet = datetime.utcnow() - timedelta(days=7)
         aet = aet.replace(tzinfo=pytz.utc)
 
         if start_time < aet:
-            #raise ValueError("Can't support time more than 7 days ago")
-            return {}, [], end_time, start_time
-
-        # get all PLs
-        pls = db.PingLatest.find({}, {'service_id': 1,
-                                      'last_operational_status': 1,
-                                      'operational_statuses': 1,
-                                      'last_good_time': 1})
-
-        failed_services = {}
-
-        for p in pls:
-
-            sidx = p.get_index(start_time)
-            eidx = p.get_index(end_time)
-
-            if sidx < eidx:
-                statuses = p.operational_statuses[sidx:eidx]
-            else:
-                statuses = p.operational_statuses[
-                    sidx:168] + p.operational_statuses[0:eidx]
-
-            count = 0
-            good = 0
-            for s in statuses:
-                if s is not None:
-                    count += 1
-                    if s:
-                        good += 1
-
-            if count == good:
-                continue
-
-            failed_services[p.service_id] = (
-                good, count, p.last_operational_status)
+            stats = db.PingRollup.get_stats_in_range(start_time, end_time)
+            failed = [sid for sid, st in stats.iteritems() if st['good'] != st['num_entries']]
+            last_statuses = {p['service_id']: p.get('last_operational_status')
+                             for p in db['ping_latest'].find({'service_id': {'$in': failed}},
+                                                             {'service_id': 1,
+                                                              'last_operational_status': 1})}
+            failed_services = {sid: (stats[sid]['good'], stats[sid]['num_entries'],
+                                     last_statuses.get(sid), stats[sid]['uptime'])
+                               for sid in failed}
+        else:
+            # (good, total, last status, uptime %) of every service with failures
+            failed_services = {sid: counts
+                               for sid, counts in db.PingLatest.get_counts_in_range(start_time, end_time).iteritems()
+                               if counts[0] != counts[1]}
 
         # retrieve all services
         services = list(db.Service.find({'_id': {'$in': failed_services.keys()}}).sort(
@@ -1,7 +1,7 @@
 from bson.objectid import ObjectId
 from datetime import datetime
 import time
-from ioos_catalog import app, db
+from ioos_catalog import app, db, http_client
 from ioos_catalog.models.base_document import BaseDocument
 import requests
 from bson.code import Code
@@ -30,7 +30,7 @@ class Stat(BaseDocument):
         assert s is not None
 
         try:
-          r = requests.get(s.url)
+          r = http_client.get(s.url)
           self.response_time = r.elapsed.microseconds / 1000
           self.response_code = r.status_code
           self.operational_status = 1 if r.status_code in [200,400] else 0
@@ -4,97 +4,189 @@
 ioos_catalog/tasks/harvest.py
 '''
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
 from ioos_catalog import app, db, queue
 from ioos_catalog.tasks.debug import debug_wrapper
 from ioos_catalog.harvesters import context_decorator
-from random import shuffle
+from ioos_catalog.models.harvests import HarvestStatus
+from ioos_catalog.util import canonical_url
+from ioos_catalog.timeout import Deadline
+from rq import get_current_job
+from ioos_catalog.tasks.harvest_scheduler import schedule_harvests
+import numpy as np
 
 
-LARGER_SERVICES = [
-    ObjectId('53d34aed8c0db37e0b538fda'),
-    ObjectId('53d49c8d8c0db37ff1370308')
-]
-
-
-def queue_harvest_tasks():
+def queue_harvest_tasks(force=False):
     """
     Generate a number of harvest tasks.
 
-    Meant to be called via cron. Only queues services that are active.
+    Meant to be called via cron. Only queues services that are active. With
+    force, services are harvested even if they haven't changed.
     """
 
     with app.app_context():
-        # Some hosts don't like successive repeated connections, so by
-        # shuffling our list of services we reduce the liklihood that we'll
-        # harvest from the same host enough times to cause a service problem.
-        # This should reduce timeouts and unresponsive datasets
         services = list(db.Service.find({'active': True}))
-        services = distinct_services(services)
-        shuffle(services)
-        for s in services:
-            service_id = s._id
-            if service_id in LARGER_SERVICES:
-                continue
-            # count all the datasets associated with this particular service
-            datalen = db.datasets.find({'services.service_id':
-                                        service_id}).count()
-            # handle timeouts for services with large numbers of datasets
-            if datalen <= 36:
-                timeout_secs = 180
-            else:
-                # for large numbers of requests, 5 seconds should be enough
-                # for each request, on average
-                timeout_secs = datalen * 60
-            queue.enqueue_call(harvest, args=(service_id,),
-                               timeout=timeout_secs)
+        queue_services(services, force)
 
     # record dataset/service metrics after harvest
     add_counts()
 
 
+def get_canonical_url(service):
+    '''
+    Returns the canonical URL of a service, computing it for services that
+    were saved without one
+    '''
+    return service.get('canonical_url') or canonical_url(service.url)
+
+
 def distinct_services(services):
     '''
     Returns a filtered list of services that contain unique URLs. Services with
-    duplicate URLs are removed
+    duplicate URLs, compared in canonical form, are removed
 
     :param list services: List of services
     '''
     retval = []
     urls = set()
     for service in services:
-        if service.url in urls:
+        url = get_canonical_url(service)
+        if url in urls:
             continue
-        urls.add(service.url)
+        urls.add(url)
         retval.append(service)
     return retval
 
 
-def queue_provider(provider):
+def queue_provider(provider, force=False):
     with app.app_context():
         services = list(db.Service.find({'data_provider': provider, 'active': True}))
-        services = distinct_services(services)
-        for s in services:
-            service_id = s._id
-            if service_id in LARGER_SERVICES:
-                continue
-            # count all the datasets associated with this particular service
-            datalen = db.datasets.find({'services.service_id':
-                                        service_id}).count()
-            # handle timeouts for services with large numbers of datasets
-            if datalen <= 36:
-                timeout_secs = 180
-            else:
-                # for large numbers of requests, 5 seconds should be enough
-                # for each request, on average
-                timeout_secs = datalen * 60
-            queue.enqueue_call(harvest, args=(service_id,),
-                               timeout=timeout_secs)
+        queue_services(services, force)
 
     # record dataset/service metrics after harvest
     add_counts()
 
 
+def get_dataset_counts():
+    '''
+    Returns a dict of service id -> number of datasets that reference the
+    service, for every service, from a single aggregation
+    '''
+    pipeline = [
+        {'$unwind': '$services'},
+        # a dataset counts once per service even if it lists it twice
+        {'$group': {'_id': {'dataset': '$_id',
+                            'service_id': '$services.service_id'}}},
+        {'$group': {'_id': '$_id.service_id',
+                    'count': {'$sum': 1}}}
+    ]
+    return {row['_id']: row['count']
+            for row in db.datasets.aggregate(pipeline, allowDiskUse=True)['result']}
+
+
+def get_harvest_timeout(datalen):
+    '''
+    Returns the harvest timeout in seconds for a service with datalen
+    datasets
+    '''
+    # handle timeouts for services with large numbers of datasets
+    if datalen <= 36:
+        return 180
+    # for large numbers of requests, 5 seconds should be enough
+    # for each request, on average
+    return datalen * 60
+
+
+def estimate_harvest(timings, datalen):
+    '''
+    Returns the (expected, timeout) seconds of a harvest from the service's
+    harvest timings (newest first).
+
+    With at least HARVEST_MIN_HISTORY timings, the timeout is the
+    HARVEST_TIMEOUT_PERCENTILE of the past wall times times
+    HARVEST_TIMEOUT_FACTOR, and at least twice the last harvest if that one
+    was killed. Otherwise both fall back to the dataset count rule.
+    '''
+    fallback = get_harvest_timeout(datalen)
+    totals = [t['total'] for t in timings or []]
+    if len(totals) < app.config.get('HARVEST_MIN_HISTORY', 3):
+        return float(fallback), fallback
+
+    timeout = np.percentile(totals, app.config.get('HARVEST_TIMEOUT_PERCENTILE', 95))
+    timeout *= app.config.get('HARVEST_TIMEOUT_FACTOR', 2.)
+    if not timings[0].get('completed', True):
+        timeout = max(timeout, 2 * timings[0]['total'])
+    timeout = min(max(timeout, app.config.get('HARVEST_MIN_TIMEOUT', 180)),
+                  app.config.get('HARVEST_MAX_TIMEOUT', 6 * 3600))
+
+    return float(np.median(totals)), int(timeout)
+
+
+def queue_services(services, force=False):
+    '''
+    Hands harvests of the distinct services to the harvest scheduler, which
+    limits the number of concurrent harvests against each host across all
+    workers, since some hosts don't like successive repeated connections.
+
+    Timeouts and expected run times come from each service's harvest
+    history (see estimate_harvest), the dataset counts and history are read
+    once for the whole pass.
+
+    SOS services with more than HARVEST_BATCH_THRESHOLD datasets, or with a
+    batched harvest left unfinished, are harvested HARVEST_BATCH_SIZE
+    offerings per job (see queue_next_batch). Services whose batches are
+    still running are left alone.
+
+    With force, the services' fingerprints are forgotten so none of them is
+    skipped as not modified.
+    '''
+    services = distinct_services(services)
+    ids = [s._id for s in services]
+    if force:
+        db.Harvest.clear_fingerprints(ids)
+    counts = get_dataset_counts()
+    history = db.Harvest.get_timing_history(ids)
+    checkpoints = db.Harvest.get_checkpoints(ids)
+    threshold = app.config.get('HARVEST_BATCH_THRESHOLD', 200)
+    batch_size = app.config.get('HARVEST_BATCH_SIZE', 50)
+    # a chain of batches updates its checkpoint at least this often
+    running = datetime.utcnow() - timedelta(seconds=app.config.get('HARVEST_MAX_TIMEOUT', 6 * 3600))
+
+    jobs = []
+    for s in services:
+        datalen = counts.get(s._id, 0)
+        checkpoint = checkpoints.get(s._id)
+        if checkpoint and checkpoint['updated'] > running:
+            continue
+        batch = s.service_type == 'SOS' and (datalen > threshold or checkpoint is not None)
+        if batch:
+            datalen = min(datalen, batch_size)
+        expected, timeout = estimate_harvest(history.get(s._id), datalen)
+        jobs.append((s, timeout, expected, batch))
+    return schedule_harvests(jobs)
+
+
+def queue_next_batch(service_id):
+    '''
+    Schedules the next batch of a batched harvest if the last one finished
+    and offerings are left. A batch that was killed is not requeued, the
+    next queue_harvest_tasks pass resumes from its checkpoint.
+
+    Returns True if a batch was scheduled.
+    '''
+    harvest = db.Harvest.find_one({'service_id': ObjectId(service_id)})
+    if harvest is None or harvest.harvest_successful != HarvestStatus.IN_PROGRESS:
+        return False
+    checkpoint = harvest.get('checkpoint')
+    if not checkpoint:
+        return False
+
+    service = db.Service.find_one({'_id': ObjectId(service_id)})
+    expected, timeout = estimate_harvest(harvest.get('harvest_timings'), checkpoint['batch_size'])
+    schedule_harvests([(service, timeout, expected, True)])
+    return True
+
+
 def add_counts():
     """Returns a timestamped aggregated count"""
     collection = db.metric_counts
@@ -220,9 +312,29 @@ def add_counts():
     datasets_by_ra.save()
 
 
+def get_harvest_deadline():
+    '''
+    Returns the Deadline of a harvest, HARVEST_DEADLINE_MARGIN seconds
+    before its RQ job would be killed so the harvest can stop and record
+    what happened. Outside of a job there is no deadline.
+    '''
+    job = get_current_job()
+    if job is None or not job.timeout or job.timeout < 0:
+        return Deadline()
+    margin = app.config.get('HARVEST_DEADLINE_MARGIN', 30)
+    return Deadline(max(job.timeout - margin, job.timeout / 2.))
+
+
 @debug_wrapper
 @context_decorator
-def harvest(service_id, ignore_active=False):
+def harvest(service_id, ignore_active=False, batch=False, force=False):
+    '''
+    Harvests a service and copies the result to the services with the same
+    URL. With batch, only the next HARVEST_BATCH_SIZE offerings of an SOS
+    are harvested. With force, the service is harvested even if it hasn't
+    changed.
+    '''
+    batch_size = app.config.get('HARVEST_BATCH_SIZE', 50) if batch else None
 
     service = db.Service.find_one({'_id': ObjectId(service_id)})
 
@@ -232,21 +344,20 @@ def harvest(service_id, ignore_active=False):
         harvest = db.Harvest()
         harvest.service_id = ObjectId(service_id)
 
-    harvest.harvest(ignore_active=ignore_active)
-    harvest.save()
+    try:
+        harvest.harvest(ignore_active=ignore_active, batch_size=batch_size, force=force,
+                        deadline=get_harvest_deadline())
+    finally:
+        # keep the timing of a harvest that was killed
+        harvest.save()
 
-    for service in db.Service.find({"url": service.url, "_id": {"$ne": ObjectId(service_id)}}):
-        other_harvest = db.Harvest.find_one({'service_id': ObjectId(service._id)})
-        if other_harvest is None:
-            other_harvest = db.Harvest()
-            other_harvest.service_id = ObjectId(service._id)
-        elif other_harvest._id == harvest._id:
-            continue
-        other_harvest.harvest_date = harvest.harvest_date
-        other_harvest.harvest_status = harvest.harvest_status
-        other_harvest.harvest_successful = harvest.harvest_successful
-        other_harvest.harvest_messages = harvest.harvest_messages
-        other_harvest.save()
+    if service is not None:
+        # the services with the same canonical URL share this harvest
+        others = db.services.find({'$or': [{'canonical_url': get_canonical_url(service)},
+                                           {'url': service.url}],
+                                   '_id': {'$ne': ObjectId(service_id)}},
+                                  {'_id': 1})
+        harvest.copy_to([s['_id'] for s in others])
     return harvest.harvest_status
 
 
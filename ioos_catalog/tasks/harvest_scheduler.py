@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/tasks/harvest_scheduler.py
+
+Host-aware harvest scheduler. Harvest jobs are held in Redis in one pending
+list per host (Service.tld) and only handed to RQ while the host has fewer
+than HARVEST_PER_HOST harvests running, across all workers.
+
+A running harvest holds a lease on its host, a member of the host's lease
+sorted set scored by the time it expires (the job timeout plus
+HARVEST_LEASE_GRACE). Leases are given back when a harvest finishes, and
+expire on their own if a work horse is killed, so a host can't get stuck.
+
+Every finished harvest dispatches the next jobs, and manage.py
+harvest_dispatch can be run from cron to pick up after expired leases.
+
+To finish the run as early as possible, each host's jobs are kept longest
+first and the hosts with the most expected work left are dispatched first.
+The makespan predicted for a run is recorded along with the actual one, see
+manage.py harvest_makespan.
+'''
+from collections import defaultdict, deque
+import heapq
+import json
+import time
+
+from ioos_catalog import app, queues, redis_connection
+
+HOSTS_KEY = 'harvest_scheduler:hosts'           # set of hosts with pending or running harvests
+PENDING_KEY = 'harvest_scheduler:pending:%s'    # list of JSON jobs waiting for a host
+LEASES_KEY = 'harvest_scheduler:leases:%s'      # zset of service id -> lease expiry epoch
+WORK_KEY = 'harvest_scheduler:work'             # hash of host -> expected seconds of pending jobs
+RUN_KEY = 'harvest_scheduler:run'               # hash describing the run in progress
+RUNS_KEY = 'harvest_scheduler:runs'             # list of JSON finished runs, newest first
+
+# Atomically drops expired leases and, if the host has room, pops the next
+# pending job and leases the host for it.
+#   KEYS: leases, pending, work
+#   ARGV: now, per host limit, lease grace, host
+ACQUIRE_SCRIPT = '''
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[2]) then
+    return false
+end
+local job = redis.call('lpop', KEYS[2])
+if not job then
+    return false
+end
+local decoded = cjson.decode(job)
+redis.call('zadd', KEYS[1], tonumber(ARGV[1]) + decoded['timeout'] + tonumber(ARGV[3]), decoded['service_id'])
+redis.call('hincrbyfloat', KEYS[3], ARGV[4], -(decoded['expected'] or 0))
+return job
+'''
+
+# Atomically forgets a host with nothing pending or leased, so a job
+# scheduled for it meanwhile can't be stranded outside the hosts set.
+#   KEYS: pending, leases, hosts, work
+#   ARGV: host
+FORGET_SCRIPT = '''
+if redis.call('llen', KEYS[1]) > 0 or redis.call('zcard', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('srem', KEYS[3], ARGV[1])
+redis.call('hdel', KEYS[4], ARGV[1])
+return 1
+'''
+
+_acquire = None
+_forget = None
+
+
+def get_host(service):
+    return service.get('tld') or u'unknown'
+
+
+def get_host_limit(host):
+    '''
+    Returns the number of concurrent harvests allowed against host, from
+    HARVEST_HOST_LIMITS or else HARVEST_PER_HOST
+    '''
+    limits = app.config.get('HARVEST_HOST_LIMITS') or {}
+    return limits.get(host, app.config.get('HARVEST_PER_HOST', 2))
+
+
+def acquire(host, now=None, redis=None):
+    '''
+    Leases host for its next pending job and returns the job, or None if the
+    host is at its limit or has nothing pending
+    '''
+    global _acquire
+    redis = redis or redis_connection
+    if _acquire is None:
+        _acquire = redis_connection.register_script(ACQUIRE_SCRIPT)
+
+    job = _acquire(keys=[LEASES_KEY % host, PENDING_KEY % host, WORK_KEY],
+                   args=[now or time.time(),
+                         get_host_limit(host),
+                         app.config.get('HARVEST_LEASE_GRACE', 60),
+                         host],
+                   client=redis)
+    if not job:
+        return None
+    return json.loads(job)
+
+
+def forget_host(host, redis=None):
+    '''
+    Removes host from the scheduled hosts if it has nothing pending or
+    running. Returns True if it was removed.
+    '''
+    global _forget
+    redis = redis or redis_connection
+    if _forget is None:
+        _forget = redis_connection.register_script(FORGET_SCRIPT)
+    return bool(_forget(keys=[PENDING_KEY % host, LEASES_KEY % host, HOSTS_KEY, WORK_KEY],
+                        args=[host], client=redis))
+
+
+def release(host, service_id, redis=None):
+    redis = redis or redis_connection
+    redis.zrem(LEASES_KEY % host, str(service_id))
+
+
+def schedule_harvests(jobs, redis=None):
+    '''
+    Adds harvest jobs to the pending lists of their hosts, longest first,
+    and dispatches as many as the hosts allow.
+
+    jobs is a list of (service, timeout seconds, expected seconds, batch)
+    tuples, batch is True to harvest the service one batch at a time.
+    '''
+    redis = redis or redis_connection
+    jobs = sorted(jobs, key=lambda j: -j[2])
+    now = time.time()
+
+    pipe = redis.pipeline()
+    for service, timeout, expected, batch in jobs:
+        host = get_host(service)
+        pipe.rpush(PENDING_KEY % host, json.dumps({'service_id': str(service._id),
+                                                   'timeout': int(timeout),
+                                                   'expected': float(expected),
+                                                   'batch': bool(batch)}))
+        pipe.hincrbyfloat(WORK_KEY, host, float(expected))
+        pipe.sadd(HOSTS_KEY, host)
+    pipe.execute()
+
+    start_run(jobs, now, redis=redis)
+    return dispatch(redis=redis)
+
+
+def dispatch(redis=None):
+    '''
+    Enqueues the pending harvests of every host that has room, hosts with
+    the most expected work left first. Hosts with nothing pending or running
+    are forgotten, and the run is finished when no host is left.
+
+    Returns the number of harvests enqueued.
+    '''
+    redis = redis or redis_connection
+    work = redis.hgetall(WORK_KEY)
+    hosts = sorted(redis.smembers(HOSTS_KEY), key=lambda h: -float(work.get(h) or 0))
+    enqueued = 0
+    for host in hosts:
+        while True:
+            job = acquire(host, redis=redis)
+            if job is None:
+                break
+            queues['harvests'].enqueue_call(harvest_job,
+                                            args=(job['service_id'], host, job.get('batch', False)),
+                                            timeout=job['timeout'])
+            enqueued += 1
+
+        forget_host(host, redis=redis)
+
+    if not redis.scard(HOSTS_KEY):
+        finish_run(redis=redis)
+
+    return enqueued
+
+
+def predict_makespan(jobs, workers):
+    '''
+    Returns the predicted seconds to run jobs, a list of (host, expected
+    seconds), on a number of workers, simulating the way dispatch hands them
+    out under the per host limits.
+    '''
+    pending = defaultdict(list)
+    for host, expected in jobs:
+        pending[host].append(expected)
+    work = {}
+    for host in pending:
+        pending[host] = deque(sorted(pending[host], reverse=True))
+        work[host] = sum(pending[host])
+
+    running = defaultdict(int)
+    finishing = []
+    now = 0.
+    free = max(workers, 1)
+    while pending or finishing:
+        startable = [h for h in pending if running[h] < get_host_limit(h)]
+        if free and startable:
+            host = max(startable, key=lambda h: work[h])
+            expected = pending[host].popleft()
+            work[host] -= expected
+            if not pending[host]:
+                del pending[host]
+            running[host] += 1
+            free -= 1
+            heapq.heappush(finishing, (now + expected, host))
+            continue
+
+        now, host = heapq.heappop(finishing)
+        running[host] -= 1
+        free += 1
+
+    return now
+
+
+def start_run(jobs, now=None, redis=None):
+    '''
+    Records the start and predicted makespan of a run, or extends the run in
+    progress with more jobs
+    '''
+    redis = redis or redis_connection
+    now = now or time.time()
+    predicted = predict_makespan([(get_host(j[0]), j[2]) for j in jobs],
+                                 app.config.get('HARVEST_WORKERS', 4))
+    run = redis.hgetall(RUN_KEY)
+    if run:
+        predicted_end = max(float(run['predicted_end']), now + predicted)
+        redis.hmset(RUN_KEY, {'predicted_end': predicted_end,
+                              'jobs': int(run['jobs']) + len(jobs)})
+    else:
+        redis.hmset(RUN_KEY, {'started': now,
+                              'predicted_end': now + predicted,
+                              'jobs': len(jobs)})
+
+
+def finish_run(now=None, redis=None):
+    '''
+    Moves the run in progress to the list of finished runs
+    '''
+    redis = redis or redis_connection
+    run = redis.hgetall(RUN_KEY)
+    if not run or not redis.delete(RUN_KEY):
+        return
+    now = now or time.time()
+    started = float(run['started'])
+    record = {'started': started,
+              'jobs': int(run['jobs']),
+              'predicted': float(run['predicted_end']) - started,
+              'actual': now - started}
+    redis.lpush(RUNS_KEY, json.dumps(record))
+    redis.ltrim(RUNS_KEY, 0, 29)
+    app.logger.info("Harvest run of %(jobs)d jobs took %(actual)ds, predicted %(predicted)ds", record)
+
+
+def get_makespan_report(redis=None):
+    '''
+    Returns (run in progress or None, finished runs newest first), as dicts
+    of started, jobs, predicted and actual (seconds, actual is elapsed so far
+    for the run in progress)
+    '''
+    redis = redis or redis_connection
+    current = redis.hgetall(RUN_KEY)
+    if current:
+        started = float(current['started'])
+        current = {'started': started,
+                   'jobs': int(current['jobs']),
+                   'predicted': float(current['predicted_end']) - started,
+                   'actual': time.time() - started}
+    else:
+        current = None
+    return current, [json.loads(r) for r in redis.lrange(RUNS_KEY, 0, -1)]
+
+
+def harvest_job(service_id, host, batch=False):
+    '''
+    Harvests a service under a lease on its host, then gives the lease back
+    and dispatches the next jobs, starting with the next batch of a batched
+    harvest
+    '''
+    from ioos_catalog.tasks.harvest import harvest, queue_next_batch
+    try:
+        return harvest(service_id, batch=batch)
+    finally:
+        with app.app_context():
+            release(host, service_id)
+            # scheduling a batch dispatches as well
+            if not (batch and queue_next_batch(service_id)):
+                dispatch()
+
+
+def harvest_queue_depths(redis=None):
+    '''
+    Returns a dict of host -> {'pending': jobs waiting, 'running': leases
+    held, 'limit': concurrent harvests allowed}
+    '''
+    redis = redis or redis_connection
+    now = time.time()
+    depths = {}
+    for host in redis.smembers(HOSTS_KEY):
+        pipe = redis.pipeline()
+        pipe.llen(PENDING_KEY % host)
+        pipe.zcount(LEASES_KEY % host, now, '+inf')
+        pending, running = pipe.execute()
+        depths[host] = {'pending': pending,
+                        'running': running,
+                        'limit': get_host_limit(host)}
+    return depths
+
+
+def clear_harvest_schedule(redis=None):
+    '''
+    Drops every pending harvest and lease
+    '''
+    redis = redis or redis_connection
+    for host in redis.smembers(HOSTS_KEY):
+        redis.delete(PENDING_KEY % host, LEASES_KEY % host)
+    redis.delete(HOSTS_KEY, WORK_KEY, RUN_KEY)
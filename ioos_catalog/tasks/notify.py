@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/tasks/notify.py
+
+Status change notification aggregator. Instead of one email job per flipped
+service, flips are collected in Redis and sent as one digest per recipient
+list once NOTIFY_WINDOW seconds have passed since the first flip of the
+batch. When a shared host goes down, the services behind it go out in a
+single email.
+'''
+from bson import ObjectId
+from datetime import datetime
+import calendar
+import json
+import time
+
+from ioos_catalog import app, queues, redis_connection
+from ioos_catalog.tasks.send_email import send_status_digest
+
+FLIPS_KEY = 'notify:flips'    # list of JSON encoded flips waiting for a digest
+FIRST_KEY = 'notify:first'    # epoch of the first flip waiting for a digest
+
+
+def record_flips(recorded, redis=None):
+    '''
+    Adds the status flips in a batch of recorded pings (the tuples returned by
+    PingLatest.ingest) to the pending digest.
+
+    Services going down are always reported, services coming back up only if
+    NOTIFY_RECOVERIES is set.
+
+    Returns the number of flips recorded.
+    '''
+    redis = redis or redis_connection
+    recoveries = app.config.get('NOTIFY_RECOVERIES', False)
+
+    flips = []
+    for r, wasnew, last in recorded:
+        if last is None or bool(last) == bool(r.operational_status):
+            continue
+        if r.operational_status and not recoveries:
+            continue
+        flips.append(json.dumps({'service_id': str(r.service_id),
+                                 'status': bool(r.operational_status),
+                                 'time': calendar.timegm(r.dt.timetuple())}))
+
+    if flips:
+        pipe = redis.pipeline()
+        pipe.rpush(FLIPS_KEY, *flips)
+        pipe.setnx(FIRST_KEY, time.time())
+        pipe.execute()
+
+    return len(flips)
+
+
+def queue_digest_if_due(redis=None, now=None):
+    '''
+    Queues a digest if the oldest pending flip is older than NOTIFY_WINDOW.
+    Safe to call from every ping batch, only one caller wins the digest.
+
+    Returns True if a digest was queued.
+    '''
+    redis = redis or redis_connection
+    now = now or time.time()
+    first = redis.get(FIRST_KEY)
+    if first is None or now - float(first) < app.config.get('NOTIFY_WINDOW', 300):
+        return False
+
+    # whoever deletes the marker sends the digest
+    if not redis.delete(FIRST_KEY):
+        return False
+
+    queues['email'].enqueue(flush_status_digest)
+    return True
+
+
+def take_flips(redis=None):
+    '''
+    Atomically removes and returns the pending flips, folded to one entry per
+    service in the order they first flipped: the status it flipped to last and
+    how many times it flipped.
+    '''
+    redis = redis or redis_connection
+    pipe = redis.pipeline()
+    pipe.lrange(FLIPS_KEY, 0, -1)
+    pipe.delete(FLIPS_KEY)
+    raw, _ = pipe.execute()
+
+    folded = {}
+    order = []
+    for item in raw:
+        flip = json.loads(item)
+        sid = flip['service_id']
+        if sid not in folded:
+            order.append(sid)
+            folded[sid] = {'service_id': ObjectId(sid),
+                           'status': flip['status'],
+                           'flips': 0,
+                           'first_time': flip['time'],
+                           'last_time': flip['time']}
+        entry = folded[sid]
+        entry['status'] = flip['status']
+        entry['flips'] += 1
+        entry['last_time'] = flip['time']
+
+    return [folded[sid] for sid in order]
+
+
+def flush_status_digest():
+    '''
+    Sends the digest of every pending flip. Returns the number of emails sent.
+    '''
+    with app.app_context():
+        flips = take_flips()
+        if not flips:
+            return 0
+
+        start_time = datetime.utcfromtimestamp(min(f['first_time'] for f in flips))
+        end_time = datetime.utcfromtimestamp(max(f['last_time'] for f in flips))
+        sent = send_status_digest(flips, start_time, end_time)
+        app.logger.info("Sent %s status digest(s) for %s services", sent, len(flips))
+        return sent
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/tasks/ping_engine.py
+
+Concurrent ping engine. Pings every active service from a single process,
+caps the number of in-flight requests per host (grouped by Service.tld) and
+hands the results back in batches.
+'''
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+from Queue import Queue, Empty
+import time
+
+from ioos_catalog import app, db, http_client
+from ioos_catalog.tasks.stat import PingResult, ping_service, record_ping_results
+
+
+class PingEngine(object):
+    '''
+    Pings a list of services concurrently with a pool of threads.
+
+    Services are grouped by their tld and at most ``per_host`` requests are
+    in flight against the same host at any time. Hosts are served round-robin
+    so that a host with hundreds of services doesn't starve the others.
+
+    Results are collected on the calling thread and handed to ``flush`` in
+    batches of ``batch_size`` (or whatever has accumulated after
+    ``flush_interval`` seconds).
+    '''
+
+    def __init__(self, workers=None, per_host=None, batch_size=None,
+                 timeout=None, flush_interval=None):
+        self.workers = workers or app.config.get('PING_WORKERS', 64)
+        self.per_host = per_host or app.config.get('PING_PER_HOST', 4)
+        self.batch_size = batch_size or app.config.get('PING_BATCH_SIZE', 200)
+        self.timeout = timeout or app.config.get('PING_TIMEOUT', 15)
+        self.flush_interval = flush_interval or app.config.get('PING_FLUSH_INTERVAL', 5)
+
+        self._cond = Condition()
+        self._pending = {}          # tld -> deque of services
+        self._hosts = deque()       # hosts with pending services, round-robin
+        self._inflight = defaultdict(int)
+        self._results = Queue()
+
+    def run(self, services):
+        '''
+        Pings every service in ``services`` and blocks until all of the
+        results have been flushed.
+
+        Returns a dict of summary statistics for the sweep.
+        '''
+        stats = {'pinged': 0,
+                 'up': 0,
+                 'down': 0,
+                 'hosts': 0,
+                 'batches': 0,
+                 'elapsed': 0.}
+        start = time.time()
+
+        for service in services:
+            tld = service.get('tld') or u''
+            self._pending.setdefault(tld, deque()).append(service)
+        self._hosts = deque(self._pending)
+        stats['hosts'] = len(self._hosts)
+
+        remaining = len(services)
+        threads = [Thread(target=self._work)
+                   for _ in xrange(min(self.workers, remaining))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        batch = []
+        last_flush = time.time()
+        while remaining:
+            try:
+                result = self._results.get(timeout=self.flush_interval)
+            except Empty:
+                result = None
+
+            if result is not None:
+                remaining -= 1
+                batch.append(result)
+                stats['pinged'] += 1
+                if result.operational_status:
+                    stats['up'] += 1
+                else:
+                    stats['down'] += 1
+
+            if batch and (len(batch) >= self.batch_size or
+                          time.time() - last_flush >= self.flush_interval):
+                self._flush(batch)
+                stats['batches'] += 1
+                batch = []
+                last_flush = time.time()
+
+        if batch:
+            self._flush(batch)
+            stats['batches'] += 1
+
+        for t in threads:
+            t.join()
+
+        stats['elapsed'] = time.time() - start
+        return stats
+
+    def flush(self, results):
+        '''
+        Persists a batch of PingResults. Override to change where results go.
+        '''
+        return record_ping_results(results)
+
+    def ping(self, service):
+        '''
+        Pings a single service and returns a PingResult. Never raises.
+        '''
+        try:
+            return ping_service(service, timeout=self.timeout)
+        except Exception:
+            app.logger.exception("Unexpected failure pinging %s", service.get('url'))
+            return PingResult(service._id, datetime.utcnow(), None, -1, False, None)
+
+    def _flush(self, batch):
+        try:
+            self.flush(batch)
+        except Exception:
+            app.logger.exception("Failed to record a batch of %s pings", len(batch))
+
+    def _next_service(self):
+        '''
+        Blocks until a service whose host has a free slot is available.
+        Returns a (tld, service) tuple, or None when there is nothing left.
+        '''
+        with self._cond:
+            while True:
+                if not self._hosts:
+                    return None
+                for _ in xrange(len(self._hosts)):
+                    tld = self._hosts[0]
+                    self._hosts.rotate(-1)
+                    if self._inflight[tld] >= self.per_host:
+                        continue
+                    pending = self._pending[tld]
+                    service = pending.popleft()
+                    if not pending:
+                        # the host we just rotated is now at the end
+                        self._hosts.pop()
+                    self._inflight[tld] += 1
+                    return tld, service
+                self._cond.wait()
+
+    def _release(self, tld):
+        with self._cond:
+            self._inflight[tld] -= 1
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            job = self._next_service()
+            if job is None:
+                return
+            tld, service = job
+            try:
+                result = self.ping(service)
+            finally:
+                self._release(tld)
+            self._results.put(result)
+
+
+def ping_all_services():
+    '''
+    Pings every active service in a single pass of the ping engine.
+    '''
+    with app.app_context():
+        services = list(db.Service.find({'active': True},
+                                        {'_id': True,
+                                         'url': True,
+                                         'tld': True,
+                                         'service_type': True}))
+        stats = PingEngine().run(services)
+        stats['http'] = http_client.pool_stats()['_total']
+        app.logger.info("Ping sweep: %(pinged)s services (%(up)s up, %(down)s down) "
+                        "across %(hosts)s hosts in %(elapsed).1fs", stats)
+        app.logger.info("Ping sweep: %(requests)s requests over %(connections)s "
+                        "connections (%(reused)s reused)", stats['http'])
+        return stats
+
+
+def run_ping_engine(forever=False):
+    '''
+    Runs a ping sweep. If forever is set, keeps running a sweep at the top of
+    every hour.
+    '''
+    while True:
+        ping_all_services()
+        if not forever:
+            return
+        now = datetime.utcnow()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        time.sleep((next_hour - now).total_seconds())
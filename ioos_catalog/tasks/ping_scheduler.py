@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/tasks/ping_scheduler.py
+
+Interval-aware ping scheduler. Instead of pinging every service at the top of
+the hour, every service is pinged on its own Service.interval, spread across
+the period with jitter.
+
+The schedule lives in Redis as a sorted set of service ids scored by the epoch
+time they are next due, so it survives restarts of the daemon.
+
+  * Services that have been down for a while are backed off exponentially,
+    up to PING_MAX_INTERVAL.
+  * Right after a service flips up or down it is pinged every
+    PING_FLIP_INTERVAL seconds for PING_FLIP_WINDOW seconds, to confirm the
+    new status quickly.
+'''
+from bson import ObjectId
+from random import uniform
+import time
+
+from ioos_catalog import app, db, redis_connection
+from ioos_catalog.tasks.ping_engine import PingEngine
+
+SCHEDULE_KEY = 'ping_scheduler:schedule'    # zset of service id -> next due epoch
+FAILURES_KEY = 'ping_scheduler:failures'    # hash of service id -> consecutive failed pings
+FLIPS_KEY = 'ping_scheduler:flips'          # hash of service id -> epoch of last status flip
+
+
+class SchedulerPingEngine(PingEngine):
+    '''
+    Ping engine that keeps what was recorded so the scheduler can reschedule
+    '''
+
+    def __init__(self, *args, **kwargs):
+        PingEngine.__init__(self, *args, **kwargs)
+        self.recorded = []
+
+    def flush(self, results):
+        recorded = PingEngine.flush(self, results)
+        self.recorded.extend(recorded or [])
+        return recorded
+
+
+class PingScheduler(object):
+
+    def __init__(self, redis=None):
+        self.redis = redis or redis_connection
+        self.tick = app.config.get('PING_SCHEDULER_TICK', 15)
+        self.sync_every = app.config.get('PING_SCHEDULER_SYNC', 300)
+        self.default_interval = app.config.get('PING_DEFAULT_INTERVAL', 3600)
+        self.min_interval = app.config.get('PING_MIN_INTERVAL', 60)
+        self.max_interval = app.config.get('PING_MAX_INTERVAL', 6 * 3600)
+        self.jitter = app.config.get('PING_JITTER', 0.1)
+        self.backoff_after = app.config.get('PING_BACKOFF_AFTER', 3)
+        self.flip_interval = app.config.get('PING_FLIP_INTERVAL', 300)
+        self.flip_window = app.config.get('PING_FLIP_WINDOW', 3600)
+        self.last_sync = 0
+
+    def get_interval(self, service):
+        interval = service.get('interval') or self.default_interval
+        return max(interval, self.min_interval)
+
+    def sync(self, now=None):
+        '''
+        Adds newly active services to the schedule at a random offset within
+        their interval, and drops services that are no longer active.
+        '''
+        now = now or time.time()
+        active = {str(s._id): s for s in db.Service.find({'active': True},
+                                                          {'_id': True,
+                                                           'interval': True})}
+        scheduled = set(self.redis.zrange(SCHEDULE_KEY, 0, -1))
+
+        new = {sid: now + uniform(0, self.get_interval(s))
+               for sid, s in active.iteritems() if sid not in scheduled}
+        stale = [sid for sid in scheduled if sid not in active]
+
+        pipe = self.redis.pipeline()
+        if new:
+            pipe.zadd(SCHEDULE_KEY, **new)
+        if stale:
+            pipe.zrem(SCHEDULE_KEY, *stale)
+            pipe.hdel(FAILURES_KEY, *stale)
+            pipe.hdel(FLIPS_KEY, *stale)
+        pipe.execute()
+
+        self.last_sync = now
+        app.logger.info("Ping scheduler: %s services scheduled, %s added, %s removed",
+                        len(active), len(new), len(stale))
+
+    def next_interval(self, service, result, failures, flipped_at, now):
+        '''
+        Returns the number of seconds until the service should be pinged again
+        '''
+        interval = self.get_interval(service)
+
+        if not result.operational_status and failures > self.backoff_after:
+            interval = min(interval * 2 ** (failures - self.backoff_after),
+                           max(self.max_interval, interval))
+
+        if flipped_at is not None and now - flipped_at < self.flip_window:
+            interval = min(interval, self.flip_interval)
+
+        return interval * uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reschedule(self, services, recorded, now=None):
+        now = now or time.time()
+        if not recorded:
+            return
+
+        sids = [str(r.service_id) for r, _, _ in recorded]
+        failures = dict(zip(sids, self.redis.hmget(FAILURES_KEY, sids)))
+        flips = dict(zip(sids, self.redis.hmget(FLIPS_KEY, sids)))
+
+        schedule = {}
+        pipe = self.redis.pipeline()
+        for r, wasnew, last_status in recorded:
+            sid = str(r.service_id)
+
+            if r.operational_status:
+                failed = 0
+                pipe.hdel(FAILURES_KEY, sid)
+            else:
+                failed = int(failures.get(sid) or 0) + 1
+                pipe.hset(FAILURES_KEY, sid, failed)
+
+            flipped_at = float(flips[sid]) if flips.get(sid) else None
+            if last_status is not None and bool(last_status) != bool(r.operational_status):
+                flipped_at = now
+                pipe.hset(FLIPS_KEY, sid, now)
+
+            schedule[sid] = now + self.next_interval(services[sid], r, failed,
+                                                     flipped_at, now)
+
+        pipe.zadd(SCHEDULE_KEY, **schedule)
+        pipe.execute()
+
+    def run_once(self, now=None):
+        '''
+        Pings every service that is due. Returns the number of services pinged.
+        '''
+        now = now or time.time()
+        if now - self.last_sync >= self.sync_every:
+            self.sync(now)
+
+        due = self.redis.zrangebyscore(SCHEDULE_KEY, 0, now)
+        if not due:
+            return 0
+
+        # Push the due services out of the way while they're pinged, so a
+        # sweep that outlasts a tick doesn't pick them up again
+        self.redis.zadd(SCHEDULE_KEY, **{sid: now + self.default_interval for sid in due})
+
+        services = {str(s._id): s for s in db.Service.find({'_id': {'$in': map(ObjectId, due)},
+                                                            'active': True},
+                                                           {'_id': True,
+                                                            'url': True,
+                                                            'tld': True,
+                                                            'service_type': True,
+                                                            'interval': True})}
+        engine = SchedulerPingEngine()
+        engine.run(services.values())
+        self.reschedule(services, engine.recorded)
+
+        return len(services)
+
+    def run(self):
+        '''
+        Runs the scheduler until interrupted
+        '''
+        while True:
+            start = time.time()
+            with app.app_context():
+                try:
+                    pinged = self.run_once(start)
+                    if pinged:
+                        app.logger.info("Ping scheduler: pinged %s services", pinged)
+                except Exception:
+                    app.logger.exception("Ping scheduler tick failed")
+            time.sleep(max(self.tick - (time.time() - start), 0))
+
+
+def run_ping_scheduler():
+    PingScheduler().run()
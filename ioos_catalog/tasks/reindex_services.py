@@ -7,11 +7,11 @@ from collections import namedtuple
 from hashlib import sha1
 from owslib.iso import MD_Metadata
 from lxml import etree
-from ioos_catalog import app, db
+from ioos_catalog import app, db, http_client
+from ioos_catalog.util import canonical_url
 from datetime import datetime, timedelta
 
 import ckanapi
-import requests
 import re
 
 PROTOCOLS = {
@@ -121,7 +121,7 @@ def get_urls(service):
         url = unicode(service['url'])
     elif erddap_match:
         test_url = erddap_match.group(1) + '.iso19115'
-        req = requests.get(test_url)
+        req = http_client.get(test_url)
         # if we have a valid ERDDAP metadata endpoint,
         # store it.
         if req.status_code == 200:
@@ -185,6 +185,7 @@ def index_service(record, organization, service):
         s.service_type = PROTOCOLS[service['resource_locator_protocol']]
     s.interval = 3600  # 1 hour
     s.tld = unicode(urlparse(urls.url).netloc)
+    s.canonical_url = canonical_url(s.url)
     s.updated = datetime.utcnow()
     s.contact = extras.get('contact-email', '')
     s.metadata_url = urls.metadata_url
@@ -4,12 +4,36 @@ from flask import render_template
 from collections import defaultdict
 from datetime import datetime, timedelta
 
-def send(subject, recipients, cc_recipients, text_body, html_body):
+def build_message(subject, recipients, cc_recipients, text_body, html_body):
     # sender comes from MAIL_DEFAULT_SENDER in env
     msg = Message(subject, recipients=recipients, cc=cc_recipients)
     msg.body = text_body
     msg.html = html_body
-    mail.send(msg)
+    return msg
+
+def send(subject, recipients, cc_recipients, text_body, html_body):
+    mail.send(build_message(subject, recipients, cc_recipients, text_body, html_body))
+
+def send_messages(messages):
+    """
+    Sends a list of Messages over a single SMTP connection
+    """
+    if not messages:
+        return
+    with mail.connect() as conn:
+        for msg in messages:
+            conn.send(msg)
+
+def get_status_recipients(service):
+    """
+    Returns the (to, cc) addresses for status alerts about a service
+    """
+    to_addresses = [app.config.get("MAIL_DEFAULT_LIST")] if app.config.get('MAILER_DEBUG') == False else [app.config.get("MAIL_DEFAULT_TO")]
+    # Don't send these until Anna updates the ISO document in GeoPortal with the correct service contacts
+    #if app.config.get('MAILER_DEBUG') == False and service.contact is not None:
+    #    to_addresses = service.contact.split(",")
+    cc_addresses = [app.config.get("MAIL_DEFAULT_TO")]
+    return to_addresses, cc_addresses
 
 def send_service_down_email(service_id):
     with app.app_context():
@@ -23,11 +47,7 @@ def send_service_down_email(service_id):
         text_template = render_template("service_status_changed.txt", **kwargs)
         html_template = render_template("service_status_changed.html", **kwargs)
 
-        to_addresses = [app.config.get("MAIL_DEFAULT_LIST")] if app.config.get('MAILER_DEBUG') == False else [app.config.get("MAIL_DEFAULT_TO")]
-        # Don't send these until Anna updates the ISO document in GeoPortal with the correct service contacts
-        #if app.config.get('MAILER_DEBUG') == False and kwargs['service'].contact is not None:
-        #    to_addresses = kwargs['service'].contact.split(",")
-        cc_addresses = [app.config.get("MAIL_DEFAULT_TO")]
+        to_addresses, cc_addresses = get_status_recipients(kwargs['service'])
 
         send(subject,
              to_addresses,
@@ -35,6 +55,46 @@ def send_service_down_email(service_id):
              text_template,
              html_template)
 
+def send_status_digest(flips, start_time, end_time):
+    """
+    Sends one digest of status changes per recipient list, all over one SMTP
+    connection.
+
+    flips is a list of dicts with service_id, status (the status the service
+    flipped to last) and flips (how many times it flipped in the window).
+    """
+    with app.app_context():
+        service_ids = [f['service_id'] for f in flips]
+        services = {s._id: s for s in db.Service.find({'_id': {'$in': service_ids}})}
+        stats = {p.service_id: p for p in db.PingLatest.find({'service_id': {'$in': service_ids}})}
+
+        groups = defaultdict(list)
+        for f in flips:
+            service = services.get(f['service_id'])
+            if service is None:
+                continue
+            to_addresses, cc_addresses = get_status_recipients(service)
+            groups[(tuple(to_addresses), tuple(cc_addresses))].append(
+                dict(f, service=service, stat=stats.get(f['service_id'])))
+
+        messages = []
+        for (to_addresses, cc_addresses), entries in groups.iteritems():
+            entries.sort(key=lambda e: (e['status'], e['service'].data_provider, e['service'].name))
+            down = len([e for e in entries if not e['status']])
+            up = len(entries) - down
+            kwargs = {'entries'    : entries,
+                      'start_time' : start_time,
+                      'end_time'   : end_time}
+            subject = "[ioos] Service Status Alert: %s DOWN, %s UP" % (down, up)
+            messages.append(build_message(subject,
+                                          list(to_addresses),
+                                          list(cc_addresses),
+                                          render_template("service_status_digest.txt", **kwargs),
+                                          render_template("service_status_digest.html", **kwargs)))
+
+        send_messages(messages)
+        return len(messages)
+
 def send_daily_report_email(end_time=None, start_time=None):
     with app.app_context():
 
@@ -1,36 +1,89 @@
+from collections import namedtuple
 from datetime import datetime
-from ioos_catalog import app, db, queue
+from ioos_catalog import app, db, queue, queues
 from bson import ObjectId
-from ioos_catalog.tasks.send_email import send_service_down_email
+from ioos_catalog.tasks.notify import record_flips, queue_digest_if_due
+
+import requests
+
+
+PingResult = namedtuple('PingResult', ['service_id',
+                                       'dt',
+                                       'response_time',
+                                       'response_code',
+                                       'operational_status',
+                                       'timings'])
+
+
+def ping_service(service, timeout=15):
+    """
+    Pings a service and returns a PingResult. Network failures are recorded as
+    a down service rather than raised.
+    """
+    dt = datetime.utcnow()
+    try:
+        response_code, timings = service.timed_ping(timeout=timeout)
+        response_time = int(round(timings['total']))
+        operational_status = True if response_code in [200, 400] else False
+    except (requests.ConnectionError, requests.HTTPError, requests.Timeout):
+        response_time = None
+        response_code = -1
+        operational_status = False
+        timings = None
+
+    return PingResult(service._id, dt, response_time, response_code,
+                      operational_status, timings)
 
 def ping_service_task(service_id):
     with app.app_context():
+        service = db.Service.find_one({'_id': ObjectId(service_id)})
+        assert service is not None
+
+        result = ping_service(service)
+        record_ping_results([result])
 
-        pl = db.PingLatest.get_for_service(ObjectId(service_id))
-        wasnew, flip = pl.ping_service()
-        pl.save()
+        return result.response_time
 
-        # save to WeeklyArchive
-        if wasnew:
-            utcnow = datetime.utcnow()
-            pa = db.PingArchive.get_for_service(ObjectId(service_id), utcnow)
-            pa.add_ping_data(pl.last_response_time, pl.last_operational_status)
-            pa.updated = utcnow
-            pa.save()
+def record_ping_results(results):
+    """
+    Records a batch of PingResults.
+
+    PingLatest, PingArchive and PingRollup are each written with one
+    unordered bulk operation for the whole batch. Status flips are added to
+    the pending notification digest (see tasks/notify.py).
+
+    Returns the list of (result, wasnew, last_status) tuples from
+    PingLatest.ingest.
+    """
+    with app.app_context():
+        recorded = db.PingLatest.ingest(results)
 
-        if flip:
-            queue.enqueue(send_service_down_email, ObjectId(service_id))
+        db.PingArchive.ingest([r for r, wasnew, last in recorded if wasnew])
+        db.PingRollup.ingest([r for r, wasnew, last in recorded])
 
-        return pl.last_response_time
+        record_flips(recorded)
+        queue_digest_if_due()
+
+        return recorded
 
 def queue_ping_tasks():
     """
-    Generate a number of ping tasks.
+    Queues a single sweep of the ping engine, which pings every active service
+    from one job.
 
-    Meant to be called via cron. Only queues services that are active.
+    Meant to be called via cron.
     """
+    from ioos_catalog.tasks.ping_engine import ping_all_services
+    with app.app_context():
+        queues['pings'].enqueue_call(ping_all_services,
+                                     timeout=app.config.get('PING_SWEEP_TIMEOUT', 3600))
+
+def prune_ping_rollups():
     with app.app_context():
-        sids = [s._id for s in db.Service.find({'active':True}, {'_id':True})]
-        for sid in sids:
-            queue.enqueue(ping_service_task, sid)
+        removed = db.PingRollup.prune()
+        app.logger.info("Pruned ping rollups: %s", removed)
+        return removed
 
+def queue_prune_ping_rollups():
+    with app.app_context():
+        queue.enqueue(prune_ping_rollups)
@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 '''
 ioos_catalog/timeout.py
+
+Deadlines for harvests. A Deadline is a point in wall clock time that is
+handed down to every remote call a harvest makes, which caps its own timeout
+by the time remaining. Unlike signal.alarm it works in any thread, nests,
+and pickles into process pools (it is only an epoch), and it never changes
+once made, so threads can share one freely.
 '''
 
-import signal
+import time
 
 try:
     TimeoutError
@@ -13,17 +19,63 @@ except NameError:
         pass
 
 
-class Timeout:
-    def __init__(self, seconds=1, error_message='Timeout'):
-        self.seconds = seconds
-        self.error_message = error_message
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline(object):
+    '''
+    The time by which a piece of work has to be done. A Deadline of None
+    seconds never expires.
+    '''
+
+    def __init__(self, seconds=None, expires=None):
+        if expires is None and seconds is not None:
+            expires = time.time() + seconds
+        self.expires = expires
+
+    def __repr__(self):
+        return 'Deadline(remaining=%r)' % self.remaining()
+
+    def child(self, seconds):
+        '''
+        Returns a Deadline seconds from now, or this one if it is sooner
+        '''
+        if seconds is None:
+            return self
+        expires = time.time() + seconds
+        if self.expires is not None:
+            expires = min(expires, self.expires)
+        return Deadline(expires=expires)
+
+    def remaining(self):
+        '''
+        Returns the seconds left, or None if there is no deadline
+        '''
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0.)
 
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
 
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
+    def check(self, what='Harvest'):
+        '''
+        Raises DeadlineExceeded if the deadline has passed
+        '''
+        if self.expired():
+            raise DeadlineExceeded('%s exceeded its deadline' % what)
 
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+    def timeout(self, cap=None):
+        '''
+        Returns the timeout in seconds for a blocking call, the time remaining
+        capped to cap, or cap if there is no deadline. Raises
+        DeadlineExceeded if no time is left.
+        '''
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if cap is None:
+            return remaining
+        return min(remaining, cap)
@@ -6,6 +6,7 @@ A python module containing useful methods
 
 from urllib import urlencode
 from flask import request
+import urlparse
 from math import ceil
 from numbers import Number
 from collections import Set, Mapping, deque
@@ -61,6 +62,43 @@ def build_url(url, query):
     return url
 
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonical_url(url):
+    '''
+    Returns url in a canonical form so that URLs that differ only trivially
+    compare equal: surrounding whitespace, the case of the scheme and host,
+    a default port, the order of the query parameters, an empty query or
+    a fragment.
+
+    :param str url: URL
+    :rtype: unicode
+    '''
+    if not url:
+        return url
+    if isinstance(url, str):
+        url = url.decode('utf-8')
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        # an IPv6 address
+        netloc = '[' + netloc + ']'
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':%d' % parts.port
+    # the pairs are sorted as they are, decoding and encoding them again
+    # would change them and fails on non-ASCII text
+    pairs = [p.partition('=') for p in parts.query.split('&') if p]
+    query = '&'.join(''.join(p) for p in sorted(pairs, key=lambda p: (p[0].lower(), p[0], p[2])))
+    return unicode(urlparse.urlunsplit((scheme, netloc, parts.path or '/', query, '')))
+
+
 zero_depth_bases = (basestring, Number, xrange, bytearray)
 iteritems = 'iteritems'
 
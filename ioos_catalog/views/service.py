@@ -9,12 +9,12 @@ from wtforms import TextField, IntegerField, SelectField, BooleanField
 from bson import json_util, ObjectId
 
 from ioos_catalog.models.harvests import HarvestStatus
-from ioos_catalog import app, db, queue, support_jsonp, requires_auth
+from ioos_catalog import app, db, queues, support_jsonp, requires_auth
 from ioos_catalog.models.stat import Stat
 from ioos_catalog.tasks.stat import ping_service_task
 from ioos_catalog.tasks.reindex_services import reindex_services
 from ioos_catalog.tasks.harvest import harvest
-from ioos_catalog.util import build_links
+from ioos_catalog.util import build_links, canonical_url
 
 
 class ServiceForm(Form):
@@ -104,7 +104,8 @@ def services(filter_provider, filter_type, oformat):
         tld_stats[k] = {'ok': 0, 'total': 0}
         for sid in v:
             tld_stats[k]['total'] += 1
-            if sid in latest_stats and latest_stats[sid].harvest_successful == HarvestStatus.SUCCESS:
+            if sid in latest_stats and latest_stats[sid].harvest_successful in (HarvestStatus.SUCCESS,
+                                                                                    HarvestStatus.NOT_MODIFIED):
                 tld_stats[k]['ok'] += 1
 
     # get list of unique providers in system
@@ -168,6 +169,7 @@ def add_service():
     f.populate_obj(service)
     url = urlparse.urlparse(service.url)
     service.tld = url.hostname
+    service.canonical_url = canonical_url(service.url)
     service.save()
 
     flash("Service '%s' Registered" % service.name, 'success')
@@ -185,6 +187,7 @@ def edit_service_submit(service_id):
 
     url = urlparse.urlparse(service.url)
     service.tld = url.hostname
+    service.canonical_url = canonical_url(service.url)
     service.save()
 
     flash("Service '%s' updated" % service.name, 'success')
@@ -214,7 +217,7 @@ def ping_service(service_id):
 def harvest_service(service_id):
     s = db.Service.find_one({'_id': service_id})
 
-    queue.enqueue_call(harvest, args=(service_id,), timeout=500)
+    queues['harvests'].enqueue_call(harvest, args=(service_id,), kwargs={'force': True}, timeout=500)
     #h = harvest(service_id, ignore_active=True)
     flash("Harvest queued")
     return redirect(url_for('show_service', service_id=service_id))
@@ -284,7 +287,7 @@ def edit_service(service_id):
 @app.route('/services/reindex', methods=['GET'])
 @requires_auth
 def reindex():
-    queue.enqueue(reindex_services)
+    queues['reindex'].enqueue(reindex_services)
     return jsonify({"message": "queued"})
 
 
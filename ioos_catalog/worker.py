@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+ioos_catalog/worker.py
+
+Runs pools of RQ workers. A pool is a list of queues, in priority order, and
+the number of worker processes listening to them, written as
+
+    pings,email:2
+
+so that a few workers can be kept for pings and emails while others work
+through the harvests. Without pools on the command line, WORKER_POOLS from
+the config is used.
+'''
+from multiprocessing import Process
+from rq import Worker
+import logging
+import signal
+import time
+
+from ioos_catalog import app, QUEUE_NAMES, queues, redis_connection
+
+DEFAULT_POOLS = ['pings,email,default:2', 'harvests,reindex,default:4']
+
+
+def parse_pools(specs):
+    '''
+    Returns a list of (queue names, process count) from pool specs like
+    'pings,email:2'. The queues of each pool are put in priority order.
+    '''
+    pools = []
+    for spec in specs:
+        names, _, count = spec.partition(':')
+        names = [n.strip() for n in names.split(',') if n.strip()]
+        unknown = set(names) - set(QUEUE_NAMES)
+        if unknown:
+            raise ValueError("Unknown queues %s, expected some of %s" % (', '.join(sorted(unknown)),
+                                                                           ', '.join(QUEUE_NAMES)))
+        count = int(count) if count else 1
+        if not names or count < 1:
+            raise ValueError("Invalid worker pool %r" % spec)
+        pools.append((sorted(set(names), key=QUEUE_NAMES.index), count))
+    return pools
+
+
+def work(names):
+    worker = Worker([queues[name] for name in names], connection=redis_connection)
+    worker.work()
+
+
+def run_pools(pools):
+    '''
+    Runs the worker processes of pools until they all exit or the parent is
+    told to stop, which stops them too
+    '''
+    processes = []
+    for names, count in pools:
+        for i in xrange(count):
+            p = Process(target=work, args=(names,), name='worker-%s-%d' % ('-'.join(names), i))
+            p.start()
+            processes.append(p)
+            app.logger.info("Started %s listening to %s", p.name, ', '.join(names))
+
+    def stop(signum, frame):
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while any(p.is_alive() for p in processes):
+        time.sleep(1)
+
+
+def main(specs=None):
+    logging.basicConfig(level=logging.INFO)
+    pools = parse_pools(specs or app.config.get('WORKER_POOLS') or DEFAULT_POOLS)
+    if len(pools) == 1 and pools[0][1] == 1:
+        work(pools[0][0])
+    else:
+        run_pools(pools)
@@ -1,10 +1,13 @@
 from flask.ext.script import Manager
 
 from rq import Queue
+from datetime import datetime
 
-from ioos_catalog import app, db, queue, redis_connection
+from ioos_catalog import app, db, queue, queues, redis_connection
 
 from ioos_catalog.tasks.stat import queue_ping_tasks
+from ioos_catalog.tasks.ping_engine import run_ping_engine
+from ioos_catalog.tasks.ping_scheduler import run_ping_scheduler
 from ioos_catalog.tasks.harvest import queue_harvest_tasks, queue_provider
 from ioos_catalog.tasks.reindex_services import reindex_services, cleanup_datasets as cleanup
 from ioos_catalog.tasks.send_email import send_daily_report_email
@@ -16,17 +19,77 @@ manager = Manager(app)
 def queue_pings():
     queue_ping_tasks()
 
+@manager.option('--forever', dest='forever', action='store_true', default=False,
+                help='Keep running, sweeping at the top of every hour')
+def ping_engine(forever=False):
+    run_ping_engine(forever)
+
+@manager.command
+def ping_scheduler():
+    run_ping_scheduler()
+
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help='Harvest every service, even those that have not changed')
+def queue_harvests(force=False):
+    queue_harvest_tasks(force)
+
+@manager.option('provider')
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help='Harvest every service, even those that have not changed')
+def queue_provider_harvest(provider, force=False):
+    queue_provider(provider, force)
+
+@manager.command
+def harvest_skips():
+    with app.app_context():
+        stats = db.Harvest.get_skip_stats()
+    print "%-6s %10s %12s %14s" % ('type', 'skipped', 'saved (h)', 'not modified')
+    for service_type, row in sorted(stats.iteritems()):
+        print "%-6s %10d %12.1f %14d" % (service_type, row['skipped'],
+                                         row['skipped_seconds'] / 3600., row['not_modified'])
+
+@manager.command
+def harvest_status():
+    from ioos_catalog.tasks.harvest_scheduler import harvest_queue_depths
+    with app.app_context():
+        depths = harvest_queue_depths()
+    print "%-40s %8s %8s %6s" % ('host', 'pending', 'running', 'limit')
+    for host, d in sorted(depths.iteritems(), key=lambda (h, d): (-d['pending'], h)):
+        print "%-40s %8d %8d %6d" % (host, d['pending'], d['running'], d['limit'])
+
 @manager.command
-def queue_harvests():
-    queue_harvest_tasks()
+def harvest_makespan():
+    from ioos_catalog.tasks.harvest_scheduler import get_makespan_report
+    with app.app_context():
+        current, runs = get_makespan_report()
+    print "%-20s %6s %10s %10s %7s" % ('started (UTC)', 'jobs', 'predicted', 'actual', 'error')
+    for label, run in [('running', current)] + [('', r) for r in runs]:
+        if run is None:
+            continue
+        error = (run['actual'] - run['predicted']) / run['predicted'] * 100 if run['predicted'] else 0
+        print "%-20s %6d %9.0fs %9.0fs %6.0f%% %s" % (
+            datetime.utcfromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M'),
+            run['jobs'], run['predicted'], run['actual'], error, label)
 
 @manager.command
-def queue_provider_harvest(provider):
-    queue_provider(provider)
+def harvest_dispatch():
+    from ioos_catalog.tasks.harvest_scheduler import dispatch
+    with app.app_context():
+        print "Enqueued %d harvests" % dispatch()
 
 @manager.command
 def empty_queue():
-    queue.empty()
+    from ioos_catalog.tasks.harvest_scheduler import clear_harvest_schedule
+    for q in queues.itervalues():
+        q.empty()
+    clear_harvest_schedule()
+
+@manager.command
+def queue_status():
+    from ioos_catalog import QUEUE_NAMES
+    print "%-10s %8s" % ('queue', 'jobs')
+    for name in QUEUE_NAMES:
+        print "%-10s %8d" % (name, queues[name].count)
 
 @manager.command
 def empty_failed():
@@ -36,11 +99,26 @@ def empty_failed():
 @manager.option('--provider', help='Provider to filter')
 def queue_reindex(provider=None):
     print provider
-    queue.enqueue(reindex_services, provider)
+    queues['reindex'].enqueue(reindex_services, provider)
 
 @manager.command
 def queue_daily_status():
-    queue.enqueue(send_daily_report_email)
+    queues['email'].enqueue(send_daily_report_email)
+
+@manager.option('--now', dest='now', action='store_true', default=False,
+                help="Send the pending flips without waiting for NOTIFY_WINDOW")
+def status_digest(now=False):
+    from ioos_catalog.tasks.notify import queue_digest_if_due, flush_status_digest
+    with app.app_context():
+        if now:
+            queues['email'].enqueue(flush_status_digest)
+        else:
+            queue_digest_if_due()
+
+@manager.command
+def prune_ping_rollups():
+    from ioos_catalog.tasks.stat import queue_prune_ping_rollups
+    queue_prune_ping_rollups()
 
 @manager.command
 def cleanup_datasets():
@@ -66,6 +144,11 @@ def migrate_150120():
     from ioos_catalog.models.migration.migrate_150120 import migrate
     queue.enqueue(migrate)
 
+@manager.command
+def migrate_261018():
+    from ioos_catalog.models.migration.migrate_261018 import migrate
+    queue.enqueue(migrate)
+
 @manager.command
 def captcha_init():
     initialize_captcha_db()
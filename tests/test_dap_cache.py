@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_dap_cache.py
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ioos_catalog.harvesters.dap_cache import (DapCache, DapCacheProxy, encode_url, HIT,
+                                                 REVALIDATED, MISS)
+import errno
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+DAS = 'Attributes {\n    time {\n        String units "days since 1970-01-01";\n    }\n}\n'
+DDS = 'Dataset {\n    Float64 time[time = 3];\n} ds;\n'
+
+
+class FakeDapHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the DAS and DDS of one dataset with an ETag, and some data
+    '''
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        documents = {'/ds.das': DAS, '/ds.dds': DDS}
+        if self.path in documents:
+            body = documents[self.path]
+            etag = '"%d"' % hash(body)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Description', 'dods_' + self.path[-3:])
+        elif self.path.startswith('/ds.dods'):
+            body = 'Data:\n' + self.path
+            self.send_response(200)
+        elif self.path in ('/cut.das', '/cut.dods'):
+            # the server goes away halfway through the body
+            body = 'Attributes {\n' * 100
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        else:
+            self.send_error(404)
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FullDapCache(DapCache):
+    '''
+    A cache on a full disk
+    '''
+
+    def _write(self, path, data):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+
+class TestDapCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeDapHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/ds' % self.server.server_address[1]
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_revalidation(self):
+        cache = DapCache(self.path)
+        entry, how = cache.fetch(self.url + '.das')
+        assert how == MISS
+        assert entry['body'] == DAS
+
+        entry, how = cache.fetch(self.url + '.das')
+        assert how == REVALIDATED
+        assert entry['body'] == DAS
+        assert len(self.server.requests) == 2
+
+        # fresh entries aren't revalidated
+        cache = DapCache(self.path, max_age=60)
+        entry, how = cache.fetch(self.url + '.das')
+        assert how == HIT
+        assert entry['headers']['Content-Description'] == 'dods_das'
+        assert len(self.server.requests) == 2
+
+    def test_lru_eviction(self):
+        cache = DapCache(self.path, max_bytes=25)
+        cache.put(u'http://a/ds.das', '0123456789')
+        cache.put(u'http://b/ds.das', '0123456789')
+        # a is used more recently than b
+        past = time.time() - 60
+        for _, _, body_path in cache.entries():
+            os.utime(body_path, (past, past))
+        assert cache.get(u'http://a/ds.das') is not None
+
+        cache.put(u'http://c/ds.das', '0123456789')
+        assert cache.get(u'http://b/ds.das') is None
+        assert cache.get(u'http://a/ds.das') is not None
+        assert cache.get(u'http://c/ds.das') is not None
+        assert cache.size() <= 25
+
+    def test_proxy(self):
+        cache = DapCache(self.path)
+        with DapCacheProxy(cache, [self.url]) as proxy:
+            url = proxy.url(self.url)
+            for _ in xrange(2):
+                response = requests.get(url + '.dds')
+                assert response.status_code == 200
+                assert response.content == DDS
+                assert response.headers['Content-Description'] == 'dods_dds'
+
+            response = requests.get(url + '.dods?time[0:1:2]')
+            assert response.content == 'Data:\n/ds.dods?time[0:1:2]'
+
+            assert requests.get(url + '.nc').status_code == 404
+            stats = proxy.stats
+        assert stats == {HIT: 0, REVALIDATED: 1, MISS: 1}
+        assert self.server.requests == ['/ds.dds', '/ds.dds', '/ds.dods?time[0:1:2]', '/ds.nc']
+
+    def test_registered_datasets_only(self):
+        cache = DapCache(self.path)
+        other = self.url[:-len('/ds')] + '/other'
+        with DapCacheProxy(cache, [self.url]) as proxy:
+            with self.assertRaises(KeyError):
+                proxy.url(other)
+            url = proxy.url(self.url).replace(proxy.datasets.keys()[0], encode_url(other))
+            assert requests.get(url + '.dds').status_code == 404
+            assert requests.get(url + '.dods').status_code == 404
+        assert self.server.requests == []
+
+    def test_cut_short(self):
+        cache = DapCache(self.path)
+        url = self.url[:-len('/ds')] + '/cut'
+        with self.assertRaises(requests.ConnectionError):
+            cache.fetch(url + '.das')
+        assert cache.get(url + '.das') is None
+
+        with DapCacheProxy(cache, [url]) as proxy:
+            assert requests.get(proxy.url(url) + '.das').status_code == 502
+            # no error page in the middle of a body that has begun
+            try:
+                content = requests.get(proxy.url(url) + '.dods').content
+            except requests.RequestException:
+                pass
+            else:
+                assert 'Error' not in content
+                assert len(content) < len('Attributes {\n' * 100)
+        assert cache.entries() == []
+
+    def test_cache_failure_passes_through(self):
+        cache = FullDapCache(self.path)
+        with self.assertRaises(IOError):
+            cache.fetch(self.url + '.das')
+        with DapCacheProxy(cache, [self.url]) as proxy:
+            response = requests.get(proxy.url(self.url) + '.das')
+            assert response.status_code == 200
+            assert response.content == DAS
+
+        # errors of the server aren't a cache failure, nor tried twice
+        other = self.url[:-len('/ds')] + '/missing'
+        with DapCacheProxy(cache, [other]) as proxy:
+            assert requests.get(proxy.url(other) + '.das').status_code == 404
+        assert self.server.requests == ['/ds.das', '/ds.das', '/ds.das', '/missing.das']
+
+    def test_can_proxy(self):
+        assert DapCacheProxy.can_proxy('http://example.com/thredds/dodsC/ds')
+        assert not DapCacheProxy.can_proxy('file:///data/ds.nc')
+        assert not DapCacheProxy.can_proxy('http://example.com/dods?x=1')
@@ -1,6 +1,14 @@
 from ioos_catalog.tasks.harvest import DapHarvest
+from ioos_catalog.harvesters.dap_harvester import DapHarvester, set_dap_timeouts
+from shapely.geometry import box
 from tests.flask_mongo import FlaskMongoTestCase
 import json
+import netCDF4
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
 
 class TestDapHarvester(FlaskMongoTestCase):
 
@@ -68,3 +76,84 @@ class TestDapHarvester(FlaskMongoTestCase):
         assert type(json.loads(json.dumps(s['geojson']))) == dict
         assert s['asset_type'] == "Grid"
         assert sorted(s['keywords']) == [u'Oceans > Coastal Process > Shorelines']
+
+
+class FakeNc(object):
+
+    def __init__(self, variables):
+        self.variables = variables
+
+
+class FakeCommonDataset(object):
+    '''
+    Variables u, v and temp on the lon_rho/lat_rho grid, which has no
+    geometry, and zeta on lon/lat. The curvilinear grid is all zeros.
+    '''
+
+    def __init__(self):
+        self.polygon_calls = []
+        grid = np.zeros((4, 5))
+        self.nc = FakeNc({'lon': grid[0], 'lat': grid[:, 0], 'lon_rho': grid, 'lat_rho': grid})
+
+    def get_coord_names(self, var=None, **kwargs):
+        if var == 'zeta':
+            return {'xname': 'lon', 'yname': 'lat', 'zname': None, 'tname': 'time'}
+        return {'xname': 'lon_rho', 'yname': 'lat_rho', 'zname': None, 'tname': 'time'}
+
+    def getboundingpolygon(self, var=None, **kwargs):
+        self.polygon_calls.append(var)
+        if var != 'zeta':
+            raise ValueError("no polygon")
+        return box(-75, 35, -70, 40)
+
+    def getbbox(self, var=None, **kwargs):
+        raise ValueError("no bbox")
+
+
+class TestParseGeometry(unittest.TestCase):
+
+    def test_geometry_per_grid(self):
+        harvester = DapHarvester({'url': u'http://example.com/dods/roms'})
+        harvester.cd = FakeCommonDataset()
+        harvester.axis_names = {}
+        harvester.std_variables = ['u', 'v']
+        harvester.non_std_variables = ['temp', 'zeta']
+
+        gj = harvester.parse_geometry()
+        assert gj['type'] == 'Polygon'
+        # v and temp are on the grid u already failed on
+        assert harvester.cd.polygon_calls == ['u', 'zeta']
+        assert harvester.counters == {'geometry_reads': 2, 'geometry_reads_avoided': 2,
+                                      'geometry_edge_reads': 1}
+
+
+class TestDapTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.home = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home
+        os.environ.pop('DAPRCFILE', None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.home)
+
+    def test_set_timeouts(self):
+        with open(os.path.join(self.home, '.dodsrc'), 'w') as f:
+            f.write('HTTP.SSL.VALIDATE=0\nHTTP.TIMEOUT=5\n')
+        set_dap_timeouts(30.2, None)
+        if hasattr(netCDF4, 'rc_get'):
+            assert netCDF4.rc_get('HTTP.TIMEOUT') == '31'
+            assert netCDF4.rc_get('HTTP.CONNECTTIMEOUT') == '0'
+            return
+        # older libraries read them from the rc file, with the user's settings
+        with open(os.environ['DAPRCFILE']) as f:
+            lines = f.read().splitlines()
+        assert lines == ['HTTP.SSL.VALIDATE=0', 'HTTP.TIMEOUT=31', 'HTTP.CONNECTTIMEOUT=0']
+
+        set_dap_timeouts(10, 5)
+        with open(os.environ['DAPRCFILE']) as f:
+            lines = f.read().splitlines()
+        assert lines == ['HTTP.SSL.VALIDATE=0', 'HTTP.TIMEOUT=10', 'HTTP.CONNECTTIMEOUT=5']
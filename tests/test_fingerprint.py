@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_fingerprint.py
+'''
+
+from ioos_catalog.harvesters.fingerprint import get_fingerprint_urls, same_fingerprint
+import unittest
+
+
+class FakeService(object):
+
+    def __init__(self, url, service_type):
+        self.url = url
+        self.service_type = service_type
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_dap_urls(self):
+        urls = get_fingerprint_urls(FakeService('http://example.com/dods/ds', 'DAP'))
+        assert urls == ['http://example.com/dods/ds.das', 'http://example.com/dods/ds.dds']
+
+    def test_capabilities_url(self):
+        service = FakeService('http://example.com/sos?SERVICE=SOS&request=GetCapabilities&sections=Contents', 'SOS')
+        url, = get_fingerprint_urls(service)
+        assert 'sections' not in url
+        assert 'SERVICE' not in url
+        assert 'request=GetCapabilities' in url
+        assert 'service=SOS' in url
+
+    def test_same_fingerprint(self):
+        a = [{'url': u'x.das', 'sha1': u'1'}, {'url': u'x.dds', 'sha1': u'2'}]
+        b = [{'url': u'x.dds', 'sha1': u'2', 'etag': u'"e"'}, {'url': u'x.das', 'sha1': u'1'}]
+        assert same_fingerprint(a, b)
+        assert not same_fingerprint(a, [{'url': u'x.das', 'sha1': u'1'}])
+        assert not same_fingerprint(None, a)
+        assert not same_fingerprint([], [])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_geometry.py
+'''
+
+from ioos_catalog.harvesters.geometry import (curvilinear_polygon, read_ring, read_chunks,
+                                              simplify_trajectory, visvalingam)
+from paegan.cdm.gridvar import Gridobj
+from shapely.geometry import LineString, MultiPoint, Point
+import numpy as np
+import unittest
+
+
+class CountingVariable(object):
+    '''
+    A 2-D array that counts the values read from it, like a remote variable
+    '''
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.read = 0
+
+    def __getitem__(self, index):
+        values = self.array[index]
+        self.read += np.size(values)
+        return values
+
+
+class FakeNc(object):
+
+    def __init__(self, **variables):
+        self.variables = variables
+
+
+def rotated_grid(n0, n1, angle=30., x0=-75., y0=35.):
+    '''
+    Returns lon, lat of a ROMS like grid rotated by angle degrees and bent a
+    little, so that its edges aren't straight
+    '''
+    i, j = np.meshgrid(np.arange(n0, dtype=float), np.arange(n1, dtype=float), indexing='ij')
+    a = np.radians(angle)
+    u = j * 0.05
+    v = i * 0.05 + 0.1 * np.sin(j / float(n1) * np.pi)
+    return x0 + u * np.cos(a) - v * np.sin(a), y0 + u * np.sin(a) + v * np.cos(a)
+
+
+def full_read_polygon(lon, lat):
+    return Gridobj(FakeNc(lon=lon.copy(), lat=lat.copy()), 'lon', 'lat').boundingpolygon
+
+
+class TestCurvilinearPolygon(unittest.TestCase):
+
+    def test_matches_full_read(self):
+        lon, lat = rotated_grid(60, 90)
+        expected = full_read_polygon(lon, lat)
+        polygon = curvilinear_polygon(lon, lat)
+        assert polygon.symmetric_difference(expected).area < 1e-9 * expected.area
+
+    def test_wrapped_longitudes(self):
+        lon, lat = rotated_grid(40, 50, x0=178.)
+        lon[lon < 0] += 360
+        expected = full_read_polygon(lon, lat)
+        polygon = curvilinear_polygon(lon, lat)
+        assert polygon.bounds[0] < -170
+        assert polygon.symmetric_difference(expected).area < 1e-9 * expected.area
+
+    def test_reads_grow_with_perimeter(self):
+        lon, lat = rotated_grid(400, 500)
+        x, y = CountingVariable(lon), CountingVariable(lat)
+        expected = full_read_polygon(lon, lat)
+        polygon = curvilinear_polygon(x, y, max_points=100)
+        assert x.read <= 4 * 101
+        assert y.read <= 4 * 101
+        # strided edges cut a little off the bends
+        assert polygon.symmetric_difference(expected).area < 1e-3 * expected.area
+
+    def test_ring_order(self):
+        lon, lat = np.meshgrid(np.arange(3.), np.arange(4.))
+        xs, ys = read_ring(lon, lat)
+        assert zip(xs, ys) == [(0, 0), (0, 1), (0, 2), (0, 3), (1, 3), (2, 3),
+                               (2, 2), (2, 1), (2, 0), (1, 0), (0, 0)]
+
+    def test_masked_edges(self):
+        lon, lat = rotated_grid(30, 40)
+        lon = np.ma.masked_array(lon, mask=np.zeros(lon.shape, dtype=bool))
+        # an HF Radar like grid with no coordinates where there is land
+        lon[:2, :15] = np.ma.masked
+        lat[-1, -5:] = np.nan
+
+        polygon = curvilinear_polygon(lon, lat)
+        valid = ~np.ma.getmaskarray(lon) & np.isfinite(lat)
+        expected = MultiPoint(zip(lon[valid], lat[valid])).convex_hull
+        # the hull of the outer rings is within the hull of every valid point
+        assert polygon.difference(expected).area < 1e-9
+        assert polygon.area > 0.9 * expected.area
+
+    def test_not_curvilinear(self):
+        with self.assertRaises(ValueError):
+            curvilinear_polygon(np.arange(5.), np.arange(5.))
+        with self.assertRaises(ValueError):
+            curvilinear_polygon(np.zeros((3, 3)) * np.nan, np.zeros((3, 3)))
+
+
+class TestTrajectorySimplifier(unittest.TestCase):
+
+    def test_keeps_turning_points(self):
+        # a zig-zag drifter track, the naive striding lands between corners
+        t = np.linspace(0, 1, 100001)
+        xs = -70 + t
+        ys = 40 + np.abs(((t * 13) % 2) - 1)
+        turns = np.where(np.diff(np.sign(np.diff(ys))) != 0)[0] + 1
+        corners = zip(xs[turns], ys[turns])
+        assert len(corners) == 12
+
+        simplifier = simplify_trajectory(read_chunks(xs, ys, 7919), 50)
+        sx, sy = simplifier.result()
+        assert len(sx) <= 50
+        assert (sx[0], sy[0]) == (xs[0], ys[0])
+        assert (sx[-1], sy[-1]) == (xs[-1], ys[-1])
+        line = LineString(zip(sx, sy))
+        for corner in corners:
+            assert line.distance(Point(corner)) < 1e-6
+
+    def test_bounded_memory(self):
+        simplifier = simplify_trajectory([], 100)
+        rng = np.random.RandomState(0)
+        for _ in xrange(50):
+            xs = np.cumsum(rng.normal(0, 0.01, 10000)) % 180
+            ys = np.cumsum(rng.normal(0, 0.01, 10000)) % 90
+            simplifier.add(xs, ys)
+            assert len(simplifier.xs) < 2 * 100
+        assert simplifier.points == 500000
+        assert len(simplifier.result()[0]) <= 100
+
+    def test_drops_invalid_points(self):
+        xs = np.ma.masked_array([0., 1., np.nan, 2., 200., 3.], mask=[0, 0, 0, 0, 0, 1])
+        ys = np.array([0., 1., 2., 90.5, 3., 3.])
+        simplifier = simplify_trajectory([(xs, ys)], 10)
+        sx, sy = simplifier.result()
+        assert zip(sx, sy) == [(0, 0), (1, 1)]
+        assert simplifier.invalid == 4
+
+    def test_visvalingam_drops_smallest_areas(self):
+        xs = np.array([0., 1., 2., 3., 4.])
+        ys = np.array([0., 0.01, 0., 5., 0.])
+        sx, sy = visvalingam(xs, ys, 4)
+        assert zip(sx, sy) == [(0, 0), (2, 0), (3, 5), (4, 0)]
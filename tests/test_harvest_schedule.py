@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_harvest_schedule.py
+'''
+
+from ioos_catalog import app
+from ioos_catalog.tasks.harvest import estimate_harvest
+from ioos_catalog.tasks.harvest_scheduler import (predict_makespan, forget_host,
+                                                  HOSTS_KEY, LEASES_KEY, PENDING_KEY, WORK_KEY)
+import json
+import redis
+import unittest
+
+# the scheduler keys the tests write are kept out of the app's database
+TEST_REDIS_DB = 15
+
+
+class TestHarvestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        app.config['HARVEST_PER_HOST'] = 2
+        app.config['HARVEST_HOST_LIMITS'] = {}
+
+    def test_makespan_respects_host_limits(self):
+        # six 10s jobs on one host run two at a time, the 100s job bounds it
+        jobs = [('a', 10)] * 6 + [('b', 100), ('c', 5)]
+        assert predict_makespan(jobs, 4) == 100
+        assert predict_makespan([('a', 10)] * 8, 8) == 40
+        assert predict_makespan([('h%d' % i, 7) for i in range(10)], 3) == 28
+
+    def test_estimate_without_history(self):
+        assert estimate_harvest([], 10) == (180., 180)
+        assert estimate_harvest(None, 100) == (6000., 6000)
+
+    def test_estimate_from_history(self):
+        timings = [{'total': t, 'completed': True} for t in (100., 120., 110., 400.)]
+        expected, timeout = estimate_harvest(timings, 10)
+        assert expected == 115.
+        assert 600 < timeout < 800
+
+        killed = [{'total': 700., 'completed': False}] + timings
+        assert estimate_harvest(killed, 10)[1] >= 1400
+
+
+class InterleavingRedis(object):
+    '''
+    A redis client that runs hook once, when the scheduler checks whether a
+    host can be forgotten: after a separate zcard check returns, or before
+    the forget script runs
+    '''
+
+    def __init__(self, client, hook):
+        self._client = client
+        self._hook = hook
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _run_hook(self):
+        if self._hook is not None:
+            hook, self._hook = self._hook, None
+            hook()
+
+    def zcard(self, key):
+        n = self._client.zcard(key)
+        self._run_hook()
+        return n
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        # the forget script is the one with four keys
+        if numkeys == 4:
+            self._run_hook()
+        return self._client.evalsha(sha, numkeys, *keys_and_args)
+
+
+class TestForgetHost(unittest.TestCase):
+
+    host = u'forget-host.invalid'
+
+    def setUp(self):
+        self.redis = redis.Redis(host=app.config.get('REDIS_HOST'),
+                                 port=app.config.get('REDIS_PORT'),
+                                 db=TEST_REDIS_DB)
+        try:
+            self.redis.ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest("Redis is not available")
+        self.tearDown()
+
+    def tearDown(self):
+        self.redis.delete(PENDING_KEY % self.host, LEASES_KEY % self.host)
+        self.redis.srem(HOSTS_KEY, self.host)
+        self.redis.hdel(WORK_KEY, self.host)
+
+    def schedule(self):
+        # what schedule_harvests does for one job
+        self.redis.rpush(PENDING_KEY % self.host, json.dumps({'service_id': 'x', 'timeout': 60,
+                                                              'expected': 10., 'batch': False}))
+        self.redis.hincrbyfloat(WORK_KEY, self.host, 10.)
+        self.redis.sadd(HOSTS_KEY, self.host)
+
+    def test_forget_idle_host(self):
+        self.redis.sadd(HOSTS_KEY, self.host)
+        assert forget_host(self.host, redis=self.redis)
+        assert not self.redis.sismember(HOSTS_KEY, self.host)
+
+    def test_keep_host_with_work(self):
+        self.schedule()
+        assert not forget_host(self.host, redis=self.redis)
+        self.redis.delete(PENDING_KEY % self.host)
+        self.redis.zadd(LEASES_KEY % self.host, 'y', 1e12)
+        assert not forget_host(self.host, redis=self.redis)
+        assert self.redis.sismember(HOSTS_KEY, self.host)
+
+    def test_schedule_while_forgetting(self):
+        # the host is idle when dispatch finds no job for it, and a job for
+        # it is scheduled while it is being forgotten
+        self.redis.sadd(HOSTS_KEY, self.host)
+        assert not forget_host(self.host, redis=InterleavingRedis(self.redis, self.schedule))
+        assert self.redis.sismember(HOSTS_KEY, self.host)
+        assert self.redis.llen(PENDING_KEY % self.host) == 1
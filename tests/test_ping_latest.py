@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_ping_latest.py
+'''
+
+from datetime import datetime, timedelta
+from ioos_catalog.models.ping_latest import (PingLatest, WINDOW_FIELDS, decode_window,
+                                             empty_window, encode_window)
+import unittest
+
+
+class TestPingLatestWindow(unittest.TestCase):
+
+    def test_index(self):
+        monday = datetime(2026, 10, 12)
+        assert PingLatest.get_index(monday, 3600) == 0
+        assert PingLatest.get_index(monday + timedelta(days=1, hours=2), 3600) == 26
+        assert PingLatest.get_index(monday + timedelta(minutes=11), 300) == 2
+        assert PingLatest.get_index(monday - timedelta(seconds=1), 300) == 2015
+
+    def test_skipped_indexes(self):
+        start = datetime(2026, 10, 12, 10, 30)
+        assert PingLatest.get_skipped_indexes(start, start + timedelta(minutes=20), 300) == [7 + 120, 8 + 120, 9 + 120]
+        assert PingLatest.get_skipped_indexes(start, start + timedelta(hours=3), 3600) == [11, 12]
+        stale = PingLatest.get_skipped_indexes(start, start + timedelta(days=8), 3600)
+        assert len(stale) == 167
+
+    def test_apply_ping(self):
+        windows = {field: empty_window(field, 300) for field in WINDOW_FIELDS}
+        start = datetime(2026, 10, 12, 0, 0)
+        PingLatest.apply_ping(windows, 300, None, start, 120, 200, True)
+        idx = PingLatest.apply_ping(windows, 300, start, start + timedelta(minutes=15), None, -1, False)
+        assert idx == 3
+        assert list(windows['response_times'][:4]) == [120, WINDOW_FIELDS['response_times'][1],
+                                                       WINDOW_FIELDS['response_times'][1],
+                                                       WINDOW_FIELDS['response_times'][1]]
+        assert list(windows['operational_statuses'][:4]) == [1, -1, -1, 0]
+        assert list(windows['response_codes'][:4:3]) == [200, -1]
+
+    def test_roundtrip(self):
+        window = empty_window('response_times', 3600)
+        window[5] = 42
+        decoded = decode_window('response_times', encode_window(window))
+        assert len(decoded) == 168
+        assert decoded[5] == 42
+        legacy = decode_window('operational_statuses', [None, True, False])
+        assert list(legacy) == [-1, 1, 0]
+
+    def test_slot_mask(self):
+        start = datetime(2026, 10, 18, 22, 0)
+        mask = PingLatest.get_slot_mask(start, start + timedelta(hours=4), 3600)
+        assert mask.sum() == 4
+        assert list(mask.nonzero()[0]) == [0, 1, 166, 167]
+
+    def test_slot_mask_within_one_slot(self):
+        start = datetime(2026, 10, 13, 10, 5)
+        mask = PingLatest.get_slot_mask(start, start + timedelta(minutes=20), 3600)
+        assert list(mask.nonzero()[0]) == [34]
+        mask = PingLatest.get_slot_mask(start, start + timedelta(days=7), 3600)
+        assert mask.all()
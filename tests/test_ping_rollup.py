@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_ping_rollup.py
+'''
+
+from datetime import datetime, timedelta
+from ioos_catalog.models.ping_rollup import PingRollup, DEFAULT_RETENTION, TIER_LENGTHS
+import unittest
+
+# a fixed now, so the buckets don't depend on when the tests run
+NOW = datetime(2026, 10, 14, 12, 30)
+
+
+def spans(buckets):
+    return sorted((start, start + TIER_LENGTHS[tier])
+                  for tier, starts in buckets.iteritems() for start in starts)
+
+
+def get_retention(tier):
+    '''
+    PingRollup.get_retention with the default retention as of NOW
+    '''
+    days = DEFAULT_RETENTION[tier]
+    if days is None:
+        return None
+    return PingRollup.get_start_time(tier, NOW - timedelta(days=days))
+
+
+class TestPingRollupBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.get_retention = PingRollup.__dict__['get_retention']
+        PingRollup.get_retention = staticmethod(get_retention)
+
+    def tearDown(self):
+        PingRollup.get_retention = self.get_retention
+
+    def assert_tiles(self, buckets, start, end):
+        '''
+        The buckets cover start to end without overlapping
+        '''
+        s = spans(buckets)
+        assert s[0][0] <= start
+        assert s[-1][1] >= end
+        for (_, prev_end), (next_start, _) in zip(s, s[1:]):
+            assert prev_end == next_start
+
+    def test_recent_day_uses_hours(self):
+        end = NOW
+        start = end - timedelta(days=1)
+        buckets = PingRollup.get_buckets(start, end)
+        assert buckets.keys() == ['hour']
+        self.assert_tiles(buckets, start, end)
+
+    def test_month_uses_coarse_tiers(self):
+        end = NOW
+        start = end - timedelta(days=10)
+        buckets = PingRollup.get_buckets(start, end)
+        assert len(buckets.get('day', [])) + len(buckets.get('week', [])) > 0
+        assert len(buckets.get('hour', [])) < 48
+        self.assert_tiles(buckets, start, end)
+
+    def test_pruned_tiers_fall_back(self):
+        end = NOW - timedelta(days=800)
+        start = end - timedelta(days=30)
+        buckets = PingRollup.get_buckets(start, end)
+        assert buckets.keys() == ['week']
+        self.assert_tiles(buckets, start, end)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_pipeline.py
+'''
+
+from ioos_catalog.harvesters.pipeline import Pipeline
+from ioos_catalog.timeout import Deadline, DeadlineExceeded
+import threading
+import time
+import unittest
+
+
+def square(value):
+    if value == 3:
+        raise ValueError("bad value")
+    return value * value
+
+
+def unpicklable(value):
+    if value == 2:
+        return threading.Lock()
+    return value
+
+
+class TestPipeline(unittest.TestCase):
+
+    def run_pipeline(self, processes):
+        batches = []
+
+        def fetch(item):
+            if item == 5:
+                raise IOError("unreachable")
+            return item
+
+        def persist(batch):
+            batches.append(batch)
+            return [(item, 'not saved') for item, _, _ in batch if item == 7]
+
+        pipeline = Pipeline(fetch, square, persist, fetch_threads=3, processes=processes,
+                            batch_size=4, queue_size=2)
+        errors = pipeline.run(range(10))
+        saved = sorted((item, result) for batch in batches for item, _, result in batch)
+        assert saved == [(i, i * i) for i in range(10) if i not in (3, 5)]
+        assert all(len(batch) <= 4 for batch in batches)
+        assert sorted(item for item, _ in errors) == [3, 5, 7]
+
+    def test_inline(self):
+        self.run_pipeline(0)
+
+    def test_process_pool(self):
+        self.run_pipeline(2)
+
+    def test_deadline(self):
+        pipeline = Pipeline(lambda item: time.sleep(5), square, lambda batch: None,
+                            fetch_threads=1, processes=0, deadline=Deadline(0.5))
+        start = time.time()
+        self.assertRaises(DeadlineExceeded, pipeline.run, range(3))
+        assert time.time() - start < 4
+
+    def test_unpicklable_result(self):
+        batches = []
+        pipeline = Pipeline(lambda item: item, unpicklable, batches.append,
+                            fetch_threads=2, processes=2, batch_size=2, queue_size=2,
+                            deadline=Deadline(30))
+        start = time.time()
+        errors = pipeline.run(range(6))
+        assert time.time() - start < 10
+        assert [item for item, _ in errors] == [2]
+        saved = sorted(item for batch in batches for item, _, _ in batch)
+        assert saved == [0, 1, 3, 4, 5]
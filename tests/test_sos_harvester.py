@@ -1,6 +1,17 @@
 from ioos_catalog.tasks.harvest import SosHarvest
+from ioos_catalog.harvesters.sos_harvester import (SosHarvester, analyze_station, plain_value,
+                                                   IOOS_SENSORML, SENSORML)
 from tests.flask_mongo import FlaskMongoTestCase
+from lxml import etree
+from owslib import ows
 import json
+import os
+import pickle
+import threading
+import time
+import unittest
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
 
 class TestSosHarvester(FlaskMongoTestCase):
 
@@ -31,4 +42,75 @@ class TestSosHarvester(FlaskMongoTestCase):
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:sea_water_temperature',
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:wind_from_direction',
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:wind_speed',
-                                                                u'urn:ioos:sensor:us.glos:UMBIO:wind_speed_of_gust'])
\ No newline at end of file
+                                                                u'urn:ioos:sensor:us.glos:UMBIO:wind_speed_of_gust'])
+
+
+class TestAnalyzeStation(unittest.TestCase):
+
+    def test_result_pickles(self):
+        # the result comes back from a pool process
+        with open(os.path.join(DATA, 'describe_sensor_station.xml')) as f:
+            result = analyze_station(f.read())
+        assert result['id'] == u'urn:ioos:station:wmo:41001'
+        assert result['asset_type'] == u'BUOY'
+        metamap = result['metamap']
+        assert metamap['Station Short Name'] == u'EAST HATTERAS'
+        assert metamap['Sensor IDs*'] == [u'sensor1', u'sensor2']
+        for value in metamap.itervalues():
+            values = value if isinstance(value, list) else [value]
+            assert all(type(v) is unicode for v in values)
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            assert pickle.loads(pickle.dumps(result, protocol)) == result
+
+    def test_plain_smart_strings(self):
+        smart = etree.fromstring('<a>x</a>').xpath('//a/text()')
+        value = plain_value(smart)
+        assert value == [u'x']
+        assert type(value[0]) is unicode
+        pickle.dumps(value, 0)
+
+
+class Rejected(ows.ExceptionReport):
+
+    def __init__(self):
+        self.code = 'InvalidParameterValue'
+        self.msg = 'Unsupported outputFormat'
+
+
+class FormatCheckingSos(object):
+    '''
+    An SOS that only describes sensors in SensorML, and records the format
+    the harvester has settled on whenever it is asked
+    '''
+
+    def __init__(self):
+        self.harvester = None
+        self.seen = []
+
+    def describe_sensor(self, outputFormat=None, **kwargs):
+        self.seen.append(self.harvester.output_format)
+        time.sleep(0.001)
+        if outputFormat != SENSORML:
+            raise Rejected()
+        return '<sml:SensorML/>'
+
+
+class TestOutputFormat(unittest.TestCase):
+
+    def test_threads_share_accepted_format(self):
+        harvester = SosHarvester({'url': u'http://example.com/sos'})
+        harvester.sos = FormatCheckingSos()
+        harvester.sos.harvester = harvester
+
+        def describe():
+            for i in xrange(20):
+                harvester._describe_sensor('urn:ioos:station:test:%d' % i)
+
+        threads = [threading.Thread(target=describe) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert harvester.output_format == SENSORML
+        # a format the server rejected is never the recorded one
+        assert set(harvester.sos.seen) <= set([IOOS_SENSORML, SENSORML])
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_timeout.py
+'''
+
+from ioos_catalog.timeout import Deadline, DeadlineExceeded, TimeoutError
+import unittest
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_no_deadline(self):
+        deadline = Deadline()
+        assert deadline.remaining() is None
+        assert deadline.timeout(30) == 30
+        assert deadline.child(5).remaining() <= 5
+        deadline.check()
+
+    def test_timeout_is_capped(self):
+        deadline = Deadline(10)
+        assert deadline.timeout(60) <= 10
+        assert deadline.timeout(1) == 1
+        assert deadline.child(60).expires == deadline.expires
+
+    def test_expired(self):
+        deadline = Deadline(-1)
+        assert deadline.expired()
+        self.assertRaises(DeadlineExceeded, deadline.check)
+        self.assertRaises(TimeoutError, deadline.timeout, 5)
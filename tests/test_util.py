@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_util.py
+'''
+
+from ioos_catalog.util import canonical_url
+import unittest
+
+
+class TestCanonicalUrl(unittest.TestCase):
+
+    def test_query_order(self):
+        a = canonical_url('http://example.com/sos?service=SOS&request=GetCapabilities')
+        b = canonical_url('http://example.com/sos?request=GetCapabilities&service=SOS')
+        assert a == b
+
+    def test_trivial_differences(self):
+        expected = canonical_url('http://example.com/dods/ds')
+        assert canonical_url(' HTTP://Example.COM:80/dods/ds? ') == expected
+        assert canonical_url('http://example.com/dods/ds#global') == expected
+        assert canonical_url('https://example.com:8443/x') == u'https://example.com:8443/x'
+        assert canonical_url('http://example.com') == u'http://example.com/'
+
+    def test_distinct(self):
+        assert canonical_url('http://example.com/dods/ds') != canonical_url('http://example.com/dods/DS')
+        assert canonical_url('http://example.com/a?x=1') != canonical_url('http://example.com/a?x=2')
+
+    def test_non_ascii_query(self):
+        a = canonical_url(u'http://example.com/a?name=caf%C3%A9&b=1')
+        assert a == u'http://example.com/a?b=1&name=caf%C3%A9'
+        assert canonical_url(u'http://example.com/a?name=caf\xe9') == u'http://example.com/a?name=caf\xe9'
+        assert canonical_url('http://example.com/a?name=caf\xc3\xa9') == u'http://example.com/a?name=caf\xe9'
+
+    def test_ipv6_host(self):
+        assert canonical_url('http://[::1]:8080/x') == u'http://[::1]:8080/x'
+        assert canonical_url('HTTP://[FE80::1]:80/x') == u'http://[fe80::1]/x'
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+'''
+tests/test_worker.py
+'''
+
+from ioos_catalog.worker import parse_pools
+import unittest
+
+
+class TestWorkerPools(unittest.TestCase):
+
+    def test_parse_pools(self):
+        pools = parse_pools(['email,pings:2', 'harvests'])
+        assert pools == [(['pings', 'email'], 2), (['harvests'], 1)]
+
+    def test_invalid_pools(self):
+        self.assertRaises(ValueError, parse_pools, ['pongs:2'])
+        self.assertRaises(ValueError, parse_pools, ['pings:0'])
+        self.assertRaises(ValueError, parse_pools, [':3'])